@@ -0,0 +1,269 @@
+"""
+Analytics for RSNBusBot
+"""
+
+### IMPORTS
+import io
+import math
+from html import escape
+from functools import lru_cache
+
+import numpy as np
+
+from constants import * # Ensure constants.py in same directory
+from db import connect, versioned # Ensure db.py in same directory
+from outbox import split_message # Ensure outbox.py in same directory
+
+WEEKDAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"] # In the order of numpy weekdays below
+
+"""
+Analytics work on the ridership_daily rollup, one row per chat, bus time and day, loaded into columnar NumPy arrays.
+Every statistic is computed for all routes at once with grouped reductions (bincount), instead of looping over rows,
+so that years of history for every route take milliseconds.
+"""
+
+### LOADING
+class Ridership:
+    """
+    Columnar ridership of service chats.
+    Routes and bus times are stored as indexes into self.routes and self.times.
+    """
+    def __init__(self, rows):
+        columns = np.array(rows, dtype=object).reshape(-1, 6).T # Much faster than splitting the rows in Python
+
+        self.routes, self.route = np.unique(columns[0].astype(np.int64), return_inverse=True)
+        self.times, self.time = np.unique(columns[1].astype(str), return_inverse=True)
+        self.date = columns[2].astype("datetime64[D]")
+        self.riders = columns[3].astype(np.float64)
+        self.buses = columns[4].astype(np.float64)
+        self.capacity = columns[5].astype(np.float64)
+
+    def __len__(self):
+        return len(self.riders)
+
+    @property
+    def weekday(self):
+        """0 (Monday) to 6 (Sunday). 1970-01-01 was a Thursday."""
+        return (self.date.astype(np.int64) + 3) % 7
+
+def load_ridership(start_date=None, end_date=None):
+    """
+    Loads the ridership_daily rows of service chats, for dates (YYYY-MM-DD, inclusive) if given.
+    Returns the Ridership, and the pickup and destination of each chat_id.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT d.chat_id, d.time, d.date, d.riders, d.buses, d.capacity \
+                      FROM ridership_daily d JOIN settings s ON d.chat_id=s.chat_id \
+                      WHERE LOWER(s.chat_type)='service' AND d.date BETWEEN ? AND ?",
+                      (start_date or "0000-00-00", end_date or "9999-99-99"))
+    ridership = Ridership(res.fetchall())
+
+    res = cur.execute("SELECT chat_id, pickup, destination FROM settings")
+    names = {i[0]: (i[1], i[2]) for i in res.fetchall()}
+
+    con.close()
+    return ridership, names
+
+### STATISTICS
+def _ratio(numerator, denominator):
+    """Element-wise numerator / denominator, 0 where the denominator is 0."""
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+def route_stats(ridership, q=90):
+    """
+    Statistics for each route, as arrays aligned with ridership.routes:
+     - fill: riders / capacity over all buses
+     - days: days with ridership
+     - full_days: days on which at least one bus was at capacity
+     - peak: the q-th percentile of riders per bus
+    """
+    n = len(ridership.routes)
+    riders = np.bincount(ridership.route, weights=ridership.riders, minlength=n)
+    capacity = np.bincount(ridership.route, weights=ridership.capacity, minlength=n)
+
+    # Count distinct (route, date) pairs, by marking them in a route x day grid
+    day = ridership.date.astype(np.int64)
+    day = day - day.min(initial=0)
+    span = day.max(initial=0) + 1
+    grid = np.zeros((n, span), dtype=bool)
+    grid[ridership.route, day] = True
+    days = grid.sum(axis=1)
+
+    full = (ridership.riders >= ridership.capacity) & (ridership.capacity > 0)
+    grid[:] = False
+    grid[ridership.route[full], day[full]] = True
+    full_days = grid.sum(axis=1)
+
+    # Percentile of riders per bus within each route: sort by route then value, and index into each route's run
+    per_bus = _ratio(ridership.riders, ridership.buses)
+    per_bus = per_bus[np.lexsort((per_bus, ridership.route))]
+    counts = np.bincount(ridership.route, minlength=n) # Every route has at least one row
+    starts = np.cumsum(counts) - counts
+    peak = per_bus[starts + np.ceil(counts * q / 100).astype(np.int64) - 1]
+
+    return {
+        "fill": _ratio(riders, capacity),
+        "days": days,
+        "full_days": full_days,
+        "peak": peak,
+    }
+
+def heatmap(ridership):
+    """
+    Fill rate for each weekday (rows, Monday first) and bus time (columns, aligned with ridership.times).
+    Cells without buses are NaN.
+    """
+    n = len(ridership.times)
+    cell = ridership.weekday * n + ridership.time
+    riders = np.bincount(cell, weights=ridership.riders, minlength=7 * n)
+    capacity = np.bincount(cell, weights=ridership.capacity, minlength=7 * n)
+
+    fill = np.full(7 * n, np.nan)
+    np.divide(riders, capacity, out=fill, where=capacity > 0)
+    return fill.reshape(7, n)
+
+### RECOMMENDATIONS
+def recommend(rows, max_riders, bus_times):
+    """
+    Capacity recommendations for a route, from its ridership_daily rows over the last RECOMMENDATIONS_WEEKS:
+    (time, date, riders, buses, capacity, turned_away).
+    Demand is riders plus the riders turned away as buses were full.
+    Returns (kind, value, reason) for:
+     - max_riders: when the RECOMMENDATIONS_PERCENTILE of demand per bus differs enough from max riders
+     - add_bus: after a bus which was full with riders turned away on enough days
+     - remove_bus: for a bus which is rarely used
+    """
+    if not rows:
+        return []
+    columns = np.array(rows, dtype=object).reshape(-1, 6).T
+    times, time = np.unique(columns[0].astype(str), return_inverse=True)
+    riders = columns[2].astype(np.float64)
+    buses = columns[3].astype(np.float64)
+    capacity = columns[4].astype(np.float64)
+    demand = riders + columns[5].astype(np.float64)
+    recommendations = []
+
+    # Max riders covering most buses
+    if len(np.unique(columns[1])) >= RECOMMENDATIONS_MIN_DAYS: # Days, not rows, as a route has rows for each bus
+        peak = math.ceil(np.percentile(_ratio(demand, buses), RECOMMENDATIONS_PERCENTILE))
+        if peak > 0 and abs(peak - max_riders) >= RECOMMENDATIONS_MIN_CHANGE * max_riders:
+            recommendations.append(("max_riders", str(peak),
+                f"{RECOMMENDATIONS_PERCENTILE}% of buses had up to {peak} riders wanting a seat, max riders is {max_riders}"))
+
+    # Scheduled buses, with the days they ran, were full, and turned riders away
+    n = len(times)
+    days = np.bincount(time, minlength=n)
+    full = (riders >= capacity) & (capacity > 0) & (demand > riders)
+    full_days = np.bincount(time, weights=full, minlength=n)
+    turned_away = np.bincount(time, weights=demand - riders, minlength=n)
+    fill = _ratio(np.bincount(time, weights=riders, minlength=n), np.bincount(time, weights=capacity, minlength=n))
+
+    for i, t in enumerate(times):
+        if t not in bus_times or days[i] < RECOMMENDATIONS_MIN_DAYS:
+            continue # Buses booked with /book, or not enough history
+
+        if full_days[i] >= RECOMMENDATIONS_FULL_DAYS * days[i]:
+            minutes = (int(t[:2]) * 60 + int(t[2:]) + RECOMMENDATIONS_EXTRA_BUS_GAP) % (24 * 60)
+            extra = f"{minutes // 60:02d}{minutes % 60:02d}"
+            if extra not in bus_times:
+                recommendations.append(("add_bus", extra,
+                    f"The {t} bus was full on {full_days[i]:.0f} of {days[i]} days, turning away {turned_away[i]:.0f} riders"))
+
+        elif fill[i] < RECOMMENDATIONS_MIN_FILL:
+            recommendations.append(("remove_bus", t,
+                f"The {t} bus was {fill[i]:.0%} full over {days[i]} days"))
+
+    return recommendations
+
+### CHARTS
+@lru_cache(maxsize=CHART_CACHE_SIZE)
+def ridership_chart(chat_id, start_date, end_date, data_version):
+    """
+    Renders the daily riders and capacity of a service chat, for dates (YYYY-MM-DD, inclusive), as a PNG.
+    Returns None if there is no ridership.
+    data_version is only part of the cache key, so that charts are rendered again once ridership changes.
+    """
+    # Imported here, as matplotlib is slow to import and only needed for charts
+    from matplotlib.figure import Figure
+
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT date, SUM(riders), SUM(capacity) FROM ridership_daily \
+                      WHERE chat_id=? AND date BETWEEN ? AND ? GROUP BY date ORDER BY date",
+                      (chat_id, start_date, end_date))
+    rows = res.fetchall()
+
+    res = cur.execute("SELECT pickup, destination FROM settings WHERE chat_id=?", (chat_id,))
+    names = res.fetchone() or ("?", "?")
+
+    con.close()
+    if not rows:
+        return None
+
+    columns = np.array(rows, dtype=object).reshape(-1, 3).T
+    date = columns[0].astype("datetime64[D]")
+    riders = columns[1].astype(np.float64)
+    capacity = columns[2].astype(np.float64)
+
+    # Figure is used directly instead of pyplot, which keeps global state and is not safe to use from threads
+    fig = Figure(figsize=(8, 4), layout="constrained")
+    ax = fig.subplots()
+    ax.fill_between(date, riders, step="mid", alpha=0.3)
+    ax.step(date, riders, where="mid", label="Riders")
+    ax.step(date, capacity, where="mid", linestyle="--", color="grey", label="Capacity")
+    ax.set_title(f"{names[0]} to {names[1]}, {start_date} to {end_date}")
+    ax.set_ylabel("Riders / day")
+    ax.set_ylim(bottom=0)
+    ax.legend(loc="upper left")
+    fig.autofmt_xdate()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=100)
+    return buffer.getvalue()
+
+### REPORT
+@versioned(maxsize=RESULT_CACHE_SIZE)
+def analytics_report(start_date=None, end_date=None):
+    """
+    Renders fill rates, days at capacity and the weekday x bus time heatmap into HTML messages.
+    Routes are split across as many messages as needed, and the heatmap is sent after them, 
+    as tables of at most HEATMAP_COLUMNS bus times.
+    Returns the messages, or None if there is no ridership.
+    """
+    ridership, names = load_ridership(start_date, end_date)
+    if len(ridership) == 0:
+        return None
+
+    overall = ridership.riders.sum() / max(ridership.capacity.sum(), 1)
+    first, last = ridership.date.min(), ridership.date.max()
+    text = f"<b>Utilisation from {first} to {last}</b>\nOverall fill rate: {overall:.0%}\n"
+
+    # Routes, fullest first
+    stats = route_stats(ridership)
+    text += "\n<b>Routes</b> (fill rate, days with a full bus, 90th percentile riders per bus)"
+    for i in np.argsort(-stats["fill"]):
+        pickup, destination = names.get(int(ridership.routes[i]), ("?", "?"))
+        text += (f"\n{escape(pickup)} -&gt; {escape(destination)}: {stats['fill'][i]:.0%}, "
+                 f"{stats['full_days'][i]}/{stats['days'][i]} days full, "
+                 f"{stats['peak'][i]:.0f} riders")
+
+    # Heatmap of fill rate (%), only weekdays with buses
+    fill = heatmap(ridership)
+    tables = ["<b>Fill rate (%) by day and bus time</b>"]
+    for start in range(0, len(ridership.times), HEATMAP_COLUMNS):
+        columns = slice(start, start + HEATMAP_COLUMNS)
+        table = "     " + " ".join(f"{escape(t):>4}" for t in ridership.times[columns])
+        for weekday in range(7):
+            if np.isnan(fill[weekday]).all():
+                continue
+            cells = " ".join("   -" if np.isnan(i) else f"{i * 100:>4.0f}" for i in fill[weekday][columns])
+            table += f"\n{WEEKDAY_NAMES[weekday]:<4} {cells}"
+        tables.append(f"<pre>{table}</pre>")
+
+    # Route lines and heatmap tables are never split, so that no HTML tag is cut
+    return split_message(text) + split_message("\n\n".join(tables), "\n\n")
@@ -0,0 +1,89 @@
+"""
+Benchmark for the /webhook endpoint of RSNBusBot
+
+Measures requests per second for the webhook alone (decoding, filtering and queueing), using FastAPI's test client.
+The PTB application is not started, so no requests are made to Telegram and queued updates are not processed.
+
+Usage (from the repository root):
+    python benchmarks/bench_webhook.py [requests]
+"""
+
+### IMPORTS
+import os
+import sys
+import time
+import tempfile
+
+# Environment for main.py, unless already set
+os.environ.setdefault('TOKEN', '123456:benchmark')
+os.environ.setdefault('BOT_USERNAME', 'benchmark_bot')
+os.environ.setdefault('TIMEZONE', 'Asia/Singapore')
+os.environ.setdefault('PASSWORD', 'benchmark')
+os.environ.setdefault('DB_FILEPATH', tempfile.mkdtemp())
+os.environ.setdefault('WEBHOOK_SECRET', 'benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+
+import main
+import webhook
+
+### UPDATES
+def callback_update(update_id):
+    """Book button clicked in a service chat."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": 1000 + update_id % 500, "is_bot": False, "first_name": "Rider", "username": f"rider{update_id % 500}"},
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": -1000000000 - update_id % 20, "type": "supergroup", "title": "Service"},
+                "text": "Booking ID: 0",
+            },
+            "chat_instance": "0",
+            "data": "book",
+        },
+    }
+
+def unhandled_update(update_id):
+    """Update type without handlers, e.g. bot added to a chat."""
+    return {
+        "update_id": update_id,
+        "my_chat_member": {
+            "chat": {"id": -1000000000, "type": "supergroup", "title": "Service"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Admin"},
+            "date": 0,
+            "old_chat_member": {"status": "left", "user": {"id": 2, "is_bot": True, "first_name": "Bot"}},
+            "new_chat_member": {"status": "member", "user": {"id": 2, "is_bot": True, "first_name": "Bot"}},
+        },
+    }
+
+### BENCHMARK
+def run(client, name, updates, headers):
+    """
+    Posts every update to the webhook, and prints the requests per second.
+    """
+    main.update_queue = webhook.UpdateQueue(len(updates)) # Large enough to never reject updates
+    main.recent_update_ids = webhook.RecentUpdateIds(main.RECENT_UPDATE_IDS)
+
+    start = time.perf_counter()
+    for update in updates:
+        response = client.post("/webhook", json=update, headers=headers)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<24} {len(updates) / elapsed:>10.0f} req/s  (last status {response.status_code})")
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    headers = {"X-Telegram-Bot-Api-Secret-Token": os.environ['WEBHOOK_SECRET']}
+
+    print(f"JSON decoder: {webhook.loads.__module__}, {n} requests per scenario\n")
+
+    client = TestClient(main.app) # Not used as a context manager, so the lifespan (and Telegram) is skipped
+    run(client, "callback queries", [callback_update(i) for i in range(n)], headers)
+    run(client, "duplicate updates", [callback_update(0)] * n, headers)
+    run(client, "unhandled updates", [unhandled_update(i) for i in range(n)], headers)
+    run(client, "wrong secret token", [callback_update(i) for i in range(n)], {})
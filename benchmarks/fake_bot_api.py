@@ -0,0 +1,160 @@
+"""
+Fake Telegram Bot API server for RSNBusBot
+
+Stands in for api.telegram.org, so that the bot can be load tested without sending anything to Telegram.
+Implements the methods used by the bot, with configurable latency and rate limiting (429) responses.
+Every group chat is a supergroup administered by user 1, and every other chat is a private chat.
+
+Usage (from the repository root):
+    python benchmarks/fake_bot_api.py [--port 8081] [--latency 0.05] [--jitter 0.02] [--rate-limited 0.01] [--retry-after 1]
+
+Then start the bot against it:
+    BOT_API_URL=http://127.0.0.1:8081 uvicorn main:app --port 8000
+
+GET /stats returns the number of calls to each method, and how many of them were rate limited.
+"""
+
+### IMPORTS
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from urllib.parse import parse_qsl
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+### CONFIGURATION
+config = {
+    "latency": 0.05, # mean seconds taken by each call
+    "jitter": 0.02, # max seconds added to or removed from the latency
+    "rate_limited": 0.0, # fraction of sendMessage / editMessageText / editMessageReplyMarkup calls answered with 429
+    "retry_after": 1, # seconds sent in 429 responses
+}
+
+ADMIN = {"id": 1, "is_bot": False, "first_name": "Admin", "username": "admin"}
+BOT = {"id": 123456, "is_bot": True, "first_name": "RSNBusBot", "username": "rsnbusbot"}
+
+### STATE
+message_ids = {} # next message_id of each chat
+webhook = {"url": ""}
+stats = {}
+
+def chat(chat_id):
+    """Groups have negative ids, like real Telegram chats."""
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+
+def message(chat_id, message_id, text):
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": chat(chat_id),
+        "from": BOT,
+        "text": text,
+    }
+
+### METHODS
+def send_message(params):
+    chat_id = int(params["chat_id"])
+    counter = message_ids.setdefault(chat_id, itertools.count(1))
+    return message(chat_id, next(counter), params.get("text", ""))
+
+def edit_message_text(params):
+    return message(int(params["chat_id"]), int(params["message_id"]), params.get("text", ""))
+
+def edit_message_reply_markup(params):
+    return message(int(params["chat_id"]), int(params["message_id"]), "")
+
+def get_chat(params):
+    return chat(int(params["chat_id"]))
+
+def get_chat_administrators(params):
+    return [{"status": "creator", "user": ADMIN, "is_anonymous": False}]
+
+def set_webhook(params):
+    webhook["url"] = params.get("url", "")
+    return True
+
+def get_webhook_info(params):
+    return {"url": webhook["url"], "has_custom_certificate": False, "pending_update_count": 0}
+
+METHODS = {
+    "getMe": lambda params: BOT,
+    "sendMessage": send_message,
+    "editMessageText": edit_message_text,
+    "editMessageReplyMarkup": edit_message_reply_markup,
+    "getChat": get_chat,
+    "getChatAdministrators": get_chat_administrators,
+    "setWebhook": set_webhook,
+    "getWebhookInfo": get_webhook_info,
+    "deleteWebhook": lambda params: True,
+    "answerCallbackQuery": lambda params: True,
+}
+RATE_LIMITED_METHODS = ["sendMessage", "editMessageText", "editMessageReplyMarkup"]
+
+### SERVER
+app = FastAPI()
+
+@app.post("/bot{token}/{method}")
+async def api(token: str, method: str, request: Request):
+    """
+    Answers a Bot API call, after waiting for the configured latency.
+    PTB sends parameters as url encoded form fields (multipart when uploading files), other clients may send JSON.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        params = await request.json()
+    elif content_type.startswith("multipart/form-data"):
+        params = dict(await request.form()) # Needs python-multipart
+    else:
+        params = dict(parse_qsl((await request.body()).decode()))
+
+    method_stats = stats.setdefault(method, {"calls": 0, "rate_limited": 0})
+    method_stats["calls"] += 1
+
+    latency = config["latency"] + random.uniform(-config["jitter"], config["jitter"])
+    await asyncio.sleep(max(0, latency))
+
+    if method not in METHODS:
+        return JSONResponse({"ok": False, "error_code": 404, "description": "Not Found: method not found"},
+                            status_code=404)
+
+    if method in RATE_LIMITED_METHODS and random.random() < config["rate_limited"]:
+        method_stats["rate_limited"] += 1
+        return JSONResponse({"ok": False,
+                             "error_code": 429,
+                             "description": f"Too Many Requests: retry after {config['retry_after']}",
+                             "parameters": {"retry_after": config["retry_after"]}},
+                            status_code=429)
+
+    return {"ok": True, "result": METHODS[method](params)}
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+@app.delete("/stats")
+async def reset_stats():
+    stats.clear()
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=config["latency"], help="mean seconds taken by each call")
+    parser.add_argument("--jitter", type=float, default=config["jitter"], help="max seconds added to or removed from the latency")
+    parser.add_argument("--rate-limited", type=float, default=config["rate_limited"],
+                        help="fraction of sendMessage / editMessageText calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=config["retry_after"], help="seconds sent in 429 responses")
+    args = parser.parse_args()
+
+    config.update(latency=args.latency,
+                  jitter=args.jitter,
+                  rate_limited=args.rate_limited,
+                  retry_after=args.retry_after)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
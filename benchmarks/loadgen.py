@@ -0,0 +1,235 @@
+"""
+Load generator for RSNBusBot
+
+Posts synthetic Book / Cancel callback queries across many chats to the webhook of a running bot,
+then reports webhook throughput and latency, and how quickly the updates were processed.
+Run the bot against the fake Bot API server (see fake_bot_api.py), never against Telegram.
+
+Open registrations are seeded directly into the bot's database, so DB_FILEPATH must be the same as the bot's.
+Processing is measured from the bot's /metrics, so the bot should run as a single worker.
+
+Usage (from the repository root):
+    python benchmarks/fake_bot_api.py &
+    BOT_API_URL=http://127.0.0.1:8081 uvicorn main:app --port 8000 &
+    python benchmarks/loadgen.py [--url http://127.0.0.1:8000] [--chats 50] [--users 200] [--updates 5000] [--concurrency 50]
+"""
+
+### IMPORTS
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIRST_CHAT_ID = -1001000000000 # Chats used by the load generator are counted down from here
+MESSAGE_ID = 1000000 # message_id of the seeded registration in every chat
+
+### SEEDING
+def seed(registrations, max_riders):
+    """
+    Opens a registration for every (chat_id, message_id), replacing any left over from previous runs in those chats.
+    """
+    from setup import setup_db
+    from db import connect
+
+    setup_db()
+
+    con = connect()
+    cur = con.cursor()
+
+    for chat_id in set(chat_id for chat_id, _ in registrations):
+        cur.execute("DELETE FROM riders WHERE book_id IN (SELECT book_id FROM registrations WHERE chat_id=?)", (chat_id,))
+        cur.execute("DELETE FROM turned_away WHERE book_id IN (SELECT book_id FROM registrations WHERE chat_id=?)", (chat_id,))
+        cur.execute("DELETE FROM registrations WHERE chat_id=?", (chat_id,))
+        cur.execute("INSERT OR REPLACE INTO settings VALUES (?, 'Service', ?, 'Camp', 'MRT')", (chat_id, max_riders))
+
+    for chat_id, message_id in registrations:
+        res = cur.execute("INSERT INTO ridership (chat_id, date, time, riders) VALUES (?, 'load test', '0000', 0)", (chat_id,))
+        cur.execute("INSERT INTO registrations (book_id, chat_id, message_id, bus_id, date, time) \
+                    VALUES (?, ?, ?, NULL, 'load test', '0000')", (res.lastrowid, chat_id, message_id))
+    con.commit()
+
+    con.close()
+
+### UPDATES
+def callback_update(update_id, chat_id, user_id, data):
+    """Book / Cancel button clicked on the seeded registration."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Rider", "username": f"rider{user_id}"},
+            "message": {
+                "message_id": MESSAGE_ID,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+                "text": "Booking ID: 0",
+            },
+            "chat_instance": str(chat_id),
+            "data": data,
+        },
+    }
+
+def generate(n, chat_ids, users):
+    """Mostly bookings, with some cancellations. update_ids are new on every run, so none are dropped as duplicates."""
+    first_update_id = int(time.time() * 1000)
+    return [callback_update(first_update_id + i,
+                            random.choice(chat_ids),
+                            random.randint(10, 10 + users),
+                            "book" if random.random() < 0.8 else "cancel")
+            for i in range(n)]
+
+### METRICS
+def parse_metrics(text):
+    """Returns {sample: value} from the Prometheus text format."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples
+
+async def get_metrics(client, url):
+    response = await client.get(f"{url}/metrics")
+    return parse_metrics(response.text)
+
+def histogram_percentile(before, after, name, labels, q):
+    """
+    Estimates a percentile from the change in a histogram's buckets, as the upper bound of the bucket it falls in.
+    """
+    buckets = []
+    for sample, value in after.items():
+        if sample.startswith(f"{name}_bucket{{{labels},le="):
+            le = sample.split('le="')[1].rstrip('"}')
+            buckets.append((float(le), value - before.get(sample, 0)))
+    buckets.sort()
+    if not buckets or buckets[-1][1] == 0:
+        return None
+
+    for le, count in buckets:
+        if count >= q * buckets[-1][1]:
+            return le
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+### LOAD
+async def wait_ready(client, url, timeout=60):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            if (await client.get(f"{url}/readyz")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Bot at {url} did not become ready within {timeout}s")
+
+async def post_all(client, url, updates, concurrency, headers):
+    """
+    Posts every update with at most concurrency requests in flight.
+    Returns the latency and status of each request.
+    """
+    results = []
+    pending = iter(updates)
+
+    async def sender():
+        for update in pending:
+            start = time.perf_counter()
+            response = await client.post(f"{url}/webhook", json=update, headers=headers)
+            results.append((time.perf_counter() - start, response.status_code))
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return results
+
+async def measure(url, bot_api_url, send, timeout):
+    """
+    Waits for the bot to be ready, sends updates with send(client, headers), then waits for them to be processed.
+    Prints webhook latency, processing throughput, handler latencies and Bot API calls.
+    """
+    headers = {}
+    if os.environ.get("WEBHOOK_SECRET"):
+        headers["X-Telegram-Bot-Api-Secret-Token"] = os.environ["WEBHOOK_SECRET"]
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=None), timeout=30) as client:
+        await wait_ready(client, url)
+        if bot_api_url:
+            await client.delete(f"{bot_api_url}/stats")
+        before = await get_metrics(client, url)
+
+        # Send updates
+        start = time.perf_counter()
+        results = await send(client, headers)
+        sent = time.perf_counter() - start
+
+        # Wait for the bot to process every accepted update, except those dropped as duplicates or unhandled
+        def handled(metrics):
+            return sum(metrics.get(name, 0) for name in ("updates_processed_total", "updates_duplicate_total", "updates_ignored_total"))
+
+        accepted = sum(1 for _, status in results if status == 200)
+        target = handled(before) + accepted
+        while True:
+            after = await get_metrics(client, url)
+            if handled(after) >= target or time.perf_counter() - start > timeout:
+                break
+            await asyncio.sleep(0.1)
+        processed_time = time.perf_counter() - start
+        processed = after.get("updates_processed_total", 0) - before.get("updates_processed_total", 0)
+        accepted -= int(handled(after) - handled(before) - processed) # Only updates which were not dropped
+
+        api_stats = (await client.get(f"{bot_api_url}/stats")).json() if bot_api_url else {}
+
+    # Report
+    latencies = sorted(latency for latency, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"Webhook:    {len(results) / sent:>8.0f} req/s     "
+          f"p50 {percentile(latencies, 50) * 1000:.1f}ms  p99 {percentile(latencies, 99) * 1000:.1f}ms  "
+          f"statuses {statuses}")
+    print(f"Processing: {processed / processed_time:>8.0f} updates/s "
+          f"({processed:.0f} of {accepted} processed in {processed_time:.1f}s)")
+
+    handlers = sorted(set(sample.split('"')[1] for sample in after 
+                          if sample.startswith("handler_duration_seconds_count{")))
+    for handler in handlers:
+        labels = f'handler="{handler}"'
+        p50 = histogram_percentile(before, after, "handler_duration_seconds", labels, 0.5)
+        p99 = histogram_percentile(before, after, "handler_duration_seconds", labels, 0.99)
+        if p50 is not None:
+            print(f"Handler:    {handler:<24} p50 <= {p50 * 1000:.0f}ms  p99 <= {p99 * 1000:.0f}ms (histogram buckets)")
+
+    for method, method_stats in sorted(api_stats.items()):
+        print(f"Bot API:    {method:<24} {method_stats['calls']:>6} calls  {method_stats['rate_limited']:>4} rate limited")
+
+async def main(args):
+    chat_ids = [FIRST_CHAT_ID - i for i in range(args.chats)]
+    seed([(chat_id, MESSAGE_ID) for chat_id in chat_ids], args.max_riders)
+    updates = generate(args.updates, chat_ids, args.users)
+
+    print(f"{len(updates)} updates across {len(chat_ids)} chats, {args.concurrency} concurrent requests")
+    await measure(args.url, 
+                  args.bot_api_url, 
+                  lambda client, headers: post_all(client, args.url, updates, args.concurrency, headers), 
+                  args.timeout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the RSNBusBot webhook")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of the bot")
+    parser.add_argument("--bot-api-url", default="http://127.0.0.1:8081", help="base URL of the fake Bot API server, empty to skip its stats")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200, help="distinct users clicking across all chats")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50, help="max requests in flight")
+    parser.add_argument("--max-riders", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=120, help="max seconds to wait for updates to be processed")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
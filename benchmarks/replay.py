@@ -0,0 +1,112 @@
+"""
+Replays recorded webhook traffic against RSNBusBot
+
+Webhook requests are recorded by starting the bot with UPDATE_LOG set to a .jsonl.gz path.
+This posts the recorded request bodies to the webhook of a running bot, keeping the gaps between them (divided by --speed),
+then reports the same measurements as loadgen.py, so that changes can be compared against real traffic shapes.
+Redelivered and ignored updates are recorded too, so they are replayed and dropped as they were originally.
+Run the bot against the fake Bot API server (see fake_bot_api.py), never against Telegram.
+
+Open registrations are seeded for every registration message clicked in the log,
+so DB_FILEPATH must be the same as the bot's.
+
+Usage (from the repository root):
+    python benchmarks/replay.py updates.jsonl.gz [--url http://127.0.0.1:8000] [--speed 1]
+"""
+
+### IMPORTS
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+
+from loadgen import seed, measure # Ensure loadgen.py in same directory
+from webhook import UPDATE_ID_PATTERN # Ensure webhook.py in repository root
+
+### LOG
+def read_log(path):
+    """
+    Returns the recorded (timestamp, request body) pairs, oldest first.
+    Logs recorded before request bodies were recorded hold decoded updates, which are encoded again.
+    """
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if "body" in record:
+                    records.append((record["t"], record["body"].encode()))
+                else:
+                    records.append((record["t"], json.dumps(record["update"]).encode()))
+    records.sort(key=lambda record: record[0])
+    return records
+
+def registrations(records):
+    """Finds the (chat_id, message_id) of every registration message clicked in the log."""
+    clicked = set()
+    for _, body in records:
+        try:
+            message = json.loads(body)["callback_query"]["message"]
+            clicked.add((message["chat"]["id"], message["message_id"]))
+        except (ValueError, TypeError, KeyError): # Invalid bodies and other updates
+            pass
+    return sorted(clicked)
+
+### REPLAY
+async def replay(client, url, records, speed, concurrency, headers):
+    """
+    Posts every request body at its recorded offset from the first one, divided by speed (0 for as fast as possible),
+    with at most concurrency requests in flight.
+    update_ids are shifted by the same amount, so that the bot does not drop them as received in an earlier replay,
+    while updates redelivered in the log are still dropped as duplicates.
+    Returns the latency and status of each request.
+    """
+    results = []
+    shift = int(time.time() * 1000)
+    first = records[0][0]
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(t, body):
+        if speed > 0:
+            await asyncio.sleep(max(0, start + (t - first) / speed - time.perf_counter()))
+
+        body = UPDATE_ID_PATTERN.sub(lambda match: b'"update_id": %d' % (int(match.group(1)) + shift), body, count=1)
+        async with semaphore:
+            sent = time.perf_counter()
+            response = await client.post(f"{url}/webhook", content=body, 
+                                         headers={**headers, "Content-Type": "application/json"})
+            results.append((time.perf_counter() - sent, response.status_code))
+
+    await asyncio.gather(*(post(t, body) for t, body in records))
+    return results
+
+async def main(args):
+    records = read_log(args.log)
+    if not records:
+        sys.exit(f"No updates recorded in {args.log}")
+
+    seed(registrations(records), args.max_riders)
+
+    duration = records[-1][0] - records[0][0]
+    print(f"{len(records)} updates recorded over {duration:.0f}s, replayed at "
+          f"{'full speed' if args.speed == 0 else f'{args.speed}x'}")
+    await measure(args.url,
+                  args.bot_api_url,
+                  lambda client, headers: replay(client, args.url, records, args.speed, args.concurrency, headers),
+                  args.timeout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the RSNBusBot webhook")
+    parser.add_argument("log", help="request log recorded with UPDATE_LOG")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of the bot")
+    parser.add_argument("--bot-api-url", default="http://127.0.0.1:8081", help="base URL of the fake Bot API server, empty to skip its stats")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed, e.g. 10 for 10x faster, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=100, help="max requests in flight")
+    parser.add_argument("--max-riders", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=600, help="max seconds to wait for updates to be processed")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -4,6 +4,80 @@ Constants for RSNBusBot
 
 ### DEFAULT SETTINGS
 DEFAULT_MAX_RIDERS = 40
+DEFAULT_OPEN_TIME = "1730" # registration for the next day opens
+DEFAULT_CLOSE_TIME = "2359" # registration for the next day closes
+
+### OUTBOX
+OUTBOX_WORKERS = 4 # number of workers delivering messages
+OUTBOX_RATE = 25 # max messages per second across all chats
+OUTBOX_CHAT_INTERVAL = 1 # min seconds between messages to the same private chat
+OUTBOX_GROUP_CHAT_INTERVAL = 3 # min seconds between messages to the same group chat, Telegram allows about 20 a minute
+OUTBOX_MAX_ATTEMPTS = 8 # attempts before a message is marked as failed
+OUTBOX_FAILED_RETENTION = 7 * 24 * 60 * 60 # seconds failed messages are kept in the outbox, for inspection
+OUTBOX_BACKOFF_BASE = 1 # seconds before the first retry, doubled on every attempt
+OUTBOX_BACKOFF_MAX = 300 # max seconds between retries
+OUTBOX_LEASE = 60 # seconds before a message claimed by a dead worker is retried
+OUTBOX_POLL_INTERVAL = 1 # seconds between checks for retries when idle
+OUTBOX_SEND_NOW_WAIT = 10 # max seconds a message sent without queueing waits for earlier messages to the chat
+OUTBOX_SEND_NOW_ATTEMPTS = 3 # attempts before a message sent without queueing is given up on
+MESSAGE_LENGTH = 4096 # max characters of a message, longer messages are rejected by Telegram
+
+### WEBHOOK
+UPDATE_QUEUE_SIZE = 1000 # max updates waiting to be processed, further updates are rejected for Telegram to retry
+UPDATE_QUEUE_DRAIN_TIMEOUT = 10 # seconds to finish processing queued updates on shutdown
+RECENT_UPDATE_IDS = 1000 # number of update_ids remembered to drop redelivered updates
+UPDATE_LOG_FLUSH_INTERVAL = 100 # updates recorded between flushes of the update log
+
+### HEALTH CHECKS
+HEALTH_CACHE_SECONDS = 5 # seconds health check results are reused for
+HEALTH_MAX_UPDATE_SECONDS = 60 # max seconds processing a single update may take
+HEALTH_MAX_UPDATE_QUEUE = 500 # max updates waiting to be processed
+HEALTH_MAX_OUTBOX_AGE = 300 # max seconds a message may wait in the outbox
+HEALTH_MAX_JOB_DELAY = 60 # max seconds a job may be overdue
+
+### WORKERS
+JOB_LOCK_TTL = 60 # seconds before the job lock held by a dead worker is taken over
+JOB_LOCK_RENEW_INTERVAL = 20 # seconds between renewals of the job lock
+REGISTRATION_CHECK_INTERVAL = 15 # seconds between checks for registrations to open / close
+REGISTRATION_CATCH_UP = 120 # seconds back that registration events missed, e.g. while restarting, are still run
+
+### RECOMMENDATIONS
+RECOMMENDATIONS_TIME = "0300" # recommendations are updated daily
+RECOMMENDATIONS_WEEKS = 8 # weeks of ridership recommendations are based on
+RECOMMENDATIONS_MIN_DAYS = 10 # min days of ridership for a bus before recommending changes to it
+RECOMMENDATIONS_PERCENTILE = 90 # percentile of demand per bus which max riders should cover
+RECOMMENDATIONS_MIN_CHANGE = 0.1 # min relative change of max riders worth recommending
+RECOMMENDATIONS_FULL_DAYS = 0.5 # min share of days a bus is full, with riders turned away, before recommending an extra bus
+RECOMMENDATIONS_EXTRA_BUS_GAP = 15 # minutes after a full bus to recommend an extra bus at
+RECOMMENDATIONS_MIN_FILL = 0.1 # fill rate below which a bus is recommended for removal
+
+### RETENTION
+RIDERSHIP_RETENTION_MONTHS = 12 # full months of ridership kept before it is moved to the archive
+RIDERSHIP_COMPACTION_TIME = "0330" # ridership is archived daily
+RIDERSHIP_COMPACTION_BATCH_SIZE = 500 # rows archived in each transaction
+RIDERSHIP_COMPACTION_PAUSE = 0.1 # seconds between batches, so that other writers are not held up
+
+### CHARTS
+CHART_DAYS = 90 # days of ridership charted if no date range is given
+CHART_CACHE_SIZE = 32 # rendered charts kept in memory by each worker process
+HEATMAP_COLUMNS = 12 # bus times in each table of the /analytics heatmap, wider heatmaps are split into several tables
+RESULT_CACHE_SIZE = 64 # results of each summary kept in memory by each worker process, until the data changes
+
+### CHAT PICKER
+CHAT_PICKER_PAGE_SIZE = 8 # service chats shown on each page of the chat picker in /settings
+
+### QUERY CONSOLE
+QUERY_TIMEOUT = 5 # seconds before a query from /edit_db is interrupted
+QUERY_PROGRESS_STEPS = 10000 # SQLite instructions between checks of the query timeout
+QUERY_PAGE_SIZE = 20 # rows shown on each page of query results
+QUERY_CELL_WIDTH = 20 # characters shown of each value in query results
+
+### SCHEDULE IMPORT
+IMPORT_MAX_FILE_SIZE = 1024 * 1024 # bytes of CSV files accepted by /import_schedule
+IMPORT_MAX_ERRORS = 10 # invalid entries listed when an import is rejected
+
+### EXPORT
+EXPORT_CHUNK_SIZE = 1000 # rows fetched from the database at a time when exporting
 
 
 ### MESSAGES
@@ -23,7 +97,13 @@ HELP_MSG = """Here are a list of currently available commands:
 /broadcast - Broadcast a custom message to all service chats.
 /notify_late - Send notification message to chat informing users that bus will be late.
 /notify_late_all - Broadcast notification message to all service chats informing users that buses will be late.
-/view_data_summary - Send message summarizing ridership statistics across all services.
+/bulk_settings - Apply the same settings and bus timings to many service chats at once.
+/import_schedule - Book / cancel many buses for many dates at once, from a message or a CSV file.
+/view_data_summary - Send message summarizing ridership statistics across all services. Optionally, for a date range, e.g. /view_data_summary 010124-310324.
+/analytics - Send fill rates, days at capacity and a day x bus time heatmap across all services. Optionally, for a date range.
+/backfill_ridership - Rebuild the daily ridership statistics from all past registrations.
+/chart - Send a chart of daily riders of a service, e.g. /chart <chat ID> 010124-310324.
+/export - Export ridership or schedule data as a CSV file, e.g. /export ridership 010124-310324 <chat ID>.
 /cancel - Cancels any conversation.
 """
 USER_HELP_MSG = """There are currently no commands available for riders."""
@@ -34,7 +114,22 @@ Max Riders
 Pickup Location
 Destination
 Chat Type
-Buses"""
+Buses
+Recommendations"""
+SETTINGS_CHAT_MSG = """Please select a chat to edit, or send part of its pickup or destination to search."""
+NO_CHATS_FOUND_MSG = """No chats found, please search again."""
+BULK_SETTINGS_MSG = """Please send the chat IDs of the service chats to change (one per line), part of their pickup or destination, or "all" for all service chats."""
+BULK_TEMPLATE_MSG = """Please send the settings to apply in this format, leaving out any settings to keep. E.g.,
+
+Max Riders: 40
+Pickup Location: Camp
+Destination: MRT
+Buses:
+0630
+0645 1200-2200
+
+Bus timings replace all bus timings of each chat, and must come last."""
+INVALID_BULK_TEMPLATE_MSG = """Invalid settings, nothing was changed. Please try again."""
 RIDER_SETTING_MSG = """Please enter a number for the max riders allowed per registration."""
 PICKUP_SETTING_MSG = """Please enter the pickup location."""
 DESTINATION_SETTING_MSG = """Please enter the destination."""
@@ -42,13 +137,18 @@ CHAT_SETTING_MSG = """Please enter the type of chat (Admin/Service)."""
 BUSES_SETTING_MSG = """Please send a list of bus timings in this format. E.g.,
 
 0630
-0645
+0645 1200-2200
 
+Registration for the next day's bus opens and closes at the optional times after each bus timing (1730-2359 if not given).
 A minimum of one bus timing must be sent."""
+INVALID_BUSES_MSG = """Please send the bus timings again, with registration opening and closing at different times."""
+RECOMMENDATIONS_SETTING_MSG = """Please enter the number of a recommendation to apply, or /cancel to stop editing."""
+NO_RECOMMENDATIONS_MSG = """There are no recommendations for this chat. Select another setting to continue editing, or /cancel to stop editing."""
 UPDATED_SETTINGS_MSG = """Settings updated! Select another setting to continue editing, or /cancel to stop editing."""
 
 MAX_RIDERS_NOTIF_MSG = """The maximum number of riders have been registered. Please find alternative means of transport, or check again later."""
 OPEN_SPACES_NOTIF_MSG = """New spaces have opened up for shuttle bus registration!"""
+TOKENS_MSG = """Your registrations for the following shuttle buses have been confirmed:"""
 
 MANAGE_MSG = "Enter booking ID of registration to edit: "
 MANAGE_FUNCTIONS_MSG = """Select a function to use, or /cancel to stop editing.
@@ -62,6 +162,7 @@ REOPEN_NOTIF_MSG = """Registration has been reopened by the admin."""
 END_NOTIF_MSG = """Registration has ended."""
 END_DAILY_NOTIF_MSG = """Registration has been ended for the day."""
 CANCEL_NOTIF_MSG = """Registration has been cancelled by the admin."""
+REGISTRATION_ENDED_MSG = """This registration has already ended."""
 OVERWRITE_FALSE_MSG = """Dear all, the bus service will not be running tomorrow. Thank you for your understanding."""
 
 VIEW_SCHEDULE_MSG = """Please enter bus ID of service schedule to view:"""
@@ -76,6 +177,14 @@ SCHEDULE_DATES_MSG = """Please send a list of date ranges in this format. E.g.,
 A minimum of one date or date range must be sent.
 Date ranges include start and end dates.
 """
+IMPORT_SCHEDULE_MSG = """Please send the schedule to import in this format, one bus and date or date range per line. E.g.,
+
+3 Cancel 010124
+4 Book 030124-050124
+
+Or send a CSV file with bus_id, status (Book/Cancel), start_date and end_date columns, like the one from /export schedule.
+Nothing is saved unless every line is valid."""
+IMPORT_FILE_TOO_LARGE_MSG = """The file is too large, please split it and try again."""
 UPDATED_SCHEDULE_MSG = """Schedule has been updated!"""
 INVALID_SCHEDULE_DATE_MSG = """Invalid schedule dates. Please try again."""
 
@@ -84,7 +193,18 @@ BROADCAST_CONFIRM_MSG = """Please confirm that this is the message you want to b
 BROADCAST_SENT_MSG = """Message has been broadcasted!"""
 NOTIFY_LATE_MSG = """Dear all, the bus will be late. Please inform your respective units of the delay and to seek their understanding. Thank you"""
 
-EDIT_DB_MSG = """Please enter the command to execute:"""
+DATA_SUMMARY_USAGE_MSG = """Please send the date range in this format, e.g. /view_data_summary 010124-310324"""
+NO_DATA_MSG = """There is no ridership data for this period."""
+ANALYTICS_USAGE_MSG = """Please send the date range in this format, e.g. /analytics 010124-310324"""
+CHART_USAGE_MSG = """Please send the chart in this format: /chart <chat ID> [date range]
+E.g., /chart -1001234567890 010124-310324"""
+EXPORT_USAGE_MSG = """Please send the export in this format: /export ridership|schedule [date range] [chat ID]
+E.g., /export ridership 010124-310324 -1001234567890"""
+
+EDIT_DB_MSG = """Please enter the query to run. The database is read-only, use /edit_db write to change it."""
+EDIT_DB_WRITE_MSG = """Please enter the command to execute. Changes are saved immediately."""
+QUERY_TIMEOUT_MSG = f"""Query interrupted after {QUERY_TIMEOUT} seconds."""
+QUERY_EXPIRED_MSG = """These results have expired, please run the query again with /edit_db."""
 
 CONVERSATION_ENTER_PASSWORD_MSG = """Please enter the bot password:"""
 CONVERSATION_INVALID_PASSWORD_MSG = """Invalid password, conversation exited."""
@@ -0,0 +1,124 @@
+"""
+Database connections for RSNBusBot
+"""
+
+### IMPORTS
+import sqlite3
+
+import os
+import time
+from datetime import datetime
+from functools import lru_cache, wraps
+
+from metrics import Counter, Histogram # Ensure metrics.py in same directory
+
+DB_FILEPATH = os.environ['DB_FILEPATH']
+
+### METRICS
+DB_QUERIES = Counter("db_queries_total", "Database queries executed", ["operation"])
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Time taken to execute database queries", ["operation"])
+
+def _observe(sql, duration):
+    words = sql.split(None, 1)
+    operation = words[0].upper() if words else ""
+    DB_QUERIES.inc(operation=operation)
+    DB_QUERY_DURATION.observe(duration, operation=operation)
+
+### SQL FUNCTIONS
+@lru_cache(maxsize=4096)
+def iso_date(date):
+    """
+    Converts dates as stored by the bot ("%d %b %y" in ridership, "%d%m%y" in schedule) to YYYY-MM-DD,
+    which can be compared and used with SQLite's date functions. Returns NULL for anything else.
+    """
+    for fmt in ("%d %b %y", "%d%m%y"):
+        try:
+            return datetime.strptime(date, fmt).strftime("%Y-%m-%d")
+        except (TypeError, ValueError):
+            pass
+    return None
+
+### CONNECTIONS
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor which records metrics for every query executed.
+    """
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            _observe(sql, time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection which creates TimedCursors.
+    """
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def connect():
+    """
+    Connects to the bot database.
+    """
+    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db", factory=TimedConnection)
+    con.create_function("iso_date", 1, iso_date, deterministic=True)
+    return con
+
+### DATA VERSION
+def get_data_version(cur):
+    """
+    Returns the version of the ridership, schedule and settings data, which results computed from it can be cached by.
+    """
+    res = cur.execute("SELECT value FROM meta WHERE key='data_version'")
+    data = res.fetchone()
+    return int(data[0]) if data else 0
+
+def bump_data_version(cur):
+    """
+    Invalidates results cached by get_data_version.
+    Must be called in the transaction which changes the data, so that no result is cached against the new version 
+    before the change is visible.
+    """
+    cur.execute("INSERT INTO meta VALUES ('data_version', '1') \
+                ON CONFLICT (key) DO UPDATE SET value=CAST(value AS INTEGER) + 1")
+
+def versioned(maxsize=128):
+    """
+    Decorator caching the results of a function by its arguments, until the data version changes.
+    The version is read before calling the function, so a change committed while it runs only causes an extra call.
+    Each worker process has its own cache, holding the results of at most maxsize arguments.
+    """
+    def decorator(func):
+        cache = {} # arguments: (data version, result), oldest first
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            con = connect()
+            data_version = get_data_version(con.cursor())
+            con.close()
+
+            key = (args, tuple(sorted(kwargs.items())))
+            if key in cache and cache[key][0] == data_version:
+                return cache[key][1]
+
+            result = func(*args, **kwargs)
+            cache.pop(key, None)
+            if len(cache) >= maxsize:
+                del cache[next(iter(cache))]
+            cache[key] = (data_version, result)
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -12,25 +12,188 @@ from telegram import (
     ReplyKeyboardRemove
 )
 from telegram.ext import (
+    CallbackQueryHandler,
     CommandHandler, 
     ConversationHandler, 
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters
 )
-
-import sqlite3
+from telegram.warnings import PTBUserWarning
 
 import os
+import re
+import csv
+import time
+import socket
+import asyncio
+import tempfile
+import warnings
+from html import escape
 from datetime import datetime, timedelta
-from functools import wraps, reduce
+from functools import wraps
+import pytz
 
 from constants import * # Ensure constants.py in same directory
+from db import connect, iso_date, get_data_version, bump_data_version, versioned # Ensure db.py in same directory
+from metrics import Histogram, timer # Ensure metrics.py in same directory
+from outbox import queue_message, queue_edit, queue_remove_buttons, discard_pending, send_now, split_message # Ensure outbox.py in same directory
+from analytics import analytics_report, recommend, ridership_chart # Ensure analytics.py in same directory
 
-DB_FILEPATH = os.environ['DB_FILEPATH']
 PASSWORD = os.environ['PASSWORD']
+TIMEZONE = os.environ['TIMEZONE']
+
+HANDLER_DURATION = Histogram("handler_duration_seconds", "Time taken by handlers and jobs", ["handler"])
+timed = timer(HANDLER_DURATION, "handler") # Decorator to record how long a handler takes
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}" # Identifies this process when running multiple workers
 
 ### HELPER FUNCTIONS
+def get_meta(key):
+    """
+    Helper function to get internal state of the bot from the meta table.
+    Returns None if the key has not been set.
+    """
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT value FROM meta WHERE key=?", (key,))
+    data = res.fetchone()
+
+    con.close()
+    return None if data is None else data[0]
+
+def set_meta(key, value):
+    """
+    Helper function to save internal state of the bot to the meta table.
+    """
+    con = connect()
+    cur = con.cursor()
+
+    cur.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+    con.commit()
+
+    con.close()
+
+def delete_meta(key):
+    """
+    Helper function to remove internal state of the bot from the meta table.
+    """
+    con = connect()
+    cur = con.cursor()
+
+    cur.execute("DELETE FROM meta WHERE key=?", (key,))
+    con.commit()
+
+    con.close()
+
+def acquire_lock(name, ttl):
+    """
+    Helper function to acquire (or renew) a lock shared by all worker processes.
+    The lock expires after ttl seconds unless renewed, so a lock held by a dead process is taken over.
+    Returns True if this process holds the lock.
+    """
+    now = time.time()
+
+    con = connect()
+    cur = con.cursor()
+
+    cur.execute("INSERT INTO locks VALUES (?, ?, ?) \
+                ON CONFLICT (name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires \
+                WHERE locks.owner=excluded.owner OR locks.expires<?",
+                (name, WORKER_ID, now + ttl, now))
+    con.commit()
+
+    res = cur.execute("SELECT owner FROM locks WHERE name=?", (name,))
+    owner = res.fetchone()[0]
+
+    con.close()
+    return owner == WORKER_ID
+
+def is_job_leader():
+    """
+    Helper function to check if this process runs the scheduled jobs.
+    Every worker process schedules the jobs, but only the holder of the job lock runs them.
+    """
+    return acquire_lock("jobs", JOB_LOCK_TTL)
+
+async def renew_job_lock(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Keeps the job lock held by this process, or takes it over from a process which died.
+    """
+    is_job_leader()
+
+def get_registrations(cur, condition):
+    """
+    Helper function to get open registrations, and the riders registered for them.
+    condition is an SQL condition on the registrations table (r).
+    """
+    res = cur.execute(f"SELECT r.book_id, r.chat_id, r.message_id, r.bus_id, r.date, r.time, r.closed, \
+                      s.pickup, s.destination, s.max_riders, \
+                      (SELECT COUNT(*) FROM turned_away t WHERE t.book_id=r.book_id) \
+                      FROM registrations r JOIN settings s ON r.chat_id=s.chat_id \
+                      WHERE {condition} ORDER BY r.book_id")
+    registrations = {}
+    for i in res.fetchall():
+        registrations[i[0]] = {
+            "book_id": i[0],
+            "chat_id": i[1],
+            "message_id": i[2],
+            "bus_id": i[3],
+            "date": i[4],
+            "time": i[5],
+            "closed": i[6],
+            "pickup": i[7],
+            "destination": i[8],
+            "max_riders": i[9],
+            "turned_away": i[10],
+            "users": []
+        }
+
+    if registrations:
+        res = cur.execute(f"SELECT book_id, user_id, username FROM riders \
+                          WHERE book_id IN ({', '.join(map(str, registrations))}) \
+                          ORDER BY booked_at")
+        for book_id, user_id, username in res.fetchall():
+            registrations[book_id]["users"].append({"username": username, "id": user_id})
+
+    return list(registrations.values())
+
+def add_to_rollup(cur, registrations):
+    """
+    Helper function to add ended registrations to the ridership_daily rollup.
+    Must be called in the transaction which saves their ridership, so that the rollup always matches it.
+    Rows changed are marked with the time of the change, for update_recommendations.
+    """
+    now = time.time()
+    rows = [(registration["chat_id"], 
+             registration["time"], 
+             iso_date(registration["date"]), 
+             len(registration["users"]), 
+             registration["max_riders"],
+             registration["turned_away"],
+             now) for registration in registrations]
+    cur.executemany("INSERT INTO ridership_daily VALUES (?, ?, ?, ?, 1, ?, ?, ?) \
+                    ON CONFLICT (chat_id, time, date) DO UPDATE SET \
+                    riders=riders+excluded.riders, buses=buses+1, capacity=capacity+excluded.capacity, \
+                    turned_away=turned_away+excluded.turned_away, updated_at=excluded.updated_at",
+                    [row for row in rows if row[2] != None])
+    bump_data_version(cur)
+
+def get_registration(book_id):
+    """
+    Helper function to get an open registration by its book_id.
+    Returns None if there is no open registration with the book_id.
+    """
+    con = connect()
+    cur = con.cursor()
+
+    registrations = get_registrations(cur, f"r.book_id={book_id}")
+
+    con.close()
+    return registrations[0] if registrations else None
+
 async def get_chat_type(context, chat_id):
     """
     Helper function to get the chat type. 
@@ -41,7 +204,7 @@ async def get_chat_type(context, chat_id):
     if chat.title == None: # one-on-one
         return "user"
     else:
-        con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+        con = connect()
         cur = con.cursor()
 
         res = cur.execute(f"SELECT chat_type FROM settings \
@@ -97,14 +260,14 @@ async def password(update: Update, context: ContextTypes.DEFAULT_TYPE, state, te
 
     pw = update.message.text
     if pw != PASSWORD:
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = CONVERSATION_INVALID_PASSWORD_MSG
         )
 
         return ConversationHandler.END
 
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = text
     )
@@ -117,7 +280,7 @@ async def invalid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Invalid response catcher for all Conversation Handlers
     """
     chat_id = update.effective_chat.id
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = CONVERSATION_INVALID_MSG,
     )
@@ -132,7 +295,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = CONVERSATION_CANCEL_MSG,
         reply_markup=ReplyKeyboardRemove()
@@ -149,7 +312,7 @@ async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = CONVERSATION_TIMEOUT_MSG,
         reply_markup=ReplyKeyboardRemove()
@@ -159,11 +322,12 @@ async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clean_schedule(bus_ids = None):
     """
     Organise the schedule so that repeats are avoided.
+    The schedule of every bus in bus_ids (all buses if None) is rewritten in a single transaction.
     """
     print("Cleaning schedule...")
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Get all bus IDs
@@ -231,7 +395,6 @@ async def clean_schedule(bus_ids = None):
 
         # Update the table
         cur.execute(f"DELETE FROM schedule WHERE bus_id={bus_id}")
-        con.commit()
         
         today = datetime.now()
         for i in dates_sorted:
@@ -246,13 +409,16 @@ async def clean_schedule(bus_ids = None):
                             '{end}', \
                             {i[2]} \
                         )")
-            con.commit()
+
+    bump_data_version(cur) # Every change to the schedule is followed by cleaning it
+    con.commit()
         
     con.close()
 
 
 ### COMMANDS
 ## GENERAL / SETTINGS
+@timed
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     For Users:
@@ -261,7 +427,6 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     For Groups:
     Introduce the bot to users, and sets up data saving:
      - Database Configuration
-     - Setup Ephermeral Data (context.bot_data)
     """
     print("COMMAND: start")
 
@@ -271,7 +436,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = await context.bot.get_chat(chat_id)
     if chat.title == None:
         # Send introduction message
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = USER_START_MSG,
             reply_markup = ReplyKeyboardRemove() # Remove any unwanted keyboards on start
@@ -286,7 +451,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Add new row for chat into database if required
@@ -300,34 +465,19 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # New entry for settings
         cur.execute(f"INSERT INTO settings VALUES \
                     ({chat_id}, 'Service', {DEFAULT_MAX_RIDERS}, '', '')")
+        bump_data_version(cur) # New chat in summaries and the chat picker
         con.commit()
 
         # New entries for buses
-        res = cur.execute(f"SELECT MAX(bus_id) FROM buses")
-        bus_id = res.fetchone()[0]
-        if bus_id == None:
-            bus_id = -1
-        cur.execute(f"INSERT INTO buses VALUES \
-                    ({bus_id + 1}, {chat_id}, '0630'), \
-                    ({bus_id + 2}, {chat_id}, '0645')")
+        cur.execute(f"INSERT INTO buses (chat_id, time) VALUES \
+                    ({chat_id}, '0630'), \
+                    ({chat_id}, '0645')")
         con.commit()
 
     con.close()
 
-    # Setup automatic processes and chat_data
-    if chat_id not in context.bot_data.keys():
-        # Initialise the message data structure which the bot will be using.
-        payload = {
-            chat_id: {
-                "initialized": True,
-                "bookings": {},
-            }
-        }
-        context.bot_data.update(payload)
-        print(context.bot_data)
-
     # Send introduction message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = START_MSG,
         reply_markup = ReplyKeyboardRemove() # Remove any unwanted keyboards on start
@@ -335,33 +485,49 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # TODO: Setup constants conversation handler
 
+@timed
 @permissions_factory("service | admin")
 @restricted
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Soft reset the bot if anything happens to its temporary state, so that it can continue running the next cycle.
+    Open registrations of the chat are discarded, and their bookings are kept in the booking history as cancelled.
     """
     print("COMMAND: reset")
 
     chat_id = update.effective_chat.id
 
-    # Reset the chat data so nothing is inside
-    payload = {
-        chat_id: {
-            "initialized": True,
-            "bookings": {},
-        }
-    }
-    context.bot_data.update(payload)
-    print(context.bot_data)
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+
+    # Keep the discarded bookings in the booking history, as cancelled
+    cur.execute(f"INSERT INTO bookings \
+                SELECT r.book_id, r.user_id, r.username, iso_date(g.date), r.booked_at, {time.time()} \
+                FROM riders r JOIN registrations g ON r.book_id=g.book_id \
+                WHERE g.chat_id={chat_id} \
+                ON CONFLICT (book_id, user_id) DO UPDATE SET \
+                booked_at=excluded.booked_at, cancelled_at=excluded.cancelled_at")
+
+    # Discard open registrations
+    cur.execute(f"DELETE FROM riders WHERE book_id IN \
+                (SELECT book_id FROM registrations WHERE chat_id={chat_id})")
+    cur.execute(f"DELETE FROM turned_away WHERE book_id IN \
+                (SELECT book_id FROM registrations WHERE chat_id={chat_id})")
+    cur.execute(f"DELETE FROM registrations WHERE chat_id={chat_id}")
+    con.commit()
+
+    con.close()
 
     # Send notification message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = RESET_MSG
     )
 
 
+@timed
 @permissions_factory("user | service | admin")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -374,18 +540,19 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Message for Users
     chat = await context.bot.get_chat(chat_id)
     if chat.title == None:
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = USER_HELP_MSG,
         )
         return
 
     # Message for Groups
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = HELP_MSG
     )
 
+@timed
 @permissions_factory("admin | service")
 @restricted
 async def view_settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -397,7 +564,7 @@ async def view_settings_command(update: Update, context: ContextTypes.DEFAULT_TY
     chat_id = update.effective_chat.id
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Get database data
@@ -409,7 +576,7 @@ async def view_settings_command(update: Update, context: ContextTypes.DEFAULT_TY
         con.close()
         return
     
-    res = cur.execute(f"SELECT bus_id, time FROM buses WHERE chat_id={chat_id}")
+    res = cur.execute(f"SELECT bus_id, time, open_time, close_time FROM buses WHERE chat_id={chat_id}")
     bus_data = res.fetchall()
 
     con.close()
@@ -421,16 +588,18 @@ async def view_settings_command(update: Update, context: ContextTypes.DEFAULT_TY
         text = f"{text}\n{settings[i]}: {settings_data[i]}"
     text = f"{text}\n\nBuses:"
     for i in bus_data:
-        text = f"{text}\n - {i[0]}: {i[1]}H"
+        text = f"{text}\n - {i[0]}: {i[1]}H (registration {i[2]}H-{i[3]}H)"
     
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = text
     )
 
 CHAT_ID, SELECT, RIDERS, PICKUP, DESTINATION, CHAT, BUSES = range(0, 7) # states for settings conversation handler
+RECOMMENDATIONS = 15 # state for applying recommendations in settings conversation handler
 
+@timed
 @permissions_factory("admin | service")
 @restricted
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -442,7 +611,7 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Check chat type
@@ -456,70 +625,175 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(context.user_data)
 
         # Send message
-        buttons = [
-            [KeyboardButton("Max Riders"),
-            KeyboardButton("Pickup Location"),
-            KeyboardButton("Destination")],
-            [KeyboardButton("Chat Type"),
-            KeyboardButton("Buses")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
-        await context.bot.send_message(
-            chat_id = chat_id,
-            text = SETTINGS_MSG,
-            reply_markup = reply_markup
-        )
+        send_settings_menu(chat_id)
         
         return SELECT
     
     if chat_type == "Admin":
-        res = cur.execute("SELECT chat_id, pickup, destination FROM settings \
-                          WHERE chat_type='Service'")
-        chats = res.fetchall()
         con.close()
-        
-        text = "Please select a chat to edit:\n\n0: (current chat)"
-        chat_map = [chat_id]
-        for i, c in enumerate(chats, 1):
-            pickup, destination = c[1], c[2]
-            chat_map.append(c[0])
-            text = f"{text}\n{i}: {pickup} to {destination}"
-
-        context.user_data["chat_map"] = chat_map
-        print(context.user_data)
-        await context.bot.send_message(
-            chat_id = chat_id,
-            text = text
-        )
 
-        return CHAT_ID
-        
+        context.user_data["chat_search"] = ""
+        print(context.user_data)
 
-async def settings_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """If chat is admin chat, select service chat to edit settings for."""
-    chat_id = update.effective_chat.id
-    chat_map = context.user_data["chat_map"]
-    del context.user_data["chat_map"]
+        remove_chat_picker(update) # Left over from an earlier conversation
+        send_chat_picker(update, "")
 
-    selection = int(update.message.text)
-    target_chat_id = chat_map[selection]
-    context.user_data["target_chat_id"] = target_chat_id
-    print(context.user_data)
+        return CHAT_ID
 
-    # Send message
+def send_settings_menu(chat_id):
+    """Sends the settings to select from."""
     buttons = [
         [KeyboardButton("Max Riders"),
         KeyboardButton("Pickup Location"),
         KeyboardButton("Destination")],
         [KeyboardButton("Chat Type"),
-        KeyboardButton("Buses")]
+        KeyboardButton("Buses"),
+        KeyboardButton("Recommendations")]
     ]
     reply_markup = ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = SETTINGS_MSG,
         reply_markup = reply_markup
     )
+
+@versioned(maxsize=1)
+def chat_directory():
+    """
+    Helper function to get the chat_id, pickup and destination of every service chat, sorted by name.
+    Results are cached until the data version changes, which every change to settings bumps.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT chat_id, pickup, destination FROM settings \
+                      WHERE LOWER(chat_type)='service' ORDER BY LOWER(pickup), LOWER(destination), chat_id")
+    chats = res.fetchall()
+
+    con.close()
+    return chats
+
+def chat_picker(chat_id, search, page):
+    """
+    Helper function to render a page of service chats whose pickup or destination contain search,
+    as buttons to select the chat to edit. The admin chat itself is always the first option.
+    Returns the message and its buttons.
+    """
+    search = search.lower()
+    chats = [c for c in chat_directory() if search in c[1].lower() or search in c[2].lower()]
+    pages = max((len(chats) - 1) // CHAT_PICKER_PAGE_SIZE + 1, 1)
+    page = min(page, pages - 1)
+
+    buttons = [[InlineKeyboardButton("(current chat)", callback_data=f"settings_chat:{chat_id}")]]
+    for c in chats[page * CHAT_PICKER_PAGE_SIZE:(page + 1) * CHAT_PICKER_PAGE_SIZE]:
+        buttons.append([InlineKeyboardButton(f"{c[1]} to {c[2]}", callback_data=f"settings_chat:{c[0]}")])
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("Prev", callback_data=f"settings_page:{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("Next", callback_data=f"settings_page:{page + 1}"))
+    if navigation:
+        buttons.append(navigation)
+
+    text = SETTINGS_CHAT_MSG if chats else NO_CHATS_FOUND_MSG
+    if search:
+        text = f"{text}\n\nChats matching \"{search}\", page {page + 1} of {pages}."
+    else:
+        text = f"{text}\n\nPage {page + 1} of {pages}."
+    return text, InlineKeyboardMarkup(buttons)
+
+def chat_picker_record(update: Update):
+    """Helper function to get the meta key which the message_id of the user's chat picker is saved under."""
+    return f"chat_picker:{update.effective_chat.id}:{update.effective_user.id}"
+
+def send_chat_picker(update: Update, search):
+    """
+    Helper function to show the first page of the chat picker for search.
+    The picker already sent in the conversation is edited in place. Otherwise a new picker is queued, 
+    and its message_id is saved by the outbox once it is delivered.
+    """
+    chat_id = update.effective_chat.id
+    record = chat_picker_record(update)
+    text, reply_markup = chat_picker(chat_id, search, 0)
+
+    message_id = get_meta(record)
+    if message_id is not None:
+        queue_edit(
+            chat_id = chat_id,
+            message_id = int(message_id),
+            text = text,
+            reply_markup = reply_markup
+        )
+    else:
+        discard_pending(record) # Not delivered yet, so replaced by the new picker
+        queue_message(
+            chat_id = chat_id,
+            text = text,
+            reply_markup = reply_markup,
+            record = record
+        )
+
+def remove_chat_picker(update: Update):
+    """Helper function to remove the buttons of the chat picker, so that it cannot be used outside the conversation."""
+    record = chat_picker_record(update)
+    message_id = get_meta(record)
+    delete_meta(record)
+
+    if message_id is not None:
+        queue_remove_buttons(update.effective_chat.id, int(message_id))
+    else:
+        discard_pending(record) # Not delivered yet, so it is never sent
+
+async def settings_chat_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """If chat is admin chat, search for the service chat to edit settings for."""
+    search = update.message.text
+    context.user_data["chat_search"] = search
+    print(context.user_data)
+
+    send_chat_picker(update, search)
+
+async def settings_chat_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """If chat is admin chat, show another page of service chats."""
+    await update.callback_query.answer()
+    chat_id = update.effective_chat.id
+    message_id = update.callback_query.message.message_id
+
+    page = int(update.callback_query.data.split(":")[1])
+    text, reply_markup = chat_picker(chat_id, context.user_data.get("chat_search", ""), page)
+    queue_edit(
+        chat_id = chat_id,
+        message_id = message_id,
+        text = text,
+        reply_markup = reply_markup
+    )
+
+async def settings_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """If chat is admin chat, select service chat to edit settings for."""
+    await update.callback_query.answer()
+    chat_id = update.effective_chat.id
+    message_id = update.callback_query.message.message_id
+    context.user_data.pop("chat_search", None)
+    delete_meta(chat_picker_record(update)) # Buttons are removed by the edit below
+
+    target_chat_id = int(update.callback_query.data.split(":")[1])
+    context.user_data["target_chat_id"] = target_chat_id
+    print(context.user_data)
+
+    # Remove the chat picker
+    name = "(current chat)"
+    for c in chat_directory():
+        if c[0] == target_chat_id:
+            name = f"{c[1]} to {c[2]}"
+    queue_edit(
+        chat_id = chat_id,
+        message_id = message_id,
+        text = f"Editing settings for {name}."
+    )
+
+    # Send message
+    send_settings_menu(chat_id)
     
     return SELECT
     
@@ -532,19 +806,19 @@ async def settings_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selection = update.message.text
     match selection:
         case "Max Riders":
-            await context.bot.send_message(
+            queue_message(
                 chat_id = chat_id,
                 text = RIDER_SETTING_MSG,
             )
             return RIDERS
         case "Pickup Location":
-            await context.bot.send_message(
+            queue_message(
                 chat_id = chat_id,
                 text = PICKUP_SETTING_MSG,
             )
             return PICKUP
         case "Destination":
-            await context.bot.send_message(
+            queue_message(
                 chat_id = chat_id,
                 text = DESTINATION_SETTING_MSG,
             )
@@ -555,18 +829,20 @@ async def settings_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
                  KeyboardButton("Service")]
             ]
             reply_markup = ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
-            await context.bot.send_message(
+            queue_message(
                 chat_id = chat_id,
                 text = CONVERSATION_ENTER_PASSWORD_MSG,
                 reply_markup = reply_markup
             )
             return PW
         case "Buses":
-            await context.bot.send_message(
+            queue_message(
                 chat_id = chat_id,
                 text = BUSES_SETTING_MSG,
             )
             return BUSES
+        case "Recommendations":
+            return settings_recommendations(update, context)
         
 async def settings_update(update: Update, context: ContextTypes.DEFAULT_TYPE, setting, value):
     """
@@ -578,7 +854,7 @@ async def settings_update(update: Update, context: ContextTypes.DEFAULT_TYPE, se
     print(context.user_data)
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Update database
@@ -588,12 +864,15 @@ async def settings_update(update: Update, context: ContextTypes.DEFAULT_TYPE, se
     cur.execute(f"UPDATE settings SET \
                 {setting}={value} \
                 WHERE chat_id={target_chat_id}")
+    if setting == "max_riders": # Recommendation no longer applies
+        cur.execute(f"DELETE FROM recommendations WHERE chat_id={target_chat_id} AND kind='max_riders'")
+    bump_data_version(cur) # Summaries show the settings of each chat
     con.commit()
 
     con.close()
 
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = UPDATED_SETTINGS_MSG,
         reply_markup = ReplyKeyboardRemove()
@@ -626,68 +905,165 @@ async def settings_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Remove buses for admin chats
     if update.message.text == "Admin":
         # Connect to DB
-        con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+        con = connect()
         cur = con.cursor()
 
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(f"DELETE FROM schedule WHERE bus_id IN (SELECT bus_id FROM buses WHERE chat_id={target_chat_id})")
         cur.execute(f"DELETE FROM buses WHERE chat_id={target_chat_id}")
+        bump_data_version(cur)
         con.commit()
 
         con.close()
 
+        await end_removed_buses(context)
+
     return SELECT
 
+@timed
 async def settings_buses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Settings for bus timings"""
     chat_id = update.effective_chat.id
     target_chat_id = context.user_data["target_chat_id"]
 
+    try:
+        buses = parse_buses(update.message.text.split("\n"))
+    except ValueError as e:
+        queue_message(
+            chat_id = chat_id,
+            text = f"{e}. {INVALID_BUSES_MSG}"
+        )
+        return BUSES
+
+    # Update database
+    apply_settings([target_chat_id], {}, buses)
+
+    # End registrations of removed buses, new timings are picked up by registration_job
+    await end_removed_buses(context)
+
+    # Send message
+    queue_message(
+        chat_id = chat_id,
+        text = UPDATED_SETTINGS_MSG,
+        reply_markup = ReplyKeyboardRemove()
+    )
+
+    return SELECT
+
+def settings_recommendations(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends the capacity recommendations of the chat, updated daily by recommendations_job."""
+    chat_id = update.effective_chat.id
+    target_chat_id = context.user_data["target_chat_id"]
+
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
-    # Get data from database
-    res = cur.execute(f"SELECT time FROM buses WHERE chat_id = {target_chat_id}")
-    current_buses = res.fetchall()
-    current_buses = list(map(lambda x: x[0], current_buses))
+    res = cur.execute(f"SELECT kind, value, reason FROM recommendations \
+                      WHERE chat_id={target_chat_id} ORDER BY kind, value")
+    recommendations = res.fetchall()
+
+    con.close()
+
+    if not recommendations:
+        queue_message(
+            chat_id = chat_id,
+            text = NO_RECOMMENDATIONS_MSG,
+            reply_markup = ReplyKeyboardRemove()
+        )
+        return SELECT
+
+    context.user_data["recommendations"] = [(kind, value) for kind, value, _ in recommendations]
+    print(context.user_data)
+
+    text = "Recommendations based on recent demand:\n"
+    for i, (kind, value, reason) in enumerate(recommendations, 1):
+        match kind:
+            case "max_riders":
+                text = f"{text}\n{i}: Set max riders to {value}. {reason}."
+            case "add_bus":
+                text = f"{text}\n{i}: Add a bus at {value}. {reason}."
+            case "remove_bus":
+                text = f"{text}\n{i}: Remove the bus at {value}. {reason}."
+    text = f"{text}\n\n{RECOMMENDATIONS_SETTING_MSG}"
+
+    queue_message(
+        chat_id = chat_id,
+        text = text,
+        reply_markup = ReplyKeyboardRemove()
+    )
+    return RECOMMENDATIONS
+
+@timed
+async def settings_apply_recommendation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Applies the selected recommendation"""
+    chat_id = update.effective_chat.id
+    target_chat_id = context.user_data["target_chat_id"]
+    recommendations = context.user_data["recommendations"]
 
-    res = cur.execute(f"SELECT MAX(bus_id) FROM buses")
-    bus_id = res.fetchone()[0]
-    if bus_id == None:
-        bus_id = -1
+    selection = int(update.message.text)
+    if not 1 <= selection <= len(recommendations):
+        return await invalid(update, context)
+    kind, value = recommendations[selection - 1]
+    del context.user_data["recommendations"]
 
-    buses = update.message.text.split("\n")
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
 
     # Update database
-    new_buses = list(set(buses) - set(current_buses))
-    for bus in new_buses: # Add new buses
-        cur.execute(f"INSERT INTO buses VALUES \
-                    ({bus_id + 1}, {target_chat_id}, '{bus}')")
-        con.commit()
-        bus_id += 1
-    old_buses = list(set(current_buses) - set(buses))
-    for bus in old_buses: # Remove old buses
-        cur.execute(f"DELETE FROM buses \
-                    WHERE chat_id = {target_chat_id} \
-                    AND time = '{bus}'")
-        con.commit()
+    match kind:
+        case "max_riders":
+            cur.execute(f"UPDATE settings SET max_riders={int(value)} WHERE chat_id={target_chat_id}")
+        case "add_bus":
+            res = cur.execute(f"SELECT EXISTS (SELECT 1 FROM buses WHERE chat_id={target_chat_id} AND time='{value}')")
+            if not res.fetchone()[0]: # Registration window defaults to DEFAULT_OPEN_TIME-DEFAULT_CLOSE_TIME
+                cur.execute(f"INSERT INTO buses (chat_id, time) VALUES ({target_chat_id}, '{value}')")
+        case "remove_bus":
+            cur.execute(f"DELETE FROM schedule WHERE bus_id IN \
+                        (SELECT bus_id FROM buses WHERE chat_id={target_chat_id} AND time='{value}')")
+            cur.execute(f"DELETE FROM buses WHERE chat_id={target_chat_id} AND time='{value}'")
+    cur.execute("DELETE FROM recommendations WHERE chat_id=? AND kind=? AND value=?", (target_chat_id, kind, value))
+    bump_data_version(cur)
+    con.commit()
 
     con.close()
 
+    # End registrations of removed buses, new timings are picked up by registration_job
+    if kind != "max_riders":
+        await end_removed_buses(context)
+
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
-        text = UPDATED_SETTINGS_MSG,
-        reply_markup = ReplyKeyboardRemove()
+        text = UPDATED_SETTINGS_MSG
     )
 
     return SELECT
 
+async def settings_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel fallback function for settings, also removing the buttons of the chat picker."""
+    remove_chat_picker(update)
+    return await cancel(update, context)
+
+async def settings_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Timeout function for settings, also removing the buttons of the chat picker."""
+    remove_chat_picker(update)
+    await timeout(update, context)
+
+# The chat picker is the only message with buttons in a settings conversation, and its buttons are removed when the 
+# conversation moves on, so the conversation does not need to be tracked per message
+warnings.filterwarnings("ignore", message="If 'per_message=False'", category=PTBUserWarning)
+
 settings_handler = ConversationHandler(
     entry_points=[CommandHandler("settings", settings_command)],
     states = {
-        CHAT_ID: [MessageHandler(filters.Regex(r"^[0-9]+$"), settings_chat_id),
+        CHAT_ID: [CallbackQueryHandler(settings_chat_id, r"^settings_chat:-?[0-9]+$"),
+                  CallbackQueryHandler(settings_chat_page, r"^settings_page:[0-9]+$"),
+                  MessageHandler(filters.TEXT & ~filters.COMMAND, settings_chat_search),
                   MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
-        SELECT: [MessageHandler(filters.Regex(r"^(Max Riders|Pickup Location|Destination|Chat Type|Buses)$"), settings_select),
+        SELECT: [MessageHandler(filters.Regex(r"^(Max Riders|Pickup Location|Destination|Chat Type|Buses|Recommendations)$"), settings_select),
                  MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
         RIDERS: [MessageHandler(filters.Regex(r"^[0-9]+$"), settings_riders),
                  MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
@@ -699,70 +1075,273 @@ settings_handler = ConversationHandler(
              MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
         CHAT: [MessageHandler(filters.Regex(r"^(Admin|Service)$"), settings_chat),
                  MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
-        BUSES: [MessageHandler(filters.Regex(r"^(([01]\d|2[0-3])([0-5]\d))(\n([01]\d|2[0-3])([0-5]\d))*$"), settings_buses),
+        BUSES: [MessageHandler(filters.Regex(r"^(([01]\d|2[0-3])([0-5]\d))( ([01]\d|2[0-3])([0-5]\d)-([01]\d|2[0-3])([0-5]\d))?(\n(([01]\d|2[0-3])([0-5]\d))( ([01]\d|2[0-3])([0-5]\d)-([01]\d|2[0-3])([0-5]\d))?)*$"), settings_buses),
                  MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
-        ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)],
+        RECOMMENDATIONS: [MessageHandler(filters.Regex(r"^[0-9]+$"), settings_apply_recommendation),
+                          MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
+        ConversationHandler.TIMEOUT: [TypeHandler(Update, settings_timeout)], # Also after a button was the last update
     },
-    fallbacks = [CommandHandler("cancel", cancel)],
+    fallbacks = [CommandHandler("cancel", settings_cancel)],
     conversation_timeout = 60,
 )
 
-## REGISTRATION
-async def registration_message(context: ContextTypes.DEFAULT_TYPE, 
-                               chat_id, 
-                               date=None,
-                               t=None,
-                               message_id=None, 
-                               close=False):
+# Bus timing with an optional registration window, e.g. "0645" or "0645 1200-2200"
+BUS_PATTERN = r"([01]\d|2[0-3])[0-5]\d( ([01]\d|2[0-3])[0-5]\d-([01]\d|2[0-3])[0-5]\d)?"
+
+def parse_buses(lines):
     """
-    Creates / Re-creates menu for registration.
+    Helper function to get bus timings and registration windows from lines matching BUS_PATTERN.
+    Returns {time: [open_time, close_time]}.
+    Raises ValueError if a line does not match, or a registration window opens and closes at the same time.
+    """
+    buses = {}
+    for line in lines:
+        if not re.fullmatch(BUS_PATTERN, line):
+            raise ValueError(f"Invalid bus timing {line}")
+        bus, _, window = line.partition(" ")
+        if window:
+            buses[bus] = window.split("-")
+        else:
+            buses[bus] = [DEFAULT_OPEN_TIME, DEFAULT_CLOSE_TIME]
+        if buses[bus][0] == buses[bus][1]:
+            raise ValueError(f"Registration for the {bus} bus opens and closes at {buses[bus][0]}")
+    return buses
+
+SETTING_NAMES = {
+    "max_riders": "Max Riders",
+    "pickup": "Pickup Location",
+    "destination": "Destination",
+} # Settings which can be changed in bulk, by their name in messages
+
+def apply_settings(chat_ids, settings, buses=None):
+    """
+    Helper function to apply settings ({column: value}) and bus timings (see parse_buses, None to keep them) 
+    to every chat in chat_ids, in a single transaction.
+    Returns the changes made to each chat as text, only for chats which changed.
     """
-    chat_data = context.bot_data[chat_id]
+    chats = ", ".join(map(str, chat_ids))
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
 
-    # Get pickup and destination info
-    res = cur.execute(f"SELECT pickup, destination FROM settings WHERE chat_id={chat_id}")
-    data = res.fetchone()
-    pickup, destination = data[0], data[1]
-
-    # Get date and time
-    if not date:
-        date = chat_data["bookings"][message_id]["date"]
-    if not t:
-        t = chat_data["bookings"][message_id]["time"]
-
-    # Get the book_id
-    if not message_id:
-        res = cur.execute("SELECT MAX(book_id) FROM ridership")
-        book_id = res.fetchone()[0]
-        if book_id == None:
-            book_id = 0
-        else:
-            book_id = book_id + 1
-    else:
-        book_id = chat_data["bookings"][message_id]["book_id"]
+    # Get data from database
+    res = cur.execute(f"SELECT chat_id, {', '.join(SETTING_NAMES)} FROM settings WHERE chat_id IN ({chats})")
+    current_settings = {i[0]: dict(zip(SETTING_NAMES, i[1:])) for i in res.fetchall()}
+
+    res = cur.execute(f"SELECT chat_id, time, open_time, close_time FROM buses WHERE chat_id IN ({chats})")
+    current_buses = {}
+    for chat_id, bus, open_time, close_time in res.fetchall():
+        current_buses.setdefault(chat_id, {})[bus] = [open_time, close_time]
+
+    # Find changes
+    changes = {}
+    updates, new_buses, old_buses, windows = [], [], [], []
+    for chat_id in chat_ids:
+        diff = []
+        for setting, value in settings.items():
+            old_value = current_settings.get(chat_id, {}).get(setting)
+            if old_value != value:
+                diff.append(f"{SETTING_NAMES[setting]} {old_value} -> {value}")
+        if diff:
+            updates.append(list(settings.values()) + [chat_id])
+
+        if buses != None:
+            chat_buses = current_buses.get(chat_id, {})
+            for bus in sorted(set(buses) - set(chat_buses)): # Add new buses
+                new_buses.append((chat_id, bus, *buses[bus]))
+                diff.append(f"+{bus} {'-'.join(buses[bus])}")
+            for bus in sorted(set(chat_buses) - set(buses)): # Remove old buses
+                old_buses.append((chat_id, bus))
+                diff.append(f"-{bus}")
+            for bus in sorted(set(chat_buses) & set(buses)): # Update registration windows
+                if chat_buses[bus] != buses[bus]:
+                    windows.append((*buses[bus], chat_id, bus))
+                    diff.append(f"{bus} {'-'.join(chat_buses[bus])} -> {'-'.join(buses[bus])}")
+
+        if diff:
+            changes[chat_id] = "; ".join(diff)
+
+    # Update database
+    if updates:
+        cur.executemany(f"UPDATE settings SET {', '.join(f'{setting}=?' for setting in settings)} WHERE chat_id=?", updates)
+        cur.executemany("DELETE FROM recommendations WHERE chat_id=? AND kind='max_riders'", 
+                        [(update[-1],) for update in updates]) # Recommendations no longer apply
+    cur.executemany("INSERT INTO buses (chat_id, time, open_time, close_time) VALUES (?, ?, ?, ?)", new_buses)
+    cur.executemany("DELETE FROM schedule WHERE bus_id IN (SELECT bus_id FROM buses WHERE chat_id=? AND time=?)", old_buses)
+    cur.executemany("DELETE FROM buses WHERE chat_id=? AND time=?", old_buses)
+    cur.executemany("UPDATE buses SET open_time=?, close_time=? WHERE chat_id=? AND time=?", windows)
+    if buses != None:
+        cur.executemany("DELETE FROM recommendations WHERE chat_id=? AND kind IN ('add_bus', 'remove_bus')", 
+                        [(chat_id,) for chat_id in chat_ids])
+    if changes:
+        bump_data_version(cur) # Once for all chats
+    con.commit()
 
     con.close()
+    return changes
+
+BULK_CHATS, BULK_TEMPLATE = range(16, 18) # states for bulk settings conversation handler
+
+@timed
+@permissions_factory("admin")
+@restricted
+async def bulk_settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Applies the same settings and bus timings to many service chats at once.
+    Selects the chats to change.
+    """
+    print("COMMAND: bulk settings")
+
+    chat_id = update.effective_chat.id
+
+    queue_message(
+        chat_id = chat_id,
+        text = BULK_SETTINGS_MSG
+    )
+
+    return BULK_CHATS
+
+async def bulk_settings_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Selects service chats by chat ID (one per line), name, or all of them."""
+    chat_id = update.effective_chat.id
+
+    selection = update.message.text.strip()
+    chats = chat_directory()
+    unknown = []
+    if selection.lower() == "all":
+        pass
+    elif re.fullmatch(r"-?[0-9]+(\n-?[0-9]+)*", selection):
+        chat_ids = list(dict.fromkeys(map(int, selection.split("\n"))))
+        unknown = [str(i) for i in chat_ids if i not in {c[0] for c in chats}]
+        chats = [c for c in chats if c[0] in chat_ids]
+    else:
+        chats = [c for c in chats if selection.lower() in c[1].lower() or selection.lower() in c[2].lower()]
+    unknown = f"Not service chats: {', '.join(unknown)}" if unknown else ""
+
+    if not chats:
+        queue_message(
+            chat_id = chat_id,
+            text = f"{NO_CHATS_FOUND_MSG}\n\n{unknown}" if unknown else NO_CHATS_FOUND_MSG
+        )
+        return BULK_CHATS
+
+    context.user_data["bulk_chat_ids"] = [c[0] for c in chats]
+    print(context.user_data)
+
+    text = f"{len(chats)} chats selected:"
+    for c in chats:
+        text = f"{text}\n{c[1]} to {c[2]}"
+    if unknown:
+        text = f"{text}\n\n{unknown}"
+    text = f"{text}\n\n{BULK_TEMPLATE_MSG}"
+    for part in split_message(text):
+        queue_message(
+            chat_id = chat_id,
+            text = part
+        )
+
+    return BULK_TEMPLATE
+
+@timed
+async def bulk_settings_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Validates the template, applies it to the selected chats and sends the changes made."""
+    chat_id = update.effective_chat.id
+
+    # Get settings and bus timings, e.g. "Max Riders: 40", "Buses:" followed by a bus timing per line
+    names = {name.lower(): setting for setting, name in SETTING_NAMES.items()}
+    settings, buses = {}, None
+    lines = [line.strip() for line in update.message.text.split("\n") if line.strip()]
+    for i, line in enumerate(lines):
+        name, _, value = line.partition(":")
+        name, value = name.strip().lower(), value.strip()
+        if name == "buses" and not value and lines[i + 1:]:
+            try:
+                buses = parse_buses(lines[i + 1:])
+            except ValueError as e:
+                queue_message(
+                    chat_id = chat_id,
+                    text = f"{e}. {INVALID_BULK_TEMPLATE_MSG}"
+                )
+                return BULK_TEMPLATE
+            break
+        elif name in names and value and (names[name] != "max_riders" or value.isdigit()):
+            settings[names[name]] = int(value) if names[name] == "max_riders" else value
+        else:
+            queue_message(
+                chat_id = chat_id,
+                text = INVALID_BULK_TEMPLATE_MSG
+            )
+            return BULK_TEMPLATE
+    if not settings and not buses:
+        queue_message(
+            chat_id = chat_id,
+            text = INVALID_BULK_TEMPLATE_MSG
+        )
+        return BULK_TEMPLATE
+
+    chat_ids = context.user_data.pop("bulk_chat_ids")
+    changes = apply_settings(chat_ids, settings, buses)
+
+    # End registrations of removed buses, once for all chats, new timings are picked up by registration_job
+    if buses != None:
+        await end_removed_buses(context)
+
+    # Send changes
+    names = {c[0]: f"{c[1]} to {c[2]}" for c in chat_directory()}
+    text = f"Settings updated for {len(changes)} of {len(chat_ids)} chats."
+    for target_chat_id, diff in changes.items():
+        text = f"{text}\n\n{names.get(target_chat_id, target_chat_id)}: {diff}"
+    for part in split_message(text, "\n\n"):
+        queue_message(
+            chat_id = chat_id,
+            text = part
+        )
+
+    return ConversationHandler.END
+
+bulk_settings_handler = ConversationHandler(
+    entry_points = [CommandHandler("bulk_settings", bulk_settings_command)],
+    states = {
+        BULK_CHATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, bulk_settings_chats),
+                     MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
+        BULK_TEMPLATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bulk_settings_template),
+                        MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
+        ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)],
+    },
+    fallbacks = [CommandHandler("cancel", cancel)],
+    conversation_timeout = 120,
+)
+
+## REGISTRATION
+async def registration_message(context: ContextTypes.DEFAULT_TYPE, registration):
+    """
+    Creates / Re-creates menu for registration.
+    Registrations without a message_id get a new message, which is saved as the registration's message.
+    Returns the new message, or None if it could not be sent.
+    """
+    chat_id = registration["chat_id"]
+    message_id = registration["message_id"]
+
+    if not message_id and registration["closed"]: # Never sent, so there is no message to close
+        return None
 
     # Prepare the text message
-    text = f"Booking ID: {book_id} \n\
-Registration of {pickup} to {destination} Shuttle Bus slots for {date} at {t}."
+    text = f"Booking ID: {registration['book_id']} \n\
+Registration of {registration['pickup']} to {registration['destination']} Shuttle Bus slots for {registration['date']} at {registration['time']}."
     
     if message_id:
-        bookings = chat_data["bookings"][message_id]['bookings']
-        users = chat_data["bookings"][message_id]['users']
+        users = registration["users"]
 
-        text = f"{text}\n\nPlaces Reserved ({bookings}):"
+        text = f"{text}\n\nPlaces Reserved ({len(users)}):"
 
         for u in users:
             text += f"\n{u['username']}"
     
     # Send the message
     reply_markup = None
-    if not close:
+    if not registration["closed"]:
         buttons = [
             [InlineKeyboardButton("Book", callback_data="book"),
             InlineKeyboardButton("Cancel", callback_data="cancel")],
@@ -770,23 +1349,36 @@ Registration of {pickup} to {destination} Shuttle Bus slots for {date} at {t}."
         reply_markup = InlineKeyboardMarkup(buttons)
     
     if message_id:
-        message = await context.bot.edit_message_text(
+        queue_edit(
             chat_id = chat_id,
             message_id = message_id,
             text = text,
             reply_markup = reply_markup,
         )
-
-        return message
-    else:
-        message = await context.bot.send_message(
+    else: # Sent directly, as the message_id is needed to track the booking
+        message = await send_now(
+            context.bot,
             chat_id = chat_id,
             text = text,
             reply_markup = reply_markup,
         )
+        if message == None:
+            return None
+
+        # Connect to DB
+        con = connect()
+        cur = con.cursor()
+
+        # Save the message of the registration
+        cur.execute(f"UPDATE registrations SET message_id={message.message_id} \
+                    WHERE book_id={registration['book_id']}")
+        con.commit()
 
-        return message, book_id
+        con.close()
+
+        return message
 
+@timed
 @permissions_factory("service")
 @restricted
 async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -797,125 +1389,112 @@ async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # TODO: Conversation handler for this command
     chat_id = update.effective_chat.id
-    chat_data = context.bot_data[chat_id]
-
-    # Get date and time
-    date = datetime.today() + timedelta(1)
-    date = date.strftime("%d %b %y")
-    t = "NA"
     
     # Send the registration message
-    message, book_id = await registration_message(context, chat_id, date, t)
-
-    # Update data
-    chat_data["bookings"][message.message_id] = {
-        "book_id": book_id,
-        "bookings": 0,
-        "users": [],
-        "date": date,
-        "time": t
-    }
-    payload = {
-        chat_id: chat_data
-    }
-    context.bot_data.update(payload)
-    print(context.bot_data)
-
-    # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
-    cur = con.cursor()
-
-    # Update database
-    cur.execute(f"INSERT INTO ridership VALUES \
-                ({book_id}, {chat_id}, '{date}', '{t}', 0)")
-    con.commit()
-
-    con.close()
+    await book_job(context, chat_id, "NA")
 
+@timed
 async def booking_cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Updates the bot once user has clicked certain options of the booking message.
+    Bookings are checked and saved in a single transaction, so that concurrent clicks (handled by any worker process) 
+    cannot exceed max_riders or register a user twice.
     """
     query = update.callback_query.data
     message_id = update.callback_query.message.message_id
     chat_id = update.effective_chat.id
-    chat_data = context.bot_data[chat_id]
+    
+    # Get user information
+    user_id = update.callback_query.from_user.id
+    username = update.callback_query.from_user.username
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE") # Lock out other writers until the booking is saved
 
-    # Get max_riders from database
-    res = cur.execute(f"SELECT max_riders \
-                      FROM settings WHERE chat_id={chat_id}")
+    # Get the registration and max_riders from database
+    res = cur.execute(f"SELECT r.book_id, r.closed, s.max_riders \
+                      FROM registrations r JOIN settings s ON r.chat_id=s.chat_id \
+                      WHERE r.chat_id={chat_id} AND r.message_id={message_id}")
     data = res.fetchone()
-    max_riders = data[0]
+    if data == None:
+        print(f"Registration failed as registration has ended.")
+        con.close()
+        return
+    book_id, closed, max_riders = data[0], data[1], data[2]
 
-    con.close()
-    
-    # Get user information
-    user = {
-        'username': update.callback_query.from_user.username,
-        'id': update.callback_query.from_user.id
-    }
-    users = chat_data["bookings"][message_id]['users']
-    all_users = reduce(lambda l, msg: l + msg["users"], chat_data["bookings"].values(), [])
+    res = cur.execute(f"SELECT COUNT(*) FROM riders WHERE book_id={book_id}")
+    riders = res.fetchone()[0]
 
     # Handle the callback
     if "book" in query: # "Book" button clicked
+        # Check if registration has been closed
+        if closed:
+            print(f"Registration failed as registration has been closed.")
+            con.close()
+            return
         # Check if max users have been reached
-        if len(users) == max_riders:
+        if riders >= max_riders:
             print(f"Registration failed as maximum number of riders have registered.")
+            cur.execute(f"INSERT OR IGNORE INTO turned_away VALUES ({book_id}, {user_id})") # Demand for recommendations
+            con.commit()
+            con.close()
             return
         # Check if user has already booked
-        if user in all_users:
+        res = cur.execute(f"SELECT EXISTS (SELECT 1 FROM riders JOIN registrations USING (book_id) \
+                          WHERE registrations.chat_id={chat_id} AND riders.user_id={user_id})")
+        if res.fetchone()[0]:
             print(f"Registration failed as user attempted to register twice.")
+            con.close()
             return
 
-        users.append(user)
-
-        # Update bot data
-        chat_data["bookings"][message_id]['bookings'] += 1
-        chat_data["bookings"][message_id]["users"] = users
-        payload = {
-            chat_id: chat_data
-        }
-        context.bot_data.update(payload)
-        print(context.bot_data) # Important for debugging
+        cur.execute("INSERT INTO riders VALUES (?, ?, ?, ?)", (book_id, user_id, username, time.time()))
+        con.commit()
+        riders += 1
 
         # Notif message for MAX RIDERS reached
-        if len(users) >= max_riders:
-            await update.callback_query.message.reply_text(MAX_RIDERS_NOTIF_MSG)
+        if riders >= max_riders:
+            queue_message(
+                chat_id = chat_id,
+                text = MAX_RIDERS_NOTIF_MSG
+            )
 
     if "cancel" in query: # "Cancel" button clicked
+        # Keep the cancelled booking in the booking history
+        cur.execute(f"INSERT INTO bookings \
+                    SELECT r.book_id, r.user_id, r.username, iso_date(g.date), r.booked_at, {time.time()} \
+                    FROM riders r JOIN registrations g ON r.book_id=g.book_id \
+                    WHERE r.book_id={book_id} AND r.user_id={user_id} \
+                    ON CONFLICT (book_id, user_id) DO UPDATE SET \
+                    booked_at=excluded.booked_at, cancelled_at=excluded.cancelled_at")
+
         # Check if user has already booked
-        if user not in users:
+        res = cur.execute(f"DELETE FROM riders WHERE book_id={book_id} AND user_id={user_id}")
+        if res.rowcount == 0:
             print(f"Registration cancellation failed as user has not registered before.")
+            con.close()
             return
-        
-        users.remove(user)
-
-        # Update bot data
-        chat_data["bookings"][message_id]['bookings'] -= 1
-        chat_data["bookings"][message_id]["users"] = users
-        payload = {
-            chat_id: chat_data
-        }
-        context.bot_data.update(payload)
-        print(context.bot_data) # Important for debugging
+        con.commit()
+        riders -= 1
 
         # If new spaces open up, send a notification message
-        if len(users) == max_riders - 1:
-            await update.callback_query.message.reply_text(OPEN_SPACES_NOTIF_MSG)
+        if riders == max_riders - 1:
+            queue_message(
+                chat_id = chat_id,
+                text = OPEN_SPACES_NOTIF_MSG
+            )
+
+    con.close()
 
     # Edit the message to show list of users
-    await registration_message(context, 
-                               chat_id, 
-                               message_id = message_id
-                               )
+    registration = get_registration(book_id)
+    if registration != None: # Not ended in the meantime
+        await registration_message(context, registration)
 
 BOOK_ID, FUNCTION = range(7, 9)
 
+@timed
 @permissions_factory("admin")
 @restricted
 async def manage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -931,7 +1510,7 @@ async def manage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = MANAGE_MSG
     )
@@ -948,14 +1527,9 @@ async def manage_book_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     book_id = int(update.message.text)
 
     # Check if book_id is valid
-    target_chat_id = None
-    for i, chat in context.bot_data.items():
-        for j in chat["bookings"].keys():
-            if chat["bookings"][j]["book_id"] == book_id:
-                target_chat_id = i
-    if target_chat_id == None:
+    if get_registration(book_id) == None:
         # Send message
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = INVALID_BOOK_ID_MSG
         )
@@ -964,7 +1538,6 @@ async def manage_book_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # Temporarily save book_id selected by user
         context.user_data["book_id"] = book_id
-        context.user_data["target_chat_id"] = target_chat_id
         print(context.user_data)
     
     # Send message
@@ -975,7 +1548,7 @@ async def manage_book_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
          KeyboardButton("Cancel")]
     ]
     reply_markup = ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = MANAGE_FUNCTIONS_MSG,
         reply_markup = reply_markup
@@ -983,180 +1556,158 @@ async def manage_book_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     return FUNCTION
 
+@timed
 async def manage_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Executes the function chosen.
     """
-    # Get book_id's corresponding message_id
-    target_chat_id = context.user_data["target_chat_id"]
-    bookings = context.bot_data[target_chat_id]["bookings"]
-    for i in bookings.keys():
-        if bookings[i]["book_id"] == context.user_data["book_id"]:
-            message_id = i
+    book_id = context.user_data["book_id"]
+
+    # Remove book_id selected by user
+    del context.user_data["book_id"]
+    print(context.user_data)
+
+    # Check the booking was not ended in the meantime
+    if get_registration(book_id) == None:
+        queue_message(
+            chat_id = update.effective_chat.id,
+            text = INVALID_BOOK_ID_MSG,
+            reply_markup = ReplyKeyboardRemove()
+        )
+        return ConversationHandler.END
 
     # Execute function based on user's selection
     selection = update.message.text
     match selection:
         case "Close":
-            await manage_close(update, context, message_id)
+            await manage_close(update, context, book_id)
         case "Reopen":
-            await manage_reopen(update, context, message_id)
+            await manage_reopen(update, context, book_id)
         case "End":
-            await manage_end(update, context, message_id)
+            await manage_end(update, context, book_id)
         case "Cancel":
-            await manage_cancel(update, context, message_id)
-
-    # Remove book_id selected by user
-    del context.user_data["book_id"]
-    del context.user_data["target_chat_id"]
-    print(context.user_data)
+            await manage_cancel(update, context, book_id)
 
     return ConversationHandler.END
 
-async def manage_close(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id):
+async def manage_close(update: Update, context: ContextTypes.DEFAULT_TYPE, book_id):
     """
     Close registration for the current day. 
     New riders will not be registered. 
     List of registered users will still be stored.
     """
-    target_chat_id = context.user_data["target_chat_id"]
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+
+    res = cur.execute(f"UPDATE registrations SET closed=1 WHERE book_id={book_id}")
+    registrations = get_registrations(cur, f"r.book_id={book_id}") if res.rowcount else []
+    con.commit()
+
+    con.close()
+
+    # Ended by the registration job or another admin in the meantime
+    if not registrations:
+        queue_message(
+            chat_id = update.effective_chat.id,
+            text = REGISTRATION_ENDED_MSG,
+            reply_markup = ReplyKeyboardRemove()
+        )
+        return
 
     # Remove reply_markup so users cannot register
-    await registration_message(context, 
-                               target_chat_id, 
-                               message_id=message_id,
-                               close=True
-                               )
+    registration = registrations[0]
+    await registration_message(context, registration)
     
     # Notif message
-    await context.bot.send_message(
-        chat_id = target_chat_id,
+    queue_message(
+        chat_id = registration["chat_id"],
         text = CLOSE_NOTIF_MSG,
         reply_markup = ReplyKeyboardRemove()
     )
 
-async def manage_reopen(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id):
+async def manage_reopen(update: Update, context: ContextTypes.DEFAULT_TYPE, book_id):
     """
     Reopen registration for the selected booking. New riders can continue being registered.
     """
-    target_chat_id = context.user_data["target_chat_id"]
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+
+    res = cur.execute(f"UPDATE registrations SET closed=0 WHERE book_id={book_id}")
+    registrations = get_registrations(cur, f"r.book_id={book_id}") if res.rowcount else []
+    con.commit()
+
+    con.close()
+
+    # Ended by the registration job or another admin in the meantime
+    if not registrations:
+        queue_message(
+            chat_id = update.effective_chat.id,
+            text = REGISTRATION_ENDED_MSG,
+            reply_markup = ReplyKeyboardRemove()
+        )
+        return
 
     # Add back reply_markup so users can register
-    await registration_message(context, 
-                               target_chat_id,
-                               message_id=message_id
-                               )
+    registration = registrations[0]
+    await registration_message(context, registration)
     
     # Notif message
-    await context.bot.send_message(
-        chat_id = target_chat_id,
+    queue_message(
+        chat_id = registration["chat_id"],
         text = REOPEN_NOTIF_MSG,
         reply_markup = ReplyKeyboardRemove(),
     )
 
-async def manage_end(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id):
+async def manage_end(update: Update, context: ContextTypes.DEFAULT_TYPE, book_id):
     """Ends registration"""
-    target_chat_id = context.user_data["target_chat_id"]
-    chat_data = context.bot_data[target_chat_id]
-
-    # Get date
-    date = datetime.today() + timedelta(1)
-    date = date.strftime("%d %b %y")
-    
-    # Remove reply_markup so users cannot reply
-    await registration_message(context, 
-                               target_chat_id, 
-                               message_id=message_id,
-                               close=True
-                               )
+    # Close the registration and send tokens
+    registrations = await end_registrations(context, f"r.book_id={book_id}")
     
     # Notif message
-    await context.bot.send_message(
-        chat_id = target_chat_id,
-        text = END_NOTIF_MSG,
-        reply_markup = ReplyKeyboardRemove()
-    )
-    
-    # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
-    cur = con.cursor()
-    
-    # Send tokens
-    res = cur.execute(f"SELECT pickup, destination \
-                      FROM settings WHERE chat_id={target_chat_id}")
-    data = res.fetchone()
-    pickup, destination = data[0], data[1]
-    time = chat_data["bookings"][message_id]["time"]
-
-    booking_token = f"Your registration for the shuttle bus from {pickup} to {destination} for {date} at time {time} has been confirmed."
-    for user in chat_data["bookings"][message_id]["users"]:
-        try:
-            await context.bot.send_message(
-                chat_id = user["id"],
-                text = booking_token
-            )
-        except Exception as e:
-            print(f"Failed to send token to user {user['username']} (id: {user['id']}) as user did not initiate conversation with bot.")
-            print(e)
-    
-    # Update database
-    book_id = chat_data["bookings"][message_id]["book_id"]
-    bookings = chat_data["bookings"][message_id]["bookings"]
-    cur.execute(f"UPDATE ridership SET \
-                riders={bookings} \
-                WHERE book_id={book_id}")
-    con.commit()
-
-    con.close()
-
-    # Delete data
-    del chat_data["bookings"][message_id]
-    payload = {
-        target_chat_id: chat_data
-    }
-    context.bot_data.update(payload)
-    print(context.bot_data)
+    for registration in registrations:
+        queue_message(
+            chat_id = registration["chat_id"],
+            text = END_NOTIF_MSG,
+            reply_markup = ReplyKeyboardRemove()
+        )
     
-async def manage_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id):
+async def manage_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, book_id):
     """
     Cancels registration for the selected booking (irreversible).
     """
-    target_chat_id = context.user_data["target_chat_id"]
-    chat_data = context.bot_data[target_chat_id]
-
-    # Remove button functionality
-    await registration_message(context, 
-                               target_chat_id, 
-                               message_id = message_id,
-                               close=True
-                               )
-    
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
     
+    registrations = get_registrations(cur, f"r.book_id={book_id}")
+
     # Update database
-    book_id = chat_data["bookings"][message_id]["book_id"]
+    cur.execute(f"DELETE FROM riders WHERE book_id={book_id}")
+    cur.execute(f"DELETE FROM turned_away WHERE book_id={book_id}")
+    cur.execute(f"DELETE FROM bookings WHERE book_id={book_id}")
+    cur.execute(f"DELETE FROM registrations WHERE book_id={book_id}")
     cur.execute(f"DELETE FROM ridership \
                 WHERE book_id={book_id}")
-    con.commit()
+    con.commit() # Registrations are only added to ridership_daily when they end, so it is unaffected
 
     con.close()
 
-    # Delete data
-    del chat_data["bookings"][message_id]
-    payload = {
-        target_chat_id: chat_data
-    }
-    context.bot_data.update(payload)
-    print(context.bot_data)
+    for registration in registrations: # Empty if cancelled by someone else in the meantime
+        # Remove button functionality
+        registration["closed"] = True
+        await registration_message(context, registration)
 
-    # Notif message
-    await context.bot.send_message(
-        chat_id = target_chat_id,
-        text = CANCEL_NOTIF_MSG,
-        reply_markup = ReplyKeyboardRemove()
-    )
+        # Notif message
+        queue_message(
+            chat_id = registration["chat_id"],
+            text = CANCEL_NOTIF_MSG,
+            reply_markup = ReplyKeyboardRemove()
+        )
 
 manage_book_handler = ConversationHandler(
     entry_points = [CommandHandler("manage", manage_command)],
@@ -1171,6 +1722,7 @@ manage_book_handler = ConversationHandler(
     conversation_timeout = 60,
 )
 
+@timed
 @permissions_factory("service")
 @restricted
 async def cancel_book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1187,7 +1739,7 @@ async def cancel_book_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     date = date.strftime("%d%m%y")
 
     # Connect to DB schedule
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Fetch all bus_ids
@@ -1209,11 +1761,12 @@ async def cancel_book_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Notif Message
     text = f"Booking cancelled for {datestr}"
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = text
     )
 
+@timed
 @permissions_factory("service")
 @restricted
 async def uncancel_book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1223,14 +1776,13 @@ async def uncancel_book_command(update: Update, context: ContextTypes.DEFAULT_TY
     print("COMMAND: uncancel book")
 
     chat_id = update.effective_chat.id
-    chat_data = context.bot_data[chat_id]
 
     dt = datetime.today() + timedelta(1)
     datestr = dt.strftime("%d %b %y")
     date = dt.strftime("%d%m%y")
 
     # Connect to DB schedule
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Fetch all bus_ids
@@ -1252,7 +1804,7 @@ async def uncancel_book_command(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Notif Message
     text = f"Booking uncancelled for {datestr}"
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = text
     )
@@ -1260,6 +1812,7 @@ async def uncancel_book_command(update: Update, context: ContextTypes.DEFAULT_TY
 
 BUS_ID_VIEW = 8
 
+@timed
 @permissions_factory("admin")
 @restricted
 async def view_schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1270,24 +1823,21 @@ async def view_schedule_command(update: Update, context: ContextTypes.DEFAULT_TY
 
     chat_id = update.effective_chat.id
 
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = VIEW_SCHEDULE_MSG,
     )
 
     return BUS_ID_VIEW
 
-async def view_schedule_bus_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@versioned(maxsize=RESULT_CACHE_SIZE)
+def schedule_text(bus_id):
     """
-    Shows the schedule for the selected bus ID
+    Helper function to render the schedule of a bus into a message.
+    Results are cached until the data version changes.
     """
-    chat_id = update.effective_chat.id
-
-    # Get the bus ID
-    bus_id = int(update.message.text)
-
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Get schedule
@@ -1307,8 +1857,22 @@ async def view_schedule_bus_id(update: Update, context: ContextTypes.DEFAULT_TYP
             text = f"{text}\n{i[0]} {status}"
         else:
             text = f"{text}\n{i[0]}-{i[1]} {status}"
+
+    return text
+
+@timed
+async def view_schedule_bus_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Shows the schedule for the selected bus ID
+    """
+    chat_id = update.effective_chat.id
+
+    # Get the bus ID
+    bus_id = int(update.message.text)
+
+    text = schedule_text(bus_id)
     
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = text
     )
@@ -1327,7 +1891,9 @@ view_schedule_handler = ConversationHandler(
 )
 
 BUS_ID, OVERWRITE, DATES = range(10, 13)
+IMPORT = 18 # state for schedule import conversation handler
 
+@timed
 @permissions_factory("admin")
 @restricted
 async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1339,7 +1905,7 @@ async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
 
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = SCHEDULE_MSG,
     )
@@ -1357,7 +1923,7 @@ async def schedule_bus_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Check whether bus id is valid
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Get all bus ids
@@ -1368,7 +1934,7 @@ async def schedule_bus_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     con.close()
 
     if bus_id not in bus_ids:
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = INVALID_BUS_ID_MSG
         )
@@ -1383,7 +1949,7 @@ async def schedule_bus_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         KeyboardButton("Cancel")
     ]]
     reply_markup = ReplyKeyboardMarkup(buttons)
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = SCHEDULE_FUNCTION_MSG,
         reply_markup = reply_markup
@@ -1401,7 +1967,7 @@ async def schedule_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["overwrite"] = selection
     print(context.user_data)
 
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = SCHEDULE_DATES_MSG,
         reply_markup = ReplyKeyboardRemove()
@@ -1409,6 +1975,7 @@ async def schedule_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return DATES
 
+@timed
 async def schedule_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Updates the schedule table.
@@ -1429,7 +1996,7 @@ async def schedule_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status = 1
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     for i in date_ranges:
@@ -1440,13 +2007,13 @@ async def schedule_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 start = datetime.strptime(date_range[0], "%d%m%y")
                 end = datetime.strptime(date_range[1], "%d%m%y")
                 if start >= end:
-                    await context.bot.send_message(
+                    queue_message(
                         chat_id = chat_id,
                         text = INVALID_SCHEDULE_DATE_MSG
                     )
                     return DATES
             except Exception:
-                await context.bot.send_message(
+                queue_message(
                         chat_id = chat_id,
                         text = INVALID_SCHEDULE_DATE_MSG
                 )
@@ -1458,7 +2025,7 @@ async def schedule_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 date = datetime.strptime(i, "%d%m%y")
             except Exception:
-                await context.bot.send_message(
+                queue_message(
                         chat_id = chat_id,
                         text = INVALID_SCHEDULE_DATE_MSG
                 )
@@ -1471,7 +2038,7 @@ async def schedule_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await clean_schedule(bus_ids = [bus_id])
 
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = UPDATED_SCHEDULE_MSG
     )
@@ -1496,19 +2063,169 @@ schedule_handler = ConversationHandler(
     conversation_timeout = 60
 )
 
-async def daily_booking(context: ContextTypes.DEFAULT_TYPE):
+# Date or date range of an imported schedule entry, e.g. "030124-050124" or "2024-01-03-2024-01-05"
+IMPORT_DATES_PATTERN = r"(\d{6}|\d{4}-\d{2}-\d{2})(?:-(\d{6}|\d{4}-\d{2}-\d{2}))?"
+
+def parse_schedule(rows):
+    """
+    Helper function to validate schedule entries, as (line number, bus ID, Book / Cancel, start date, end date).
+    Dates are DDMMYY or YYYY-MM-DD, and the end date is optional for single days.
+    Returns the entries as schedule rows, and the errors found (nothing should be saved if there are any).
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT bus_id FROM buses")
+    bus_ids = set(i[0] for i in res.fetchall())
+
+    con.close()
+
+    def parse_date(date):
+        for fmt in ("%d%m%y", "%Y-%m-%d"):
+            try:
+                return datetime.strptime(date.strip(), fmt)
+            except ValueError:
+                pass
+        return None
+
+    entries, errors = [], []
+    for line, bus_id, status, start_date, end_date in rows:
+        status = status.strip().capitalize()
+        start, end = parse_date(start_date), parse_date(end_date or start_date)
+        if not bus_id.strip().isdigit() or int(bus_id) not in bus_ids:
+            errors.append(f"Line {line}: no bus with bus ID {bus_id}")
+        elif status not in ("Book", "Cancel"):
+            errors.append(f"Line {line}: {status} is not Book or Cancel")
+        elif start == None or end == None or start > end:
+            errors.append(f"Line {line}: invalid dates {start_date}{f'-{end_date}' if end_date else ''}")
+        else:
+            entries.append((int(bus_id), start.strftime("%d%m%y"), end.strftime("%d%m%y"), 0 if status == "Book" else 1))
+
+    return entries, errors
+
+@timed
+@permissions_factory("admin")
+@restricted
+async def import_schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Book / cancel many buses for many periods at once, from a message or a CSV file
+    """
+    print("COMMAND: import schedule")
+
+    chat_id = update.effective_chat.id
+
+    queue_message(
+        chat_id = chat_id,
+        text = IMPORT_SCHEDULE_MSG,
+    )
+
+    return IMPORT
+
+@timed
+async def import_schedule_entries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Validates every entry before saving any, saves them in a single transaction,
+    then cleans the schedule of only the buses imported.
+    """
+    chat_id = update.effective_chat.id
+
+    # Get entries, from lines of "<bus ID> <Book/Cancel> <date or date range>" or a CSV file
+    rows = []
+    if update.message.document:
+        if update.message.document.file_size > IMPORT_MAX_FILE_SIZE:
+            queue_message(
+                chat_id = chat_id,
+                text = IMPORT_FILE_TOO_LARGE_MSG
+            )
+            return IMPORT
+        file = await update.message.document.get_file()
+        data = await file.download_as_bytearray()
+
+        # Same columns as /export schedule, other columns are ignored
+        try:
+            reader = csv.DictReader(data.decode("utf-8-sig").splitlines())
+            if not {"bus_id", "status", "start_date"} <= set(reader.fieldnames or []):
+                raise ValueError("missing columns")
+            for line, row in enumerate(reader, 2):
+                rows.append((line, row["bus_id"] or "", row["status"] or "", row["start_date"] or "", row.get("end_date")))
+        except (ValueError, csv.Error) as e: # Includes files which are not UTF-8
+            print(e)
+            queue_message(
+                chat_id = chat_id,
+                text = IMPORT_SCHEDULE_MSG
+            )
+            return IMPORT
+    else:
+        for line, text in enumerate(update.message.text.split("\n"), 1):
+            if text.strip():
+                bus_id, _, rest = text.strip().partition(" ")
+                status, _, dates = rest.strip().partition(" ")
+                match = re.fullmatch(IMPORT_DATES_PATTERN, dates.strip())
+                start_date, end_date = match.groups() if match else (dates.strip(), None)
+                rows.append((line, bus_id, status, start_date, end_date))
+
+    entries, errors = parse_schedule(rows)
+    if errors or not entries:
+        text = INVALID_SCHEDULE_DATE_MSG
+        for error in errors[:IMPORT_MAX_ERRORS]:
+            text = f"{text}\n{error}"
+        if len(errors) > IMPORT_MAX_ERRORS:
+            text = f"{text}\n... and {len(errors) - IMPORT_MAX_ERRORS} more"
+        queue_message(
+            chat_id = chat_id,
+            text = text
+        )
+        return IMPORT
+
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    cur.executemany("INSERT INTO schedule VALUES (?, ?, ?, ?)", entries)
+    con.commit()
+
+    con.close()
+
+    # Clean schedule, once for all buses imported
+    bus_ids = sorted(set(entry[0] for entry in entries))
+    await clean_schedule(bus_ids = bus_ids)
+
+    queue_message(
+        chat_id = chat_id,
+        text = f"Schedule updated with {len(entries)} entries for {len(bus_ids)} buses."
+    )
+
+    return ConversationHandler.END
+
+import_schedule_handler = ConversationHandler(
+    entry_points = [CommandHandler("import_schedule", import_schedule_command)],
+    states = {
+        IMPORT: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.FileExtension("csv"), import_schedule_entries),
+                 MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
+        ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]},
+    fallbacks = [CommandHandler("cancel", cancel)],
+    conversation_timeout = 120
+)
+
+@timed
+async def daily_booking(context: ContextTypes.DEFAULT_TYPE, bus_ids=None):
     """
-    Initiates / cancels daily booking for all chats.
+    Initiates / cancels daily booking for the given buses (all buses if not given).
     Cleans up the schedule.
     """
     print("DAILY BOOKING START")
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Get all buses to send booking messages for
-    res = cur.execute("SELECT bus_id, chat_id, time FROM buses")
+    if bus_ids == None:
+        res = cur.execute("SELECT bus_id, chat_id, time FROM buses")
+    else:
+        res = cur.execute(f"SELECT bus_id, chat_id, time FROM buses \
+                          WHERE bus_id IN ({', '.join(map(str, bus_ids))})")
     buses = res.fetchall()
 
     date = datetime.today() + timedelta(1)
@@ -1516,160 +2233,271 @@ async def daily_booking(context: ContextTypes.DEFAULT_TYPE):
     for bus in buses:
         bus_id, chat_id, t = bus[0], bus[1], bus[2]
 
-        if chat_id not in context.bot_data.keys():
-            print(f"Unable to send bookings messages to chat {chat_id} as bot was not started.")
-            continue
+        try: # An error for one bus, e.g. the bot was removed from its chat, must not stop the other buses
+            # Check for any overwrites
+            res = cur.execute(f"SELECT start_date, end_date, status FROM schedule \
+                              WHERE bus_id={bus_id}")
+            overwrites = res.fetchall()
 
-        # Check for any overwrites
-        res = cur.execute(f"SELECT start_date, end_date, status FROM schedule \
-                          WHERE bus_id={bus_id}")
-        overwrites = res.fetchall()
-
-        flag = False
-        for i in overwrites:
-            start_date, end_date, status = datetime.strptime(i[0], "%d%m%y"), datetime.strptime(i[1], "%d%m%y"), i[2]
-            if date.date() >= start_date.date() and date.date() <= end_date.date():
-                print(status)
-                if status == 0:
-                    await book_job(context, chat_id, t)
-                else:
-                    await context.bot.send_message(
-                        chat_id = chat_id,
-                        text = f"Dear all, the bus at {t} will not be running tomorrow." # OVERWRITE_FALSE_MSG
-                    )
+            flag = False
+            for i in overwrites:
+                start_date, end_date, status = datetime.strptime(i[0], "%d%m%y"), datetime.strptime(i[1], "%d%m%y"), i[2]
+                if date.date() >= start_date.date() and date.date() <= end_date.date():
+                    print(status)
+                    if status == 0:
+                        await book_job(context, chat_id, t, bus_id)
+                    else:
+                        queue_message(
+                            chat_id = chat_id,
+                            text = f"Dear all, the bus at {t} will not be running tomorrow." # OVERWRITE_FALSE_MSG
+                        )
 
-                flag = True
-                break
+                    flag = True
+                    break
 
-        if flag:
-            continue
-              
-        # Check for weekends
-        day = date.weekday()
-        if day == 5 or day == 6: # Don't send if the next day is Sat or Sun
-            return
-        
-        # Send if it's a regular day
-        await book_job(context, chat_id, t)
+            if flag:
+                continue
+                  
+            # Check for weekends
+            day = date.weekday()
+            if day == 5 or day == 6: # Don't send if the next day is Sat or Sun
+                continue
+            
+            # Send if it's a regular day
+            await book_job(context, chat_id, t, bus_id)
+        except Exception as e:
+            print(f"Failed to open registration for bus {bus_id}.")
+            print(e)
 
     con.close()
 
     # Clean the schedule
-    await clean_schedule()
+    await clean_schedule(bus_ids)
 
-async def book_job(context: ContextTypes.DEFAULT_TYPE, chat_id, t):
+async def book_job(context: ContextTypes.DEFAULT_TYPE, chat_id, t, bus_id=None):
     """
     Sends a message to book shuttle bus slots for a day.
+    The book_id is allocated by the database, so it is unique across worker processes.
     """
-    chat_data = context.bot_data[chat_id]
-
     # Get date
     date = datetime.today() + timedelta(1)
     date = date.strftime("%d %b %y")
-    
-    # Send registration message
-    message, book_id = await registration_message(context, chat_id, date, t)
-
-    # Update data
-    chat_data["bookings"][message.message_id] = {
-        "book_id": book_id,
-        "bookings": 0,
-        "users": [],
-        "date": date,
-        "time": t
-    }
-    payload = {
-        chat_id: chat_data
-    }
-    context.bot_data.update(payload)
-    print(context.bot_data)
 
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+
+    # Check registration has not already been opened, e.g. by another worker process
+    if bus_id != None:
+        res = cur.execute("SELECT EXISTS (SELECT 1 FROM registrations WHERE bus_id=? AND date=?)", (bus_id, date))
+        if res.fetchone()[0]:
+            print(f"Registration for bus {bus_id} on {date} is already open.")
+            con.close()
+            return
 
     # Update database
-    cur.execute(f"INSERT INTO ridership VALUES \
-                ({book_id}, {chat_id}, '{date}', '{t}', 0)")
+    res = cur.execute("INSERT INTO ridership (chat_id, date, time, riders) VALUES (?, ?, ?, 0)", 
+                      (chat_id, date, t))
+    book_id = res.lastrowid
+    cur.execute("INSERT INTO registrations (book_id, chat_id, bus_id, date, time) VALUES (?, ?, ?, ?, ?)", 
+                (book_id, chat_id, bus_id, date, t))
     con.commit()
 
     con.close()
+    
+    # Send registration message
+    message = None
+    try:
+        message = await registration_message(context, get_registration(book_id))
+    finally:
+        if message == None:
+            # Remove the registration, as riders cannot register without the message
+            print(f"Registration {book_id} removed, as its message could not be sent to chat {chat_id}.")
+            con = connect()
+            cur = con.cursor()
+            cur.execute(f"DELETE FROM registrations WHERE book_id={book_id}")
+            cur.execute(f"DELETE FROM ridership WHERE book_id={book_id}")
+            con.commit()
+            con.close()
 
-async def end_book_job(context: ContextTypes.DEFAULT_TYPE):
+async def end_registrations(context: ContextTypes.DEFAULT_TYPE, condition):
     """
-    Ends all registrations
+    Ends open registrations matching an SQL condition on the registrations table (r).
+    Saves the ridership and booking history, closes the registration messages and sends tokens, combining all registrations of a user into one message.
+    Registrations are removed in a single transaction, so each registration is only ended once.
+    Returns the registrations which were ended.
     """
-    print("DAILY BOOKING END")
-
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
 
-    # Get all chats to send booking messages for
-    res = cur.execute("SELECT chat_id, pickup, destination, chat_type FROM settings")
-    chats = res.fetchall()
+    registrations = get_registrations(cur, condition)
 
-    date = datetime.today() + timedelta(1)
-    date = date.strftime("%d %b %y")
+    # Update database
+    if registrations:
+        book_ids = ", ".join(str(registration["book_id"]) for registration in registrations)
+        cur.executemany("UPDATE ridership SET riders=? WHERE book_id=?", 
+                        [(len(registration["users"]), registration["book_id"]) for registration in registrations])
+        add_to_rollup(cur, registrations)
+        cur.execute(f"INSERT INTO bookings \
+                    SELECT r.book_id, r.user_id, r.username, iso_date(g.date), r.booked_at, NULL \
+                    FROM riders r JOIN registrations g ON r.book_id=g.book_id \
+                    WHERE r.book_id IN ({book_ids}) \
+                    ON CONFLICT (book_id, user_id) DO UPDATE SET \
+                    username=excluded.username, booked_at=excluded.booked_at, cancelled_at=NULL") # Booked again after cancelling
+        cur.execute(f"DELETE FROM riders WHERE book_id IN ({book_ids})")
+        cur.execute(f"DELETE FROM turned_away WHERE book_id IN ({book_ids})")
+        cur.execute(f"DELETE FROM registrations WHERE book_id IN ({book_ids})")
+    con.commit()
 
-    for chat in chats:
-        chat_id, pickup, destination, chat_type = chat[0], chat[1], chat[2], chat[3]
-        chat_data = context.bot_data[chat_id]
+    con.close()
 
-        if chat_type == "Admin":
-            continue
+    # Confirmed registrations for each user, so every user gets a single token
+    tokens = {}
 
-        if not chat_data["bookings"]: # Will return false if dictionary is empty
-            print("No bookings")
-            continue
+    for registration in registrations:
+        # Remove reply_markup so users cannot reply
+        registration["closed"] = True
+        await registration_message(context, registration)
 
-        for message_id in chat_data["bookings"].keys():
+        # Collect tokens
+        for user in registration["users"]:
+            tokens.setdefault(user["id"], []).append((registration["pickup"], 
+                                                      registration["destination"], 
+                                                      registration["date"], 
+                                                      registration["time"]))
 
-            # Remove reply_markup so users cannot reply
-            await registration_message(context, 
-                                    chat_id, 
-                                    message_id=message_id,
-                                    close=True
-                                    )
-            
-            # Update database
-            book_id = chat_data["bookings"][message_id]["book_id"]
-            bookings = chat_data["bookings"][message_id]["bookings"]
-            cur.execute(f"UPDATE ridership SET \
-                        riders={bookings} \
-                        WHERE book_id={book_id}")
-            con.commit()
-                
-            # Send tokens
-            time = chat_data["bookings"][message_id]["time"]
-            booking_token = f"Your registration for the shuttle bus from {pickup} to {destination} for {date} at time {time} has been confirmed."
-            for user in chat_data["bookings"][message_id]["users"]:
-                try:
-                    await context.bot.send_message(
-                        chat_id = user["id"],
-                        text = booking_token
-                    )
-                except Exception as e:
-                    print(f"Failed to send token to user {user['username']} (id: {user['id']}) as user did not initiate conversation with bot.")
-                    print(e)
-
-        # Delete data
-        chat_data["bookings"] = {}
-        payload = {
-            chat_id: chat_data
-        }
-        context.bot_data.update(payload)
-        print(context.bot_data)
+    # Send tokens
+    for user_id, user_registrations in tokens.items():
+        if len(user_registrations) == 1:
+            pickup, destination, date, t = user_registrations[0]
+            booking_token = f"Your registration for the shuttle bus from {pickup} to {destination} for {date} at time {t} has been confirmed."
+        else:
+            booking_token = TOKENS_MSG
+            for pickup, destination, date, t in user_registrations:
+                booking_token = f"{booking_token}\n - {pickup} to {destination} for {date} at {t}"
+
+        queue_message(
+            chat_id = user_id,
+            text = booking_token
+        ) # Dropped by the outbox if user did not initiate conversation with bot
+
+    riders = sum(len(i) for i in tokens.values())
+    print(f"Sent {len(tokens)} tokens for {riders} registrations, saving {riders - len(tokens)} API calls.")
+
+    return registrations
+
+@timed
+async def end_book_job(context: ContextTypes.DEFAULT_TYPE, bus_ids=None):
+    """
+    Ends registrations for the given buses (all registrations if not given).
+    Registrations opened with /book have no bus, and are ended when None is in bus_ids, 
+    as are registrations of buses which were removed.
+    """
+    print("DAILY BOOKING END")
+
+    # Get bookings to end
+    if bus_ids == None:
+        condition = "1"
+    else:
+        conditions = [f"r.bus_id IN ({', '.join(str(i) for i in bus_ids if i != None)})"]
+        if None in bus_ids:
+            conditions.append("r.bus_id IS NULL OR r.bus_id NOT IN (SELECT bus_id FROM buses)")
+        condition = " OR ".join(conditions)
+
+    registrations = await end_registrations(context, condition)
+    if not registrations:
+        print("No bookings")
+
+    # Notif message, once for each chat
+    for chat_id in dict.fromkeys(registration["chat_id"] for registration in registrations):
+        queue_message(
+            chat_id = chat_id,
+            text = END_NOTIF_MSG
+        )
+
+@timed
+async def end_removed_buses(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Ends open registrations of buses which were removed, as their close time is no longer scheduled.
+    Must be called whenever buses are removed, after the change is saved.
+    """
+    registrations = await end_registrations(context, "r.bus_id NOT IN (SELECT bus_id FROM buses)")
+
+    # Notif message, once for each chat
+    for chat_id in dict.fromkeys(registration["chat_id"] for registration in registrations):
+        queue_message(
+            chat_id = chat_id,
+            text = END_NOTIF_MSG
+        )
+
+def due_registration_events(since, now):
+    """
+    Helper function to find the registrations to open and close at times after since, up to now, 
+    based on the windows of every bus.
+    Registrations are only opened on the day their window opens, as they are for the next day.
+    Returns {"open": [bus_id, ...], "close": [bus_id, ...]}, where None in "close" ends registrations opened with /book.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT bus_id, open_time, close_time FROM buses")
+    buses = res.fetchall()
 
-        # Notif message
-        await context.bot.send_message(chat_id = chat_id,
-                                        text = END_NOTIF_MSG)
-        
     con.close()
+
+    tz = pytz.timezone(TIMEZONE)
+    def due(t, days):
+        for day in days:
+            run = tz.localize(datetime.combine(day, datetime.strptime(t, "%H%M").time()))
+            if since < run <= now:
+                return True
+        return False
+
+    today, yesterday = now.date(), now.date() - timedelta(1)
+    events = {"open": [], "close": []}
+    if due(DEFAULT_CLOSE_TIME, [yesterday, today]): # Registrations opened with /book
+        events["close"].append(None)
+    for bus_id, open_time, close_time in buses:
+        if due(open_time, [today]):
+            events["open"].append(bus_id)
+        if due(close_time, [yesterday, today]):
+            events["close"].append(bus_id)
+    return events
+
+@timed
+async def registration_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Opens and closes registrations due since the last run, every REGISTRATION_CHECK_INTERVAL seconds.
+    Bus timings are read from the database on every run, so changes made through any worker are picked up.
+    When running multiple workers, only the holder of the job lock opens and closes registrations, 
+    and catches up on events missed while no worker held it, up to REGISTRATION_CATCH_UP seconds back.
+    """
+    if not is_job_leader():
+        return
+
+    now = datetime.now(pytz.timezone(TIMEZONE))
+    since = now - timedelta(seconds=REGISTRATION_CATCH_UP)
+    last_run = get_meta("registration_job_time")
+    if last_run is not None:
+        since = max(since, datetime.fromisoformat(last_run))
+    set_meta("registration_job_time", now.isoformat()) # Before running, so that no event runs twice
+
+    events = due_registration_events(since, now)
+    if events["close"] or events["open"]:
+        print(f"Registration events due: {events}")
+    if events["close"]:
+        await end_book_job(context, events["close"])
+    if events["open"]:
+        await daily_booking(context, events["open"])
     
 ## BROADCAST / NOTIFICATION
 CONFIRM, SENT = range(13, 15) # States for broadcast conversation handler
 
+@timed
 @permissions_factory("admin")
 @restricted
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1681,7 +2509,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Send message
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = BROADCAST_PROMPT_MSG
     )
@@ -1703,7 +2531,7 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
          KeyboardButton("No")]
     ]
     reply_markup = ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = text,
         reply_markup = reply_markup
@@ -1715,6 +2543,7 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return SENT
 
+@timed
 async def broadcast_sent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Send a confirmation message for the broadcast.
@@ -1725,13 +2554,13 @@ async def broadcast_sent(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if message == "Yes":
         # Notif Message
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = BROADCAST_SENT_MSG
         )
         
         # Connect to DB
-        con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+        con = connect()
         cur = con.cursor()
 
         res = cur.execute("SELECT chat_id, chat_type FROM settings")
@@ -1742,7 +2571,7 @@ async def broadcast_sent(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Send message to every service chat
         for chat in data:
             if chat[1] == "service":
-                await context.bot.send_message(
+                queue_message(
                     chat_id = chat[0],
                     text = context.user_data["broadcast"]
                 )
@@ -1753,7 +2582,7 @@ async def broadcast_sent(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     else: # if message = "No"
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat_id,
             text = BROADCAST_PROMPT_MSG
         )
@@ -1772,6 +2601,7 @@ broadcast_handler = ConversationHandler(
     conversation_timeout = 60,
 )
 
+@timed
 @permissions_factory("admin | service")
 @restricted
 async def notify_late(update: Update, context: ContextTypes.DEFAULT_TYPE, all_chats=False):
@@ -1782,122 +2612,670 @@ async def notify_late(update: Update, context: ContextTypes.DEFAULT_TYPE, all_ch
     
     chats = [chat_id]
     if all_chats:
-        chats = context.bot_data.keys()
+        # Connect to DB
+        con = connect()
+        cur = con.cursor()
+
+        res = cur.execute("SELECT chat_id FROM settings")
+        chats = [chat[0] for chat in res.fetchall()]
+
+        con.close()
 
     for chat in chats:
-        await context.bot.send_message(
+        queue_message(
             chat_id = chat,
             text = NOTIFY_LATE_MSG
         )
 
 
 ### DATA AND STATISTICS
+WEEKDAYS = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"] # In the order of SQLite's strftime('%w')
+
+@versioned(maxsize=RESULT_CACHE_SIZE)
+def get_ridership_summary(start_date=None, end_date=None):
+    """
+    Helper function to summarise the ridership of all service chats in a single query on the ridership_daily rollup.
+    Dates are YYYY-MM-DD and inclusive, and default to all dates.
+    Returns rows of (grouping, chat_id, pickup, destination, key, riders, days, buses, capacity), where grouping is:
+     - "route": for each service chat (also those without ridership)
+     - "time": for each bus time of each service chat, key is the time
+     - "weekday": for each day of the week, key is 0 (Sunday) to 6
+     - "total": across all service chats, key is the first and last date with ridership
+    Results are cached until the data version changes.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("WITH rides AS MATERIALIZED ( \
+                          SELECT d.chat_id, d.time, d.date AS day, d.riders, d.buses, d.capacity \
+                          FROM ridership_daily d JOIN settings s ON d.chat_id=s.chat_id \
+                          WHERE LOWER(s.chat_type)='service' AND d.date BETWEEN ? AND ? \
+                      ) \
+                      SELECT 'route', s.chat_id, s.pickup, s.destination, NULL, \
+                          TOTAL(rides.riders), COUNT(DISTINCT rides.day), TOTAL(rides.buses), TOTAL(rides.capacity) \
+                          FROM settings s LEFT JOIN rides ON s.chat_id=rides.chat_id \
+                          WHERE LOWER(s.chat_type)='service' GROUP BY s.chat_id \
+                      UNION ALL \
+                      SELECT 'time', chat_id, NULL, NULL, time, \
+                          TOTAL(riders), COUNT(DISTINCT day), TOTAL(buses), TOTAL(capacity) \
+                          FROM rides GROUP BY chat_id, time \
+                      UNION ALL \
+                      SELECT 'weekday', NULL, NULL, NULL, CAST(strftime('%w', day) AS INTEGER), \
+                          TOTAL(riders), COUNT(DISTINCT day), TOTAL(buses), TOTAL(capacity) \
+                          FROM rides GROUP BY strftime('%w', day) \
+                      UNION ALL \
+                      SELECT 'total', NULL, NULL, NULL, MIN(day) || ' to ' || MAX(day), \
+                          TOTAL(riders), COUNT(DISTINCT day), TOTAL(buses), TOTAL(capacity) \
+                          FROM rides",
+                      (start_date or "0000-00-00", end_date or "9999-99-99"))
+    rows = res.fetchall()
+
+    con.close()
+    return rows
+
+def format_ridership_summary(rows):
+    """
+    Helper function to render the rows of get_ridership_summary into text, which may need to be split into several messages.
+    """
+    routes = {row[1]: row for row in rows if row[0] == "route"}
+    total = [row for row in rows if row[0] == "total"][0]
+    if total[7] == 0:
+        return NO_DATA_MSG
+
+    _, _, _, _, dates, riders, days, buses, capacity = total
+    text = f"Ridership from {dates}: {riders:.0f} riders on {buses:.0f} buses over {days} days"
+    if capacity:
+        text += f", {riders / capacity:.0%} of capacity"
+    text += ".\n\n"
+
+    # Averages for each route, and each bus time of the route
+    text += "Average daily riderships across bus services:"
+    for chat_id, route in routes.items():
+        _, _, pickup, destination, _, riders, days, _, _ = route
+        avg = riders / days if days else 0
+        text += f"\n{pickup} -> {destination}: {avg:.1f}"
+
+        for row in rows:
+            if row[0] == "time" and row[1] == chat_id:
+                text += f"\n   {row[4]}: {row[5] / row[7]:.1f} per bus"
+
+    # Weekday distribution
+    text += "\n\nAverage daily riderships by day of the week:"
+    for row in sorted((row for row in rows if row[0] == "weekday"), key=lambda row: (row[4] - 1) % 7): # Monday first
+        text += f"\n{WEEKDAYS[row[4]]}: {row[5] / row[6]:.1f} ({row[5]:.0f} riders over {row[6]} days)"
+
+    return text
+
+@timed
 @permissions_factory("admin")
 @restricted
 async def view_data_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Sends a message displaying the ridership stats.
-     - Average ridership / day for each service (overall for all bus timings)
+    Sends a message displaying the ridership stats, optionally for a date range (DDMMYY-DDMMYY).
+     - Average ridership / day for each service, and for each of its bus timings
+     - Average ridership / day for each day of the week
+     - Totals
     """
     print("COMMAND: view data summary")
 
     chat_id = update.effective_chat.id
 
+    # Get date range
+    start_date, end_date = None, None
+    if context.args:
+        try:
+            start, end = context.args[0].split("-")
+            start_date = datetime.strptime(start, "%d%m%y").strftime("%Y-%m-%d")
+            end_date = datetime.strptime(end, "%d%m%y").strftime("%Y-%m-%d")
+        except ValueError:
+            queue_message(
+                chat_id = chat_id,
+                text = DATA_SUMMARY_USAGE_MSG
+            )
+            return
+
+    text = format_ridership_summary(get_ridership_summary(start_date, end_date))
+    
+    # Send messages, split as there is a line for every route and bus time
+    for message in split_message(text):
+        queue_message(
+            chat_id = chat_id,
+            text = message
+        )
+
+@timed
+@permissions_factory("admin")
+@restricted
+async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Sends a message with utilisation statistics, optionally for a date range (DDMMYY-DDMMYY).
+     - Fill rate, days with a full bus and 90th percentile riders per bus for each service
+     - Fill rate for each day of the week and bus time
+    """
+    print("COMMAND: analytics")
+
+    chat_id = update.effective_chat.id
+
+    # Get date range
+    start_date, end_date = None, None
+    if context.args:
+        try:
+            start, end = context.args[0].split("-")
+            start_date = datetime.strptime(start, "%d%m%y").strftime("%Y-%m-%d")
+            end_date = datetime.strptime(end, "%d%m%y").strftime("%Y-%m-%d")
+        except ValueError:
+            queue_message(
+                chat_id = chat_id,
+                text = ANALYTICS_USAGE_MSG
+            )
+            return
+
+    # Computed in a thread, so other updates are not held up
+    messages = await asyncio.to_thread(analytics_report, start_date, end_date)
+    
+    # Send messages
+    for text in messages or [NO_DATA_MSG]:
+        queue_message(
+            chat_id = chat_id,
+            text = text,
+            parse_mode = "HTML"
+        )
+
+@timed
+@permissions_factory("admin")
+@restricted
+async def backfill_ridership_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Rebuilds the ridership_daily rollup from the ridership and ridership_archive tables, e.g. for ridership saved before the rollup existed.
+    Capacity of past buses is taken from the current max riders of each chat.
+    Riders turned away from past buses are not saved in the ridership table, so they are lost.
+    """
+    print("COMMAND: backfill ridership")
+
+    chat_id = update.effective_chat.id
+
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE") # Registrations ending in the meantime would be counted twice
+
+    cur.execute("DELETE FROM ridership_daily")
+    res = cur.execute("INSERT INTO ridership_daily \
+                      SELECT r.chat_id, r.time, iso_date(r.date), SUM(r.riders), COUNT(*), COUNT(*) * IFNULL(s.max_riders, 0), 0, ? \
+                      FROM (SELECT * FROM ridership UNION ALL SELECT * FROM ridership_archive) r \
+                      LEFT JOIN settings s ON r.chat_id=s.chat_id \
+                      WHERE iso_date(r.date) IS NOT NULL \
+                      AND r.book_id NOT IN (SELECT book_id FROM registrations) \
+                      GROUP BY r.chat_id, r.time, iso_date(r.date)", (time.time(),))
+    rows = res.rowcount
+    bump_data_version(cur)
+    cur.execute("DELETE FROM meta WHERE key='recommendations_time'") # Recommendations are recomputed for every chat
+    con.commit()
 
-    res = cur.execute("SELECT chat_id FROM settings WHERE chat_type='service'")
-    chat_ids = res.fetchall()
-    chat_ids = [chat[0] for chat in chat_ids]
+    con.close()
 
-    # Get averages for each chat_id
-    text = "Average daily riderships across bus services: \n"
-    for chat in chat_ids:
-        # Get average
-        res = cur.execute(f"SELECT date, SUM(riders) FROM ridership WHERE chat_id={chat} GROUP BY date")
-        riders = res.fetchall()
+    # Notif Message
+    queue_message(
+        chat_id = chat_id,
+        text = f"Daily ridership rebuilt, {rows} rows."
+    )
 
-        if len(riders) == 0:
-            avg = 0
-        else:
-            s = sum([r[1] for r in riders])
-            l = len(riders)
-            avg = s / l
+def recommendation_inputs(cur, chat_id):
+    """
+    Helper function to get what the recommendations of a chat are computed from, besides its ridership rows: 
+    the last time its rollup rows changed, its max riders and its bus times.
+    """
+    res = cur.execute(f"SELECT MAX(updated_at) FROM ridership_daily WHERE chat_id={chat_id}")
+    updated_at = res.fetchone()[0]
+    res = cur.execute(f"SELECT max_riders FROM settings WHERE chat_id={chat_id}")
+    max_riders = (res.fetchone() or [None])[0]
+    res = cur.execute(f"SELECT time FROM buses WHERE chat_id={chat_id}")
+    bus_times = set(i[0] for i in res.fetchall())
+    return updated_at, max_riders, bus_times
+
+def update_recommendations():
+    """
+    Recomputes the capacity recommendations of service chats from their last RECOMMENDATIONS_WEEKS of ridership_daily.
+    Only chats whose rollup rows changed since the last run (for any date), or whose oldest rows have left the window since, 
+    are recomputed, so each run only reads the chats which changed. Every chat is recomputed if there was no last run.
+    Recommendations are computed without the write lock, then saved in one short transaction for the chats which 
+    did not change in the meantime. The last run is only moved on once every changed chat is saved.
+    Returns the number of chats updated.
+    """
+    start_date = (datetime.now(pytz.timezone(TIMEZONE)) - timedelta(weeks=RECOMMENDATIONS_WEEKS)).strftime("%Y-%m-%d")
+    now = time.time() # Before reading, so rollup rows changed during this run are marked later
+
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
 
-        # Get pickup and destination
-        res = cur.execute(f"SELECT pickup, destination FROM settings \
-                          WHERE chat_id={chat}")
-        data = res.fetchone()
-        pickup, destination = data[0], data[1]
+    res = cur.execute("SELECT key, value FROM meta WHERE key IN ('recommendations_time', 'recommendations_start')")
+    last_run = dict(res.fetchall())
+    last_time = float(last_run.get("recommendations_time", 0))
 
-        # Add to text
-        text = f"{text}\n{pickup} -> {destination}: {avg}"
+    if "recommendations_time" in last_run:
+        res = cur.execute("SELECT s.chat_id FROM settings s \
+                          WHERE LOWER(s.chat_type)='service' AND EXISTS \
+                          (SELECT 1 FROM ridership_daily d WHERE d.chat_id=s.chat_id \
+                          AND (d.updated_at > ? OR (d.date >= ? AND d.date < ?)))", 
+                          (last_time, last_run.get("recommendations_start", start_date), start_date))
+    else:
+        res = cur.execute("SELECT chat_id FROM settings WHERE LOWER(chat_type)='service'")
+    chats = [i[0] for i in res.fetchall()]
+
+    recommendations = {}
+    for chat_id in chats:
+        inputs = recommendation_inputs(cur, chat_id)
+        res = cur.execute("SELECT time, date, riders, buses, capacity, turned_away FROM ridership_daily \
+                          WHERE chat_id=? AND date >= ?", (chat_id, start_date))
+        rows = res.fetchall()
+        recommendations[chat_id] = (inputs, recommend(rows, inputs[1], inputs[2]))
+
+    cur.execute("BEGIN IMMEDIATE")
+
+    # Chats which changed since they were read, and rollup rows which were not committed yet when chats were found
+    changed = [chat_id for chat_id, (inputs, _) in recommendations.items() if recommendation_inputs(cur, chat_id) != inputs]
+    res = cur.execute("SELECT DISTINCT d.chat_id FROM ridership_daily d JOIN settings s ON d.chat_id=s.chat_id \
+                      WHERE LOWER(s.chat_type)='service' AND d.updated_at > ? AND d.updated_at <= ?", (last_time, now))
+    missed = [i[0] for i in res.fetchall() if i[0] not in recommendations]
+
+    for chat_id, (_, chat_recommendations) in recommendations.items():
+        if chat_id in changed:
+            continue
+        cur.execute(f"DELETE FROM recommendations WHERE chat_id={chat_id}")
+        cur.executemany("INSERT INTO recommendations VALUES (?, ?, ?, ?)", 
+                        [(chat_id, kind, value, reason) for kind, value, reason in chat_recommendations])
+
+    if changed or missed:
+        print(f"Recommendations of {len(changed) + len(missed)} chats changed while updating, left for the next run.")
+    else:
+        cur.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", 
+                        [("recommendations_time", str(now)), ("recommendations_start", start_date)])
+    con.commit()
 
     con.close()
-    
-    # Send messages
-    await context.bot.send_message(
+    return len(recommendations) - len(changed)
+
+@timed
+async def recommendations_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Daily job updating capacity recommendations, which admins apply from /settings.
+    """
+    if not is_job_leader():
+        return
+
+    # Computed in a thread, so other updates are not held up
+    chats = await asyncio.to_thread(update_recommendations)
+    print(f"Updated recommendations for {chats} chats.")
+
+def archive_ridership(cutoff):
+    """
+    Moves one batch of ridership before cutoff (YYYY-MM-DD) to ridership_archive.
+    The batch is found before taking the write lock, so other writers are only held up while it is moved, 
+    not while the ridership table is scanned.
+    Returns the number of rows archived.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    # Oldest rows first, so the scan stops early while there is ridership to archive
+    res = cur.execute(f"SELECT book_id FROM ridership \
+                      WHERE iso_date(date) < ? \
+                      AND book_id NOT IN (SELECT book_id FROM registrations) \
+                      ORDER BY book_id LIMIT {RIDERSHIP_COMPACTION_BATCH_SIZE}", (cutoff,))
+    book_ids = ", ".join(str(i[0]) for i in res.fetchall())
+
+    rows = 0
+    if book_ids:
+        cur.execute("BEGIN IMMEDIATE")
+        condition = f"book_id IN ({book_ids}) AND book_id NOT IN (SELECT book_id FROM registrations)" # Checked again under the lock
+        cur.execute(f"INSERT INTO ridership_archive SELECT * FROM ridership WHERE {condition}")
+        res = cur.execute(f"DELETE FROM ridership WHERE {condition}")
+        rows = res.rowcount
+        con.commit()
+
+    con.close()
+    return rows
+
+@timed
+async def compact_ridership_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Daily job moving ridership older than RIDERSHIP_RETENTION_MONTHS full months to the archive,
+    in batches of RIDERSHIP_COMPACTION_BATCH_SIZE, so that the database is never locked for long.
+    Archived ridership stays in ridership_daily and exports.
+    """
+    if not is_job_leader():
+        return
+
+    # First day of the oldest month kept
+    today = datetime.now(pytz.timezone(TIMEZONE)).date()
+    months = today.year * 12 + today.month - 1 - RIDERSHIP_RETENTION_MONTHS
+    cutoff = f"{months // 12:04d}-{months % 12 + 1:02d}-01"
+
+    archived = 0
+    while True:
+        rows = await asyncio.to_thread(archive_ridership, cutoff)
+        archived += rows
+        if rows < RIDERSHIP_COMPACTION_BATCH_SIZE:
+            break
+        await asyncio.sleep(RIDERSHIP_COMPACTION_PAUSE)
+    print(f"Archived {archived} rows of ridership before {cutoff}.")
+
+EXPORTS = {
+    "ridership": "SELECT r.book_id, r.chat_id, s.pickup, s.destination, iso_date(r.date) AS date, r.time, r.riders \
+                  FROM (SELECT * FROM ridership UNION ALL SELECT * FROM ridership_archive) r \
+                  LEFT JOIN settings s ON r.chat_id=s.chat_id \
+                  WHERE iso_date(r.date) BETWEEN :start AND :end AND (:chat_id IS NULL OR r.chat_id=:chat_id) \
+                  ORDER BY r.book_id",
+    "schedule": "SELECT sc.bus_id, b.chat_id, s.pickup, s.destination, b.time, \
+                 iso_date(sc.start_date) AS start_date, iso_date(sc.end_date) AS end_date, \
+                 CASE sc.status WHEN 0 THEN 'Book' ELSE 'Cancel' END AS status \
+                 FROM schedule sc JOIN buses b ON sc.bus_id=b.bus_id LEFT JOIN settings s ON b.chat_id=s.chat_id \
+                 WHERE iso_date(sc.end_date) >= :start AND iso_date(sc.start_date) <= :end \
+                 AND (:chat_id IS NULL OR b.chat_id=:chat_id) \
+                 ORDER BY sc.bus_id, iso_date(sc.start_date)",
+} # Queries for each export, filtered by date range and chat
+
+def write_export(f, table, params):
+    """
+    Helper function to write an export to the CSV file f, fetching EXPORT_CHUNK_SIZE rows at a time,
+    so that memory use does not grow with the number of rows.
+    Returns the number of rows written.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute(EXPORTS[table], params)
+    writer = csv.writer(f)
+    writer.writerow([column[0] for column in res.description])
+
+    count = 0
+    while True:
+        rows = res.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        writer.writerows(rows)
+        count += len(rows)
+
+    con.close()
+    return count
+
+@timed
+@permissions_factory("admin")
+@restricted
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Sends ridership or schedule data as a CSV file, optionally for a date range (DDMMYY-DDMMYY) and chat.
+    """
+    print("COMMAND: export")
+
+    chat_id = update.effective_chat.id
+
+    # Get table, date range and chat
+    args = context.args or []
+    params = {"start": "0000-00-00", "end": "9999-99-99", "chat_id": None}
+    try:
+        table = args[0].lower()
+        if table not in EXPORTS:
+            raise ValueError
+        for arg in args[1:]:
+            if "-" in arg[1:]: # Date range, not a (negative) chat ID
+                start, end = arg.split("-")
+                params["start"] = datetime.strptime(start, "%d%m%y").strftime("%Y-%m-%d")
+                params["end"] = datetime.strptime(end, "%d%m%y").strftime("%Y-%m-%d")
+            else:
+                params["chat_id"] = int(arg)
+    except (IndexError, ValueError):
+        queue_message(
+            chat_id = chat_id,
+            text = EXPORT_USAGE_MSG
+        )
+        return
+
+    # Write the export to a temporary file, in a thread so other updates are not held up
+    with tempfile.TemporaryFile("w+", newline="") as f:
+        count = await asyncio.to_thread(write_export, f, table, params)
+        f.seek(0)
+
+        # Sent directly, as the outbox only holds text messages
+        await context.bot.send_document(
+            chat_id = chat_id,
+            document = f.buffer,
+            filename = f"{table}.csv",
+            caption = f"{count} rows exported."
+        )
+
+@timed
+@permissions_factory("admin")
+@restricted
+async def chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Sends a chart of the daily riders of a service chat, for a date range (DDMMYY-DDMMYY) or the last CHART_DAYS days.
+    Charts already sent for the current ridership data are sent again by their file_id, instead of being uploaded.
+    """
+    print("COMMAND: chart")
+
+    chat_id = update.effective_chat.id
+
+    # Get chat and date range
+    args = context.args or []
+    today = datetime.now(pytz.timezone(TIMEZONE))
+    start_date = (today - timedelta(CHART_DAYS)).strftime("%Y-%m-%d")
+    end_date = today.strftime("%Y-%m-%d")
+    try:
+        target_chat_id = int(args[0])
+        if len(args) > 1:
+            start, end = args[1].split("-")
+            start_date = datetime.strptime(start, "%d%m%y").strftime("%Y-%m-%d")
+            end_date = datetime.strptime(end, "%d%m%y").strftime("%Y-%m-%d")
+    except (IndexError, ValueError):
+        queue_message(
+            chat_id = chat_id,
+            text = CHART_USAGE_MSG
+        )
+        return
+
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    data_version = get_data_version(cur)
+    res = cur.execute("SELECT file_id FROM charts \
+                      WHERE chat_id=? AND start_date=? AND end_date=? AND data_version=?",
+                      (target_chat_id, start_date, end_date, data_version))
+    data = res.fetchone()
+
+    con.close()
+
+    if data != None:
+        photo = data[0]
+    else:
+        # Rendered in a thread, so other updates are not held up
+        photo = await asyncio.to_thread(ridership_chart, target_chat_id, start_date, end_date, data_version)
+        if photo == None:
+            queue_message(
+                chat_id = chat_id,
+                text = NO_DATA_MSG
+            )
+            return
+
+    # Sent directly, as the outbox only holds text messages
+    message = await context.bot.send_photo(
         chat_id = chat_id,
-        text = text
+        photo = photo
     )
 
+    # Save the file_id of the uploaded chart
+    if data == None:
+        con = connect()
+        cur = con.cursor()
+        cur.execute("INSERT OR REPLACE INTO charts VALUES (?, ?, ?, ?, ?)",
+                    (target_chat_id, start_date, end_date, data_version, message.photo[-1].file_id))
+        con.commit()
+        con.close()
+
 QUERY = 14
 
+def run_query(sql, write=False, offset=0):
+    """
+    Helper function to run a query from the query console in its own connection.
+    The query is interrupted after QUERY_TIMEOUT seconds, and cannot change the database unless write is set.
+    Pages after the first are found by running the query again and skipping the rows before offset.
+    Returns the column names, up to QUERY_PAGE_SIZE rows from offset, whether there are more rows and the rows changed.
+    """
+    # Connect to DB
+    con = connect()
+    if not write:
+        con.execute("PRAGMA query_only=ON")
+    deadline = time.monotonic() + QUERY_TIMEOUT
+    con.set_progress_handler(lambda: time.monotonic() > deadline, QUERY_PROGRESS_STEPS) # Interrupts the query when true
+    cur = con.cursor()
+
+    try:
+        res = cur.execute(sql)
+        columns = [column[0] for column in res.description or []]
+        while offset > 0:
+            skipped = res.fetchmany(min(offset, QUERY_PAGE_SIZE))
+            if not skipped:
+                break
+            offset -= len(skipped)
+        rows = res.fetchmany(QUERY_PAGE_SIZE + 1) # One more row, to know if there is a next page
+        changes = con.total_changes
+        if write:
+            if changes > 0:
+                bump_data_version(cur) # Cached results are stale after a manual change
+            con.commit()
+    finally:
+        con.close()
+
+    return columns, rows[:QUERY_PAGE_SIZE], len(rows) > QUERY_PAGE_SIZE, changes
+
+def format_table(columns, rows):
+    """
+    Helper function to render query results as a fixed width table, shortening values to QUERY_CELL_WIDTH.
+    """
+    def cell(value):
+        value = "NULL" if value is None else str(value).replace("\n", " ")
+        return value if len(value) <= QUERY_CELL_WIDTH else f"{value[:QUERY_CELL_WIDTH - 1]}~"
+
+    table = [[cell(column) for column in columns]] + [[cell(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(columns))]
+    lines = [" | ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in table]
+    lines.insert(1, "-+-".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+async def query_page(sql, write, offset, query_id):
+    """
+    Runs a query from the query console in a thread, so that other updates are not held up.
+    Returns the HTML message and Prev / Next buttons for the page of results from offset.
+    """
+    try:
+        columns, rows, more, changes = await asyncio.to_thread(run_query, sql, write, offset)
+    except Exception as e:
+        return (QUERY_TIMEOUT_MSG if str(e) == "interrupted" else escape(str(e))), None
+
+    if not columns:
+        return f"Query executed, {changes} rows changed.", None
+
+    # Drop rows from the end until the table fits in a message
+    text = ""
+    for shown in range(len(rows), -1, -1):
+        header = f"Rows {offset + 1} to {offset + shown}" if shown else "No rows"
+        text = f"{header}:\n<pre>{escape(format_table(columns, rows[:shown]))}</pre>"
+        if len(text) <= MESSAGE_LENGTH:
+            break
+    more = more or shown < len(rows)
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("Prev", callback_data=f"query:{query_id}:{max(offset - QUERY_PAGE_SIZE, 0)}"))
+    if more and not write: # Writes are not run again
+        buttons.append(InlineKeyboardButton("Next", callback_data=f"query:{query_id}:{offset + max(shown, 1)}"))
+
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@timed
 @permissions_factory("admin")
 @restricted
 async def edit_db_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Allows direct access to DB through sql commands
+    Query console for the DB, read-only unless started with /edit_db write
     Only give access to certain members of admin
     """
     print("COMMAND: edit DB")
 
     chat_id = update.effective_chat.id
+    context.user_data["query_write"] = bool(context.args) and context.args[0].lower() == "write"
 
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
         text = CONVERSATION_ENTER_PASSWORD_MSG
     )
 
     return PW
 
+@timed
 async def edit_db_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Executes whatever command is entered by the user, so
-    DO NOT USE THIS FUNCTION UNLESS ABSOLUTELY NECESSARY
+    Executes whatever command is entered by the user, and sends the first page of results.
+    DO NOT USE WRITE MODE UNLESS ABSOLUTELY NECESSARY
     """
     chat_id = update.effective_chat.id
 
     query = update.message.text
+    write = context.user_data.pop("query_write", False)
+    query_id = update.message.message_id
 
-    # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
-    cur = con.cursor()
+    # Saved for paging, only the latest query of each user can be paged
+    context.user_data["query"] = (query_id, query, write)
 
-    # Attempt to execute
-    try:
-        res = cur.execute(query)
-        con.commit()
-        response = res.fetchall()
-    except Exception as e:
-        response = str(e)
-    
-    con.close()
+    text, reply_markup = await query_page(query, write, 0, query_id)
 
     # Output
-    await context.bot.send_message(
+    queue_message(
         chat_id = chat_id,
-        text = response
+        text = text,
+        reply_markup = reply_markup,
+        parse_mode = "HTML"
     )
 
     return ConversationHandler.END
 
+@timed
+async def query_page_cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Shows another page of query results once Prev / Next is clicked.
+    Queries are kept in the user_data of the admin who ran them, so nobody else can page through them.
+    """
+    _, query_id, offset = update.callback_query.data.split(":")
+    message_id = update.callback_query.message.message_id
+    chat_id = update.effective_chat.id
+
+    saved = context.user_data.get("query")
+    if saved == None or saved[0] != int(query_id):
+        await update.callback_query.answer(QUERY_EXPIRED_MSG)
+        return
+    await update.callback_query.answer()
+
+    _, query, write = saved
+    text, reply_markup = await query_page(query, write, int(offset), saved[0])
+
+    queue_edit(
+        chat_id = chat_id,
+        message_id = message_id,
+        text = text,
+        reply_markup = reply_markup,
+        parse_mode = "HTML"
+    )
+
 
 edit_db_handler = ConversationHandler(
     entry_points = [CommandHandler("edit_db", edit_db_command)],
     states = {
-        PW: [MessageHandler(filters.TEXT, lambda u, c: password(u, c, QUERY, EDIT_DB_MSG)),
+        PW: [MessageHandler(filters.TEXT, lambda u, c: password(u, c, QUERY, EDIT_DB_WRITE_MSG if c.user_data.get("query_write") else EDIT_DB_MSG)),
                 MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
         QUERY: [MessageHandler(filters.TEXT, edit_db_query),
                 MessageHandler(filters.ALL & ~filters.COMMAND, invalid)],
@@ -1909,6 +3287,7 @@ edit_db_handler = ConversationHandler(
 
 
 ### OTHER EVENTS
+@timed
 async def migrate_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handles migrations to another chat
@@ -1922,7 +3301,7 @@ async def migrate_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Connect to DB
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db")
+    con = connect()
     cur = con.cursor()
 
     # Update databases
@@ -1938,16 +3317,24 @@ async def migrate_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 WHERE chat_id={old_chat_id}")
     con.commit()
 
-    cur.execute(f"UPDATE schedule SET chat_id={new_chat_id} \
+    cur.execute(f"UPDATE ridership_daily SET chat_id={new_chat_id} \
                 WHERE chat_id={old_chat_id}")
+    bump_data_version(cur)
     con.commit()
 
-    con.close()
+    cur.execute(f"UPDATE ridership_archive SET chat_id={new_chat_id} \
+                WHERE chat_id={old_chat_id}")
+    con.commit()
 
-    # Update bot_data
-    context.bot_data[new_chat_id] = context.bot_data[old_chat_id]
-    del context.bot_data[old_chat_id]
-    print(context.bot_data)
+    cur.execute(f"UPDATE recommendations SET chat_id={new_chat_id} \
+                WHERE chat_id={old_chat_id}")
+    con.commit()
+
+    cur.execute(f"UPDATE registrations SET chat_id={new_chat_id} \
+                WHERE chat_id={old_chat_id}")
+    con.commit()
+
+    con.close()
 
 
 ### ERROR
@@ -16,20 +16,36 @@ from telegram.ext import (
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from http import HTTPStatus
 
+import time
+START_TIME = time.perf_counter() # For startup timings
+
 import os
-from datetime import time
+import hmac
+import asyncio
+import hashlib
+from datetime import datetime
 import pytz
 
-from setup import * # Ensure setup.py in same directory
+from setup import setup_db # Ensure setup.py in same directory
+from db import connect # Ensure db.py in same directory
 from handlers import * # Ensure handlers.py in same directory
+from outbox import start_outbox, stop_outbox, outbox_running, outbox_backlog # Ensure outbox.py in same directory
+from webhook import * # Ensure webhook.py in same directory
+import metrics # Ensure metrics.py in same directory
+from metrics import Gauge, InstrumentedRequest
 
 ### CONSTANTS
 # Environment Variables
 TOKEN = os.environ['TOKEN']
 BOT_USERNAME = os.environ['BOT_USERNAME']
 TIMEZONE = os.environ['TIMEZONE']
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', "https://rsnbusbot.onrender.com/webhook")
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') # Optional, checked against the secret token header of webhook requests
+BOT_API_URL = os.environ.get('BOT_API_URL') # Optional, e.g. the fake Bot API server in benchmarks/ for load tests
+UPDATE_LOG = os.environ.get('UPDATE_LOG') # Optional, path of a .jsonl.gz file to record webhook requests to
 
 ### MAIN
 """
@@ -37,29 +53,117 @@ There are two applications running:
  - The Python Telegram Bot application, which handles receiving, processing and sending Telegram updates.
  - The FastAPI application, which sets up the webhook endpoint for Telegram to send updates to.
 """
-setup_db()
-
 print('Starting bot...') # Logging
 
 # Create the PTB application
-ptb = (
+builder = (
     Application.builder()
     .token(TOKEN)
+    .request(InstrumentedRequest(connection_pool_size=256)) # Records metrics for Telegram API calls
     .concurrent_updates(False)
-    .build()
 )
+if BOT_API_URL:
+    builder.base_url(f"{BOT_API_URL}/bot")
+ptb = builder.build()
+
+# Booking metrics
+def count_rows(table):
+    """Counts the rows of a table, shared by all worker processes."""
+    con = connect()
+    count = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    con.close()
+    return count
+
+OPEN_BOOKINGS = Gauge("open_bookings", "Registrations currently open")
+OPEN_BOOKINGS.set_function(lambda: count_rows("registrations"))
+RIDERS = Gauge("riders", "Riders registered across all open registrations")
+RIDERS.set_function(lambda: count_rows("riders"))
+
+# Updates received at the webhook, waiting to be processed by the PTB application
+update_queue = UpdateQueue(UPDATE_QUEUE_SIZE)
+recent_update_ids = RecentUpdateIds(RECENT_UPDATE_IDS)
+update_recorder = UpdateRecorder(UPDATE_LOG) if UPDATE_LOG else None
+
+async def register_webhook():
+    """
+    Sets up the webhook, unless Telegram already has it registered with the same settings.
+    The secret token is not returned by getWebhookInfo, so the last registered settings are kept in the database.
+    """
+    settings = f"{WEBHOOK_URL} {WEBHOOK_SECRET} {HANDLED_UPDATE_TYPES}"
+    fingerprint = hashlib.sha256(settings.encode()).hexdigest()
+
+    info = await ptb.bot.getWebhookInfo()
+    if info.url == WEBHOOK_URL and get_meta("webhook") == fingerprint:
+        print("Webhook already registered.")
+        return
+
+    await ptb.bot.setWebhook(url=WEBHOOK_URL,
+                            certificate=None,
+                            secret_token=WEBHOOK_SECRET,
+                            allowed_updates=HANDLED_UPDATE_TYPES) # Sets up webhook
+    set_meta("webhook", fingerprint)
+    print("Webhook registered.")
+
+async def deferred_startup():
+    """
+    Work which is not needed to serve the first requests, run after startup completes.
+    """
+    if is_job_leader(): # Once for all worker processes
+        await clean_schedule() # Catch up on schedule cleaning missed while the bot was down
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """This code only runs once, before the application starts up and starts receiving requests."""
+    timings = {"imports": time.perf_counter() - START_TIME}
+    lap = time.perf_counter()
+    def timing(name):
+        nonlocal lap
+        now = time.perf_counter()
+        timings[name] = now - lap
+        lap = now
 
-    await ptb.bot.setWebhook(url="https://rsnbusbot.onrender.com/webhook",
-                            certificate=None) # Sets up webhook
+    setup_db()
+    ptb.job_queue.run_repeating(renew_job_lock, 
+                                interval=JOB_LOCK_RENEW_INTERVAL, 
+                                first=0, 
+                                name="renew_job_lock") # Only one worker process runs the jobs
+    ptb.job_queue.run_repeating(registration_job, 
+                                interval=REGISTRATION_CHECK_INTERVAL, 
+                                first=0, 
+                                name="registration_job") # Opens / closes registrations at each bus's times
+    tz = pytz.timezone(TIMEZONE)
+    ptb.job_queue.run_daily(recommendations_job,
+                            time=datetime.now(tz).replace(hour=int(RECOMMENDATIONS_TIME[:2]), 
+                                                          minute=int(RECOMMENDATIONS_TIME[2:]), 
+                                                          second=0, microsecond=0).timetz(),
+                            name="recommendations_job")
+    ptb.job_queue.run_daily(compact_ridership_job,
+                            time=datetime.now(tz).replace(hour=int(RIDERSHIP_COMPACTION_TIME[:2]), 
+                                                          minute=int(RIDERSHIP_COMPACTION_TIME[2:]), 
+                                                          second=0, microsecond=0).timetz(),
+                            name="compact_ridership_job")
+    timing("database")
+
+    await register_webhook()
+    timing("webhook")
     
     # Allows ptb and fastapi applications to run together
     async with ptb:
         await ptb.start()
+        update_queue.start(ptb) # Processes updates received at the webhook
+        start_outbox(ptb.bot) # Delivers queued messages
+        timing("bot")
+
+        text = ", ".join(f"{name} {t:.2f}s" for name, t in timings.items())
+        print(f"Startup timings: {text}, total {time.perf_counter() - START_TIME:.2f}s")
+
+        deferred = asyncio.create_task(deferred_startup())
         yield
+        await asyncio.gather(deferred, return_exceptions=True)
+        await update_queue.stop()
+        if update_recorder is not None:
+            update_recorder.close()
+        await stop_outbox()
         await ptb.stop()
 
 # Create the FastAPI application
@@ -71,12 +175,148 @@ async def index():
     # TODO FUTURE: Add a basic single static page here to explain the bot!
     return "Hello"
 
+def check_health():
+    """
+    Checks that the PTB application and the workers feeding it are running, and that updates are not stuck.
+    """
+    processing_since = update_queue.processing_since
+    processing = 0 if processing_since is None else time.monotonic() - processing_since
+
+    checks = {
+        "bot_running": ptb.running,
+        "update_queue_running": update_queue.running,
+        "outbox_running": outbox_running(),
+        "update_processing_seconds": round(processing, 3),
+    }
+    ok = ptb.running and update_queue.running and outbox_running() \
+        and processing <= HEALTH_MAX_UPDATE_SECONDS
+    return ok, checks
+
+def check_readiness():
+    """
+    Checks the database, queues and scheduled jobs, in addition to check_health.
+    """
+    ok, checks = check_health()
+
+    # Database
+    try:
+        con = connect()
+        con.execute("SELECT 1")
+        con.close()
+        checks["database"] = True
+    except Exception as e:
+        print(e)
+        checks["database"] = False
+        ok = False
+
+    # Update queue
+    depth = update_queue.queue.qsize()
+    checks["update_queue_depth"] = depth
+    ok = ok and depth <= HEALTH_MAX_UPDATE_QUEUE
+
+    # Outbox
+    if checks["database"]:
+        pending, age, failed = outbox_backlog()
+        checks["outbox"] = {"pending": pending, "overdue_seconds": round(age, 3), "failed": failed}
+        ok = ok and age <= HEALTH_MAX_OUTBOX_AGE
+
+    # Jobs
+    now = datetime.now(pytz.utc)
+    checks["jobs"] = {}
+    for job in ptb.job_queue.jobs():
+        try:
+            next_t = job.next_t
+        except AttributeError: # Job queue not started yet
+            next_t = None
+        checks["jobs"][job.name] = None if next_t is None else next_t.isoformat()
+        if next_t is not None and (now - next_t).total_seconds() > HEALTH_MAX_JOB_DELAY:
+            ok = False
+    if not checks["jobs"]: # The registration job must always be scheduled
+        ok = False
+
+    return ok, checks
+
+class CachedCheck:
+    """
+    Reuses the result of a health check for HEALTH_CACHE_SECONDS, so that probes cost almost nothing to serve.
+    """
+    def __init__(self, check):
+        self.check = check
+        self.result = None
+        self.checked = 0
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.result is None or now - self.checked > HEALTH_CACHE_SECONDS:
+            self.result = self.check()
+            self.checked = now
+        
+        ok, checks = self.result
+        status_code = HTTPStatus.OK if ok else HTTPStatus.SERVICE_UNAVAILABLE
+        return JSONResponse({"ok": ok, "checks": checks}, status_code = status_code)
+
+cached_health = CachedCheck(check_health)
+cached_readiness = CachedCheck(check_readiness)
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness probe. Fails if the bot has stalled and should be restarted."""
+    return cached_health()
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness probe. Fails if the bot cannot currently serve updates or send messages in time."""
+    return cached_readiness()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/webhook")
 async def process_update(request: Request):
-    """Updates PTB application when post request received at webhook"""
-    req = await request.json()
-    update = Update.de_json(req, ptb.bot)
-    await ptb.process_update(update)
+    """
+    Queues the update for the PTB application when post request received at webhook.
+    Responds as soon as the update is queued, so Telegram does not wait for the update to be processed.
+    """
+    # Reject requests which were not sent by Telegram
+    if WEBHOOK_SECRET:
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            return Response(status_code = HTTPStatus.FORBIDDEN)
+
+    body = await request.body()
+    if update_recorder is not None: # Recorded as received, so that replays include duplicate and ignored updates
+        update_recorder.record(time.time(), body)
+
+    # Drop updates which were already received, e.g. redelivered by Telegram after a slow response
+    update_id = get_update_id(body)
+    if update_id in recent_update_ids:
+        UPDATES_DUPLICATE.inc()
+        return Response(status_code = HTTPStatus.OK)
+
+    try:
+        req = loads(body)
+    except Exception:
+        return Response(status_code = HTTPStatus.BAD_REQUEST)
+    if not isinstance(req, dict) or "update_id" not in req:
+        return Response(status_code = HTTPStatus.BAD_REQUEST)
+
+    # Drop updates which no handler would process, before building the Update
+    if not is_handled(req):
+        UPDATES_IGNORED.inc()
+        recent_update_ids.add(update_id)
+        return Response(status_code = HTTPStatus.OK)
+
+    try:
+        update = Update.de_json(req, ptb.bot)
+    except Exception:
+        return Response(status_code = HTTPStatus.BAD_REQUEST)
+
+    if not update_queue.put(update): # Full queue, Telegram will retry later
+        return Response(status_code = HTTPStatus.SERVICE_UNAVAILABLE)
+    recent_update_ids.add(update_id)
+    
     return Response(status_code = HTTPStatus.OK)
 
 # Set up PTB handlers
@@ -85,11 +325,13 @@ ptb.add_handler(CommandHandler('start', start_command))
 ptb.add_handler(CommandHandler('reset', reset_command))
 ptb.add_handler(CommandHandler('view_settings', view_settings_command))
 ptb.add_handler(settings_handler)
+ptb.add_handler(bulk_settings_handler)
 ptb.add_handler(CommandHandler('help', help_command))
 
 # Commands (Booking)
 ptb.add_handler(CommandHandler('book', book_command))
 ptb.add_handler(CallbackQueryHandler(booking_cb_handler, r"^(book|cancel)$")) # Handles callbacks for book command
+ptb.add_handler(CallbackQueryHandler(query_page_cb_handler, r"^query:[0-9]+:[0-9]+$")) # Handles paging of /edit_db results
 ptb.add_handler(manage_book_handler)
 ptb.add_handler(CommandHandler('cancel_book', cancel_book_command))
 ptb.add_handler(CommandHandler('uncancel_book', uncancel_book_command))
@@ -97,6 +339,7 @@ ptb.add_handler(CommandHandler('uncancel_book', uncancel_book_command))
 # Commands (Scheduling)
 ptb.add_handler(view_schedule_handler)
 ptb.add_handler(schedule_handler)
+ptb.add_handler(import_schedule_handler)
 
 # Commands (Broadcasting)
 ptb.add_handler(broadcast_handler)
@@ -105,6 +348,10 @@ ptb.add_handler(CommandHandler('notify_late_all', lambda u, c: notify_late(u, c,
 
 # Commands (Data)
 ptb.add_handler(CommandHandler('view_data_summary', view_data_summary_command))
+ptb.add_handler(CommandHandler('analytics', analytics_command))
+ptb.add_handler(CommandHandler('backfill_ridership', backfill_ridership_command))
+ptb.add_handler(CommandHandler('chart', chart_command))
+ptb.add_handler(CommandHandler('export', export_command))
 ptb.add_handler(edit_db_handler)
 
 # Messages
@@ -117,12 +364,7 @@ ptb.add_handler(MessageHandler(filters.StatusUpdate.MIGRATE, migrate_chat))
 ptb.add_error_handler(error)
 
 # Automatic Processes
-ptb.job_queue.run_daily(daily_booking,
-                        time=time(hour=17, minute=30, second=0, tzinfo=pytz.timezone(TIMEZONE)), 
-                        days=(0, 1, 2, 3, 4, 5, 6)) # MUST be 0 to 6 to work
-ptb.job_queue.run_daily(end_book_job,
-                        time=time(hour=23, minute=59, second=59, tzinfo=pytz.timezone(TIMEZONE)),
-                        days=(0, 1, 2, 3, 4, 5, 6))
+# Scheduled during startup, see lifespan
 
 # Polling, for dev purposes
 # print('Polling...')
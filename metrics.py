@@ -0,0 +1,157 @@
+"""
+Metrics for RSNBusBot
+"""
+
+### IMPORTS
+from telegram.request import HTTPXRequest
+
+import time
+from functools import wraps
+
+### METRICS
+"""
+Metrics are kept in memory by each process, and rendered in the Prometheus text format at /metrics.
+"""
+_metrics = []
+
+class Metric:
+    """
+    Base class for metrics. Values are stored per combination of label values.
+    """
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {} if labels else {(): 0}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(i, "")) for i in self.labels)
+
+    def _label_text(self, key, **extra):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, key)]
+        pairs += [f'{name}="{value}"' for name, value in extra.items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(pairs) + "}"
+
+    def samples(self):
+        """Returns a list of (name, label text, value) to render."""
+        return [(self.name, self._label_text(key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", 
+                 f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """A value which only goes up, e.g. number of updates processed."""
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A value which can go up and down, e.g. queue depth."""
+    type = "gauge"
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Computes the value with function every time the metric is rendered."""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        return super().samples()
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. handler latencies."""
+    type = "histogram"
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.values = {} # bucket counts, then sum and count, for each combination of label values
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = [0] * len(self.buckets) + [0, 0]
+        counts = self.values[key]
+
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self):
+        samples = []
+        for key, counts in self.values.items():
+            for bucket, count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", self._label_text(key, le=bucket), count))
+            samples.append((f"{self.name}_bucket", self._label_text(key, le="+Inf"), counts[-1]))
+            samples.append((f"{self.name}_sum", self._label_text(key), counts[-2]))
+            samples.append((f"{self.name}_count", self._label_text(key), counts[-1]))
+        return samples
+
+def timer(histogram, label):
+    """
+    Creates a decorator which observes how long an async function takes in histogram.
+    Observations are labelled with the name of the function.
+    """
+    def timed(func):
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **{label: func.__name__})
+
+        return wrapped
+    return timed
+
+def render():
+    """
+    Renders all metrics in the Prometheus text format.
+    """
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+### TELEGRAM API
+TELEGRAM_REQUESTS = Counter("telegram_requests_total", "Telegram Bot API calls", ["method"])
+TELEGRAM_ERRORS = Counter("telegram_errors_total", "Telegram Bot API calls which failed", ["method"])
+TELEGRAM_DURATION = Histogram("telegram_request_duration_seconds", "Time taken by Telegram Bot API calls", ["method"])
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    Request backend for the PTB application which records metrics for every Telegram Bot API call.
+    """
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        TELEGRAM_REQUESTS.inc(method=api_method)
+
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception: # Network errors, timeouts, etc.
+            TELEGRAM_ERRORS.inc(method=api_method)
+            raise
+        finally:
+            TELEGRAM_DURATION.observe(time.perf_counter() - start, method=api_method)
+
+        if code >= 400: # Telegram responded with an error
+            TELEGRAM_ERRORS.inc(method=api_method)
+        return code, payload
@@ -0,0 +1,364 @@
+"""
+Outbox for RSNBusBot
+"""
+
+### IMPORTS
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    RetryAfter
+)
+
+import json
+import time
+import asyncio
+
+from constants import * # Ensure constants.py in same directory
+from db import connect # Ensure db.py in same directory
+
+PENDING, SENDING, FAILED = range(0, 3) # status of outbox rows
+
+"""
+Handlers do not call the Telegram API to send or edit messages directly.
+Instead, each message is written to the outbox table, and a pool of workers delivers them in the background:
+ - Messages to the same chat are delivered in the order they were queued.
+ - Edits to a message which is still waiting in the outbox replace the waiting edit, unless other messages were queued after it.
+ - Failed deliveries are retried with exponential backoff, and survive restarts.
+ - Messages whose message_id is needed later, e.g. to remove their buttons, save it in the meta table once delivered.
+"""
+_wakeup = asyncio.Event()
+_workers = []
+
+### RATE LIMITING
+class RateLimiter:
+    """
+    Spaces out API calls so that the bot stays within Telegram's global and per chat limits.
+    Slots are reserved in the rate_limits table, so that the limits hold across all worker processes.
+    """
+    def __init__(self, rate, chat_interval, group_chat_interval):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.group_chat_interval = group_chat_interval
+
+    def reserve(self, key, interval):
+        """Reserves the next free slot of a limit, returning the time it starts at."""
+        now = time.time()
+
+        # Connect to DB
+        con = connect()
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+
+        cur.execute("DELETE FROM rate_limits WHERE next_slot<?", (now,)) # Forget limits which no longer apply
+        res = cur.execute("SELECT next_slot FROM rate_limits WHERE key=?", (key,))
+        data = res.fetchone()
+        slot = now if data is None else max(now, data[0])
+        cur.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?)", (key, slot + interval))
+        con.commit()
+
+        con.close()
+        return slot
+
+    async def wait(self, chat_id):
+        # Per chat limit, group chats have a lower limit than private chats
+        interval = self.group_chat_interval if chat_id < 0 else self.chat_interval
+        await asyncio.sleep(self.reserve(f"chat:{chat_id}", interval) - time.time())
+
+        # Global limit, only reserved once the chat's slot is due, so a chat held back does not hold back the others
+        await asyncio.sleep(self.reserve("global", self.interval) - time.time())
+
+    def defer(self, chat_id, seconds):
+        """Holds back all messages to a chat, e.g. after Telegram responds with RetryAfter."""
+        # Connect to DB
+        con = connect()
+        cur = con.cursor()
+
+        cur.execute("INSERT INTO rate_limits VALUES (?, ?) \
+                    ON CONFLICT (key) DO UPDATE SET next_slot=MAX(next_slot, excluded.next_slot)",
+                    (f"chat:{chat_id}", time.time() + seconds))
+        con.commit()
+
+        con.close()
+
+_limiter = RateLimiter(OUTBOX_RATE, OUTBOX_CHAT_INTERVAL, OUTBOX_GROUP_CHAT_INTERVAL)
+
+### QUEUEING
+def enqueue(method, chat_id, message_id=None, record=None, **kwargs):
+    """
+    Adds a Telegram API call to the outbox.
+    A pending edit to the same message is coalesced if it is the newest message of the chat, so only the latest text is sent.
+    If record is given, the message_id of the message sent is saved in the meta table under record once delivered.
+    """
+    reply_markup = kwargs.get("reply_markup")
+    if reply_markup is not None:
+        kwargs["reply_markup"] = reply_markup.to_dict()
+    payload = json.dumps(kwargs)
+
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    coalesced = False
+    if method == "edit_message_text": # Only the newest message of the chat, so the edit is not sent ahead of later messages
+        res = cur.execute("UPDATE outbox SET payload=? \
+                          WHERE id=(SELECT MAX(id) FROM outbox WHERE chat_id=?) \
+                          AND method='edit_message_text' AND message_id=? AND status=?",
+                          (payload, chat_id, message_id, PENDING))
+        coalesced = res.rowcount > 0
+
+    if not coalesced:
+        cur.execute("INSERT INTO outbox \
+                    (method, chat_id, message_id, payload, status, attempts, next_attempt, record) \
+                    VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                    (method, chat_id, message_id, payload, PENDING, time.time(), record))
+    con.commit()
+
+    con.close()
+
+    # Wake up idle workers
+    _wakeup.set()
+
+def split_message(text, separator="\n", limit=MESSAGE_LENGTH):
+    """
+    Splits text into messages of at most limit characters, between the parts separated by separator.
+    Parts longer than limit are cut.
+    """
+    messages = []
+    message = None
+    for part in text.split(separator):
+        if message is not None and len(message) + len(separator) + len(part) <= limit:
+            message = f"{message}{separator}{part}"
+            continue
+
+        if message is not None:
+            messages.append(message)
+        while len(part) > limit:
+            messages.append(part[:limit])
+            part = part[limit:]
+        message = part
+    messages.append(message)
+    return messages
+
+def queue_message(chat_id, text, **kwargs):
+    """Queues a send_message call."""
+    enqueue("send_message", chat_id, text=text, **kwargs)
+
+def queue_edit(chat_id, message_id, text, **kwargs):
+    """Queues an edit_message_text call."""
+    enqueue("edit_message_text", chat_id, message_id=message_id, text=text, **kwargs)
+
+def queue_remove_buttons(chat_id, message_id):
+    """Queues an edit_message_reply_markup call removing the inline buttons of a message."""
+    enqueue("edit_message_reply_markup", chat_id, message_id=message_id)
+
+def discard_pending(record):
+    """
+    Removes messages queued with record which are still waiting to be sent.
+    Returns True if there were any.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("DELETE FROM outbox WHERE record=? AND status=?", (record, PENDING))
+    con.commit()
+
+    con.close()
+    return res.rowcount > 0
+
+### DELIVERY
+def _claim():
+    """
+    Claims the next message which is due for delivery.
+    Only the oldest message of each chat can be claimed, which keeps messages to a chat in order.
+    Messages claimed by a worker which died are reclaimed after OUTBOX_LEASE seconds.
+    """
+    now = time.time()
+
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT id, method, chat_id, message_id, payload, attempts, record FROM outbox \
+                      WHERE id IN (SELECT MIN(id) FROM outbox WHERE status!=? GROUP BY chat_id) \
+                      AND ((status=? AND next_attempt<=?) OR (status=? AND claimed<?)) \
+                      ORDER BY id",
+                      (FAILED, PENDING, now, SENDING, now - OUTBOX_LEASE))
+    rows = res.fetchall()
+
+    row = None
+    for r in rows:
+        res = cur.execute("UPDATE outbox SET status=?, claimed=? \
+                          WHERE id=? AND (status=? OR claimed<?)",
+                          (SENDING, now, r[0], PENDING, now - OUTBOX_LEASE))
+        con.commit()
+        if res.rowcount > 0: # Not claimed by another worker in the meantime
+            row = r
+            break
+
+    con.close()
+    return row
+
+def _finish(outbox_id, attempts=None, delay=None, record=None, message_id=None):
+    """
+    Removes a delivered (or undeliverable) message from the outbox.
+    If delay is given, the message is instead scheduled to be retried after delay seconds.
+    If record is given, message_id is saved under it in the same transaction.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    if delay is None:
+        cur.execute("DELETE FROM outbox WHERE id=?", (outbox_id,))
+        if record is not None and message_id is not None:
+            cur.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (record, str(message_id)))
+    elif attempts >= OUTBOX_MAX_ATTEMPTS:
+        print(f"Outbox gave up on message {outbox_id} after {attempts} attempts.")
+        cur.execute("UPDATE outbox SET status=?, attempts=? WHERE id=?",
+                    (FAILED, attempts, outbox_id))
+        cur.execute("DELETE FROM outbox WHERE status=? AND claimed<?",
+                    (FAILED, time.time() - OUTBOX_FAILED_RETENTION)) # Failed messages are only kept for a while
+    else:
+        cur.execute("UPDATE outbox SET status=?, attempts=?, next_attempt=? WHERE id=?",
+                    (PENDING, attempts, time.time() + delay, outbox_id))
+    con.commit()
+
+    con.close()
+
+async def _deliver(bot, row):
+    """
+    Makes the API call for an outbox message.
+    """
+    outbox_id, method, chat_id, message_id, payload, attempts, record = row
+    kwargs = json.loads(payload)
+    if message_id is not None:
+        kwargs["message_id"] = message_id
+
+    await _limiter.wait(chat_id)
+
+    try:
+        message = await getattr(bot, method)(chat_id = chat_id, **kwargs)
+    except RetryAfter as e: # Rate limited, does not count as an attempt
+        print(f"Outbox rate limited for chat {chat_id}, retrying in {e.retry_after}s.")
+        _limiter.defer(chat_id, e.retry_after)
+        _finish(outbox_id, attempts, e.retry_after)
+        return
+    except (BadRequest, Forbidden) as e: # Will never succeed, e.g. user did not start the bot
+        print(f"Outbox dropped {method} to chat {chat_id}.")
+        print(e)
+        _finish(outbox_id)
+        return
+    except Exception as e: # Network errors, timeouts, etc.
+        attempts += 1
+        delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+        print(f"Outbox failed to {method} to chat {chat_id} (attempt {attempts}).")
+        print(e)
+        _finish(outbox_id, attempts, delay)
+        return
+
+    _finish(outbox_id, record=record, message_id=getattr(message, "message_id", None))
+
+async def _worker(bot):
+    """
+    Delivers messages from the outbox until cancelled.
+    """
+    while True:
+        _wakeup.clear()
+        row = _claim()
+
+        if row is None: # Nothing due, wait for new messages or retries
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        await _deliver(bot, row)
+
+async def send_now(bot, chat_id, **kwargs):
+    """
+    Sends a message without queueing it, for messages whose message_id is needed straight away, e.g. registrations.
+    Messages queued earlier to the chat are given OUTBOX_SEND_NOW_WAIT seconds to be delivered first, so that it is not sent ahead of them.
+    Failed sends are retried with backoff, up to OUTBOX_SEND_NOW_ATTEMPTS attempts.
+    Returns the message, or None if it could not be sent.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT MAX(id) FROM outbox WHERE chat_id=? AND status!=?", (chat_id, FAILED))
+    last_id = res.fetchone()[0]
+
+    deadline = time.monotonic() + OUTBOX_SEND_NOW_WAIT
+    while last_id is not None and time.monotonic() < deadline:
+        res = cur.execute("SELECT EXISTS (SELECT 1 FROM outbox WHERE chat_id=? AND id<=? AND status!=?)",
+                          (chat_id, last_id, FAILED))
+        if not res.fetchone()[0]:
+            break
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    con.close()
+
+    for attempt in range(1, OUTBOX_SEND_NOW_ATTEMPTS + 1):
+        await _limiter.wait(chat_id)
+
+        try:
+            return await bot.send_message(chat_id = chat_id, **kwargs)
+        except RetryAfter as e:
+            _limiter.defer(chat_id, e.retry_after)
+            delay = e.retry_after
+        except (BadRequest, Forbidden) as e: # Will never succeed, e.g. bot was removed from the chat
+            print(f"Failed to send message to chat {chat_id}.")
+            print(e)
+            return None
+        except Exception as e: # Network errors, timeouts, etc.
+            print(e)
+            delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempt - 1), OUTBOX_BACKOFF_MAX)
+
+        print(f"Failed to send message to chat {chat_id} (attempt {attempt}).")
+        if attempt < OUTBOX_SEND_NOW_ATTEMPTS:
+            await asyncio.sleep(delay)
+
+    return None
+
+def outbox_running():
+    """
+    Checks that all outbox workers are running.
+    """
+    return len(_workers) > 0 and not any(task.done() for task in _workers)
+
+def outbox_backlog():
+    """
+    Returns the number of messages waiting to be delivered, 
+    the seconds the most overdue of them is late by, and the number of messages which failed.
+    """
+    # Connect to DB
+    con = connect()
+    cur = con.cursor()
+
+    res = cur.execute("SELECT COUNT(*), MIN(next_attempt) FROM outbox WHERE status!=?", (FAILED,))
+    pending, oldest = res.fetchone()
+    res = cur.execute("SELECT COUNT(*) FROM outbox WHERE status=?", (FAILED,))
+    failed = res.fetchone()[0]
+
+    con.close()
+
+    age = 0 if oldest is None else max(0, time.time() - oldest)
+    return pending, age, failed
+
+def start_outbox(bot):
+    """
+    Starts the outbox workers. Must be called from within the running event loop.
+    """
+    for _ in range(OUTBOX_WORKERS):
+        _workers.append(asyncio.create_task(_worker(bot)))
+
+async def stop_outbox():
+    """
+    Stops the outbox workers. Undelivered messages stay in the outbox for the next start.
+    """
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -2,18 +2,44 @@
 Setup for RSNBusBot
 """
 
-import sqlite3
+from constants import * # Ensure constants.py in same directory
+from db import connect # Ensure db.py in same directory
 
-import os
 
-DB_FILEPATH = os.environ['DB_FILEPATH']
+def use_autoincrement(con, table, create, max_id):
+    """
+    Rebuilds a table created before its id used AUTOINCREMENT, so that the ids of deleted rows are never used again.
+    create is the CREATE TABLE IF NOT EXISTS statement of the table, and max_id a query for the highest id used so far.
+    """
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE") # Checked again by every worker process, after any other has rebuilt the table
+
+    res = cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    if "AUTOINCREMENT" in res.fetchone()[0]:
+        con.commit()
+        return
+
+    print(f"Rebuilding {table} table...") # Logging
+    cur.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    cur.execute(create)
+    cur.execute(f"INSERT INTO {table} SELECT * FROM {table}_old")
+    cur.execute(f"DROP TABLE {table}_old")
+
+    res = cur.execute(max_id)
+    seq = res.fetchone()[0] or 0
+    cur.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+    cur.execute("INSERT INTO sqlite_sequence VALUES (?, ?)", (table, seq))
+    con.commit()
 
 def setup_db():
-    con = sqlite3.connect(f"{DB_FILEPATH}/rsnbusbot.db") 
+    con = connect() 
     cur = con.cursor()
 
     print('Setting up...') # Logging
 
+    # Allow worker processes to read while another writes
+    res = cur.execute("PRAGMA journal_mode=WAL")
+
     # Prepare the database
     res = cur.execute("CREATE TABLE IF NOT EXISTS settings (\
                     chat_id INTEGER PRIMARY KEY, \
@@ -23,19 +49,46 @@ def setup_db():
                     destination TEXT NOT NULL\
                     )") # Create settings table
 
-    res = cur.execute("CREATE TABLE IF NOT EXISTS buses (\
-                    bus_id INTEGER PRIMARY KEY, \
+    create_buses = f"CREATE TABLE IF NOT EXISTS buses (\
+                    bus_id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                    chat_id INTEGER NOT NULL, \
+                    time TEXT NOT NULL, \
+                    open_time TEXT NOT NULL DEFAULT '{DEFAULT_OPEN_TIME}', \
+                    close_time TEXT NOT NULL DEFAULT '{DEFAULT_CLOSE_TIME}' \
+                    )"
+    res = cur.execute(create_buses) # Create buses table, bus_ids are never reused once buses are removed
+
+    # Add registration windows to buses tables created before they were introduced
+    res = cur.execute("SELECT name FROM pragma_table_info('buses')")
+    columns = [i[0] for i in res.fetchall()]
+    if "open_time" not in columns:
+        cur.execute(f"ALTER TABLE buses ADD COLUMN open_time TEXT NOT NULL DEFAULT '{DEFAULT_OPEN_TIME}'")
+        cur.execute(f"ALTER TABLE buses ADD COLUMN close_time TEXT NOT NULL DEFAULT '{DEFAULT_CLOSE_TIME}'")
+        con.commit()
+
+    create_ridership = "CREATE TABLE IF NOT EXISTS ridership (\
+                    book_id INTEGER PRIMARY KEY AUTOINCREMENT, \
                     chat_id INTEGER NOT NULL, \
-                    time TEXT NOT NULL \
-                    )") # Create buses table
+                    date TEXT NOT NULL, \
+                    time TEXT NOT NULL, \
+                    riders INTEGER NOT NULL\
+                    )"
+    res = cur.execute(create_ridership) # Create ridership table, book_ids are never reused once ridership is archived
 
-    res = cur.execute("CREATE TABLE IF NOT EXISTS ridership (\
+    res = cur.execute("CREATE TABLE IF NOT EXISTS ridership_archive (\
                     book_id INTEGER PRIMARY KEY, \
                     chat_id INTEGER NOT NULL, \
                     date TEXT NOT NULL, \
                     time TEXT NOT NULL, \
                     riders INTEGER NOT NULL\
-                    )") # Create ridership table
+                    )") # Create ridership_archive table, for ridership older than RIDERSHIP_RETENTION_MONTHS
+
+    # Rebuild ridership tables created before book_ids were never reused
+    use_autoincrement(con, "ridership", create_ridership, 
+                      "SELECT MAX(book_id) FROM (SELECT book_id FROM ridership UNION ALL SELECT book_id FROM ridership_archive)")
+
+    # Archived ridership stays in ridership_daily, so it is no longer rolled up by month
+    res = cur.execute("DROP TABLE IF EXISTS ridership_monthly")
     
     res = cur.execute("CREATE TABLE IF NOT EXISTS schedule (\
                       bus_id INTEGER NOT NULL, \
@@ -43,5 +96,126 @@ def setup_db():
                       end_date TEXT NOT NULL, \
                       status INTEGER NOT NULL\
                       )") # Create schedule table
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS ridership_daily (\
+                      chat_id INTEGER NOT NULL, \
+                      time TEXT NOT NULL, \
+                      date TEXT NOT NULL, \
+                      riders INTEGER NOT NULL, \
+                      buses INTEGER NOT NULL, \
+                      capacity INTEGER NOT NULL, \
+                      turned_away INTEGER NOT NULL DEFAULT 0, \
+                      updated_at REAL NOT NULL DEFAULT 0, \
+                      PRIMARY KEY (chat_id, time, date)\
+                      )") # Create ridership_daily table, ridership rolled up by bus time and date (YYYY-MM-DD)
+    res = cur.execute("CREATE INDEX IF NOT EXISTS ridership_daily_date ON ridership_daily (date)")
+
+    # Add demand beyond capacity to ridership_daily tables created before it was introduced
+    res = cur.execute("SELECT name FROM pragma_table_info('ridership_daily')")
+    columns = [i[0] for i in res.fetchall()]
+    if "turned_away" not in columns:
+        cur.execute("ALTER TABLE ridership_daily ADD COLUMN turned_away INTEGER NOT NULL DEFAULT 0")
+        con.commit()
+
+    # Add the time each row last changed to ridership_daily tables created before it was introduced
+    if "updated_at" not in columns:
+        cur.execute("ALTER TABLE ridership_daily ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+        con.commit()
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS recommendations (\
+                      chat_id INTEGER NOT NULL, \
+                      kind TEXT NOT NULL, \
+                      value TEXT NOT NULL, \
+                      reason TEXT NOT NULL, \
+                      PRIMARY KEY (chat_id, kind, value)\
+                      )") # Create recommendations table, for capacity recommendations based on demand
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS charts (\
+                      chat_id INTEGER NOT NULL, \
+                      start_date TEXT NOT NULL, \
+                      end_date TEXT NOT NULL, \
+                      data_version INTEGER NOT NULL, \
+                      file_id TEXT NOT NULL, \
+                      PRIMARY KEY (chat_id, start_date, end_date)\
+                      )") # Create charts table, for Telegram file_ids of charts sent
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS registrations (\
+                      book_id INTEGER PRIMARY KEY, \
+                      chat_id INTEGER NOT NULL, \
+                      message_id INTEGER, \
+                      bus_id INTEGER, \
+                      date TEXT NOT NULL, \
+                      time TEXT NOT NULL, \
+                      closed INTEGER NOT NULL DEFAULT 0\
+                      )") # Create registrations table, for registrations which are open
+    res = cur.execute("CREATE INDEX IF NOT EXISTS registrations_chat_id ON registrations (chat_id, message_id)")
+
+    # Rebuild buses tables created before bus_ids were never reused
+    use_autoincrement(con, "buses", create_buses, 
+                      "SELECT MAX(bus_id) FROM (SELECT bus_id FROM buses UNION ALL SELECT bus_id FROM schedule \
+                      UNION ALL SELECT bus_id FROM registrations)")
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS riders (\
+                      book_id INTEGER NOT NULL, \
+                      user_id INTEGER NOT NULL, \
+                      username TEXT, \
+                      booked_at REAL NOT NULL, \
+                      PRIMARY KEY (book_id, user_id)\
+                      )") # Create riders table, for riders of open registrations
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS bookings (\
+                      book_id INTEGER NOT NULL, \
+                      user_id INTEGER NOT NULL, \
+                      username TEXT, \
+                      date TEXT, \
+                      booked_at REAL NOT NULL, \
+                      cancelled_at REAL, \
+                      PRIMARY KEY (book_id, user_id)\
+                      )") # Create bookings table, for riders of ended registrations and cancelled bookings (date is YYYY-MM-DD)
+    res = cur.execute("CREATE INDEX IF NOT EXISTS bookings_user_id ON bookings (user_id, date)")
+    res = cur.execute("CREATE INDEX IF NOT EXISTS bookings_date ON bookings (date)")
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS turned_away (\
+                      book_id INTEGER NOT NULL, \
+                      user_id INTEGER NOT NULL, \
+                      PRIMARY KEY (book_id, user_id)\
+                      )") # Create turned_away table, for users who could not register as open registrations were full
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS locks (\
+                      name TEXT PRIMARY KEY, \
+                      owner TEXT NOT NULL, \
+                      expires REAL NOT NULL\
+                      )") # Create locks table, shared by all worker processes
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS outbox (\
+                      id INTEGER PRIMARY KEY, \
+                      method TEXT NOT NULL, \
+                      chat_id INTEGER NOT NULL, \
+                      message_id INTEGER, \
+                      payload TEXT NOT NULL, \
+                      status INTEGER NOT NULL, \
+                      attempts INTEGER NOT NULL, \
+                      next_attempt REAL NOT NULL, \
+                      claimed REAL, \
+                      record TEXT\
+                      )") # Create outbox table
+    res = cur.execute("CREATE INDEX IF NOT EXISTS outbox_chat_id ON outbox (chat_id, id)")
+
+    # Add message_ids saved on delivery to outbox tables created before they were introduced
+    res = cur.execute("SELECT name FROM pragma_table_info('outbox')")
+    columns = [i[0] for i in res.fetchall()]
+    if "record" not in columns:
+        cur.execute("ALTER TABLE outbox ADD COLUMN record TEXT")
+        con.commit()
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS rate_limits (\
+                      key TEXT PRIMARY KEY, \
+                      next_slot REAL NOT NULL\
+                      )") # Create rate_limits table, for the next free slot of the outbox's global and per chat limits
+
+    res = cur.execute("CREATE TABLE IF NOT EXISTS meta (\
+                      key TEXT PRIMARY KEY, \
+                      value TEXT NOT NULL\
+                      )") # Create meta table, for internal state of the bot
     
     con.close()
\ No newline at end of file
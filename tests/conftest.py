@@ -0,0 +1,48 @@
+"""
+Test fixtures for RSNBusBot
+
+Every test gets a new database in a temporary DB_FILEPATH, set up by setup_db.
+
+Usage (from the repository root):
+    python -m pytest -q
+"""
+
+### IMPORTS
+import os
+import sys
+import glob
+import tempfile
+
+# Environment for handlers.py, the database is always temporary
+os.environ.setdefault('TOKEN', '123456:test')
+os.environ.setdefault('BOT_USERNAME', 'test_bot')
+os.environ.setdefault('TIMEZONE', 'Asia/Singapore')
+os.environ.setdefault('PASSWORD', 'test')
+os.environ['DB_FILEPATH'] = tempfile.mkdtemp()
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import analytics
+import handlers
+from db import connect
+from setup import setup_db
+
+### FIXTURES
+@pytest.fixture
+def db():
+    """Returns a connection to a new database."""
+    for path in glob.glob(f"{os.environ['DB_FILEPATH']}/rsnbusbot.db*"):
+        os.remove(path)
+    setup_db()
+
+    # Data versions start again with every database, so results cached for the previous one are stale
+    for module in (handlers, analytics):
+        for value in vars(module).values():
+            if isinstance(getattr(value, "cache", None), dict):
+                value.cache.clear()
+
+    con = connect()
+    yield con
+    con.close()
@@ -0,0 +1,46 @@
+"""
+Tests for moving old ridership to the archive
+"""
+
+### IMPORTS
+import asyncio
+from types import SimpleNamespace
+
+import handlers
+
+def add_ridership(con, dates):
+    con.executemany("INSERT INTO ridership (chat_id, date, time, riders) VALUES (-1, ?, '0630', 10)", [(date,) for date in dates])
+    con.commit()
+
+def book_ids(con, table):
+    return [i[0] for i in con.execute(f"SELECT book_id FROM {table} ORDER BY book_id").fetchall()]
+
+### ARCHIVING
+def test_ridership_is_archived_in_batches_oldest_first(db, monkeypatch):
+    monkeypatch.setattr(handlers, "RIDERSHIP_COMPACTION_BATCH_SIZE", 2)
+    add_ridership(db, ["01 Feb 59", "01 Jan 59", "01 Mar 59", "01 Jan 60"])
+
+    assert handlers.archive_ridership("2060-01-01") == 2
+    assert book_ids(db, "ridership_archive") == [1, 2]
+
+    assert [handlers.archive_ridership("2060-01-01") for _ in range(2)] == [1, 0]
+    assert book_ids(db, "ridership") == [4]
+
+def test_ridership_of_open_registrations_is_not_archived(db):
+    add_ridership(db, ["01 Jan 59", "02 Jan 59"])
+    db.execute("INSERT INTO registrations (book_id, chat_id, date, time) VALUES (2, -1, '02 Jan 59', '0630')")
+    db.commit()
+
+    assert handlers.archive_ridership("2060-01-01") == 1
+    assert book_ids(db, "ridership") == [2]
+
+def test_compact_ridership_job_archives_every_batch(db, monkeypatch):
+    monkeypatch.setattr(handlers, "RIDERSHIP_COMPACTION_BATCH_SIZE", 2)
+    monkeypatch.setattr(handlers, "RIDERSHIP_COMPACTION_PAUSE", 0)
+    monkeypatch.setattr(handlers, "is_job_leader", lambda: True)
+    add_ridership(db, [f"{day:02d} Jan 00" for day in range(1, 6)])
+
+    asyncio.run(handlers.compact_ridership_job(SimpleNamespace()))
+
+    assert book_ids(db, "ridership") == []
+    assert len(book_ids(db, "ridership_archive")) == 5
@@ -0,0 +1,99 @@
+"""
+Tests for the chat picker of /settings in admin chats
+"""
+
+### IMPORTS
+import asyncio
+import json
+from types import SimpleNamespace
+
+import handlers
+import outbox
+from constants import CHAT_PICKER_PAGE_SIZE, NO_CHATS_FOUND_MSG
+
+ADMIN_CHAT = -3
+
+def add_chats(con, count):
+    con.executemany("INSERT INTO settings VALUES (?, 'service', 40, ?, ?)",
+                    [(-100 - i, f"Camp {i:02d}", "MRT" if i % 2 else "Town") for i in range(count)])
+    con.commit()
+
+def buttons(reply_markup):
+    return [[button.text for button in row] for row in reply_markup.inline_keyboard]
+
+def admin_update():
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=ADMIN_CHAT), effective_user=SimpleNamespace(id=1))
+
+def queued(con):
+    res = con.execute("SELECT method, message_id, payload FROM outbox ORDER BY id")
+    return [(method, message_id, json.loads(payload)) for method, message_id, payload in res.fetchall()]
+
+def deliver(message_id):
+    """Delivers the next outbox message, as if Telegram gave it message_id."""
+    class Bot:
+        async def send_message(self, chat_id, **kwargs):
+            return SimpleNamespace(message_id=message_id)
+    asyncio.run(outbox._deliver(Bot(), outbox._claim()))
+
+### PAGING AND SEARCH
+def test_chat_picker_pages_through_service_chats(db):
+    add_chats(db, 20)
+
+    text, reply_markup = handlers.chat_picker(ADMIN_CHAT, "", 0)
+    assert "Page 1 of 3" in text
+    assert buttons(reply_markup)[0] == ["(current chat)"]
+    assert buttons(reply_markup)[1] == ["Camp 00 to Town"]
+    assert buttons(reply_markup)[-1] == ["Next"]
+    assert len(buttons(reply_markup)) == CHAT_PICKER_PAGE_SIZE + 2
+
+    text, reply_markup = handlers.chat_picker(ADMIN_CHAT, "", 5) # Past the last page
+    assert "Page 3 of 3" in text
+    assert buttons(reply_markup)[-1] == ["Prev"]
+
+def test_chat_picker_searches_pickup_and_destination(db):
+    add_chats(db, 20)
+
+    text, reply_markup = handlers.chat_picker(ADMIN_CHAT, "mrt", 0)
+    assert "Chats matching \"mrt\", page 1 of 2" in text
+    assert all(row[0].endswith("to MRT") for row in buttons(reply_markup)[1:-1])
+
+    text, reply_markup = handlers.chat_picker(ADMIN_CHAT, "camp 07", 0)
+    assert buttons(reply_markup) == [["(current chat)"], ["Camp 07 to MRT"]]
+
+    text, reply_markup = handlers.chat_picker(ADMIN_CHAT, "nowhere", 0)
+    assert text.startswith(NO_CHATS_FOUND_MSG)
+
+### PICKER MESSAGE
+def test_new_searches_edit_the_picker_once_delivered(db):
+    add_chats(db, 3)
+    handlers.send_chat_picker(admin_update(), "")
+    deliver(42)
+
+    handlers.send_chat_picker(admin_update(), "camp 01")
+
+    [(method, message_id, payload)] = queued(db)
+    assert (method, message_id) == ("edit_message_text", 42)
+    assert "Chats matching \"camp 01\"" in payload["text"]
+
+def test_new_searches_replace_a_picker_not_delivered_yet(db):
+    handlers.send_chat_picker(admin_update(), "")
+    handlers.send_chat_picker(admin_update(), "camp")
+
+    assert [(method, payload["text"].split("\n")[-1]) for method, _, payload in queued(db)] == \
+        [("send_message", "Chats matching \"camp\", page 1 of 1.")]
+
+def test_removing_the_picker_removes_its_buttons(db):
+    handlers.send_chat_picker(admin_update(), "")
+    deliver(42)
+
+    handlers.remove_chat_picker(admin_update())
+
+    assert queued(db) == [("edit_message_reply_markup", 42, {})]
+    assert handlers.get_meta(handlers.chat_picker_record(admin_update())) is None
+
+def test_removing_the_picker_before_it_is_delivered_discards_it(db):
+    handlers.send_chat_picker(admin_update(), "")
+
+    handlers.remove_chat_picker(admin_update())
+
+    assert queued(db) == []
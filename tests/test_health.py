@@ -0,0 +1,63 @@
+"""
+Tests for the readiness check of the webhook server
+"""
+
+### IMPORTS
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+import pytz
+
+import main
+import outbox
+from constants import HEALTH_MAX_JOB_DELAY, HEALTH_MAX_OUTBOX_AGE, HEALTH_MAX_UPDATE_QUEUE
+
+@pytest.fixture
+def server(db, monkeypatch):
+    """A healthy server with the registration job scheduled, which tests can break."""
+    jobs = [SimpleNamespace(name="registration_job", next_t=datetime.now(pytz.utc) + timedelta(seconds=10))]
+    monkeypatch.setattr(main, "check_health", lambda: (True, {}))
+    monkeypatch.setattr(main, "ptb", SimpleNamespace(job_queue=SimpleNamespace(jobs=lambda: jobs)))
+    return SimpleNamespace(jobs=jobs)
+
+### READINESS
+def test_ready(server):
+    ok, checks = main.check_readiness()
+
+    assert ok
+    assert checks["database"] and checks["outbox"] == {"pending": 0, "overdue_seconds": 0, "failed": 0}
+    assert list(checks["jobs"]) == ["registration_job"]
+
+def test_not_ready_without_the_database(server, monkeypatch):
+    def connect():
+        raise OSError("database is gone")
+    monkeypatch.setattr(main, "connect", connect)
+
+    ok, checks = main.check_readiness()
+
+    assert not ok
+    assert checks["database"] is False and "outbox" not in checks
+
+def test_not_ready_with_too_many_updates_queued(server, monkeypatch):
+    monkeypatch.setattr(main.update_queue.queue, "qsize", lambda: HEALTH_MAX_UPDATE_QUEUE + 1)
+
+    assert main.check_readiness()[0] is False
+
+def test_not_ready_with_overdue_messages(server, db):
+    outbox.queue_message(-1, "stuck")
+    db.execute("UPDATE outbox SET next_attempt=?", (time.time() - HEALTH_MAX_OUTBOX_AGE - 10,))
+    db.commit()
+
+    ok, checks = main.check_readiness()
+
+    assert not ok
+    assert checks["outbox"]["pending"] == 1
+
+def test_not_ready_with_overdue_or_missing_jobs(server):
+    server.jobs[0].next_t = datetime.now(pytz.utc) - timedelta(seconds=HEALTH_MAX_JOB_DELAY + 10)
+    assert main.check_readiness()[0] is False
+
+    server.jobs.clear()
+    assert main.check_readiness()[0] is False
@@ -0,0 +1,61 @@
+"""
+Tests for messages which grow with the number of routes, which must be split at Telegram's message limit
+"""
+
+### IMPORTS
+import analytics
+import handlers
+from constants import MESSAGE_LENGTH
+from outbox import split_message
+
+def add_routes(con, routes, days=30):
+    """Adds service chats with ridership of three bus times a day."""
+    rows = []
+    for route in range(routes):
+        chat_id = -1000 - route
+        con.execute(f"INSERT INTO settings VALUES ({chat_id}, 'Service', 40, 'Pickup number {route} & co', 'Destination {route}')")
+        for day in range(1, days + 1):
+            for time in ("0630", "0645", f"{route % 10 + 7:02d}{route % 4 * 15:02d}"):
+                rows.append((chat_id, time, f"2060-01-{day:02d}", 20 + route % 20, 1, 40))
+    con.executemany("INSERT INTO ridership_daily (chat_id, time, date, riders, buses, capacity) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+
+### SPLITTING
+def test_split_message_keeps_parts_in_order():
+    parts = [f"line {i} " * 20 for i in range(200)]
+
+    messages = split_message("\n".join(parts))
+
+    assert len(messages) > 1
+    assert all(len(message) <= MESSAGE_LENGTH for message in messages)
+    assert "\n".join(messages) == "\n".join(parts)
+
+def test_split_message_cuts_parts_longer_than_the_limit():
+    messages = split_message(f"short\n{'x' * 10}\nend", limit=4)
+
+    assert messages == ["shor", "t", "xxxx", "xxxx", "xx", "end"]
+
+def test_split_message_leaves_short_text_alone():
+    assert split_message("a\nb") == ["a\nb"]
+
+### REPORTS
+def test_ridership_summary_fits_in_messages(db):
+    add_routes(db, 100)
+
+    text = handlers.format_ridership_summary(handlers.get_ridership_summary())
+
+    assert len(text) > MESSAGE_LENGTH
+    assert all(len(message) <= MESSAGE_LENGTH for message in split_message(text))
+
+def test_analytics_report_fits_in_messages(db):
+    add_routes(db, 100)
+
+    messages = analytics.analytics_report()
+
+    assert len(messages) > 1
+    for message in messages:
+        assert len(message) <= MESSAGE_LENGTH
+        assert message.count("<pre>") == message.count("</pre>")
+
+def test_analytics_report_without_ridership(db):
+    assert analytics.analytics_report() is None
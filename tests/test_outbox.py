@@ -0,0 +1,93 @@
+"""
+Tests for the ordering, coalescing and rate limiting of outbox messages
+"""
+
+### IMPORTS
+import json
+import time
+
+import pytest
+
+import outbox
+
+def pending(con):
+    res = con.execute("SELECT method, chat_id, message_id, payload FROM outbox ORDER BY id")
+    return [(method, chat_id, message_id, json.loads(payload)["text"]) for method, chat_id, message_id, payload in res.fetchall()]
+
+### COALESCING
+def test_edits_to_the_newest_message_are_coalesced(db):
+    outbox.queue_edit(-1, 5, "first")
+    outbox.queue_edit(-1, 5, "second")
+
+    assert pending(db) == [("edit_message_text", -1, 5, "second")]
+
+def test_edits_are_not_sent_ahead_of_later_messages(db):
+    outbox.queue_edit(-1, 5, "first")
+    outbox.queue_message(-1, "message")
+    outbox.queue_edit(-1, 5, "second")
+
+    assert pending(db) == [
+        ("edit_message_text", -1, 5, "first"),
+        ("send_message", -1, None, "message"),
+        ("edit_message_text", -1, 5, "second"),
+    ]
+
+def test_edits_to_other_messages_are_not_coalesced(db):
+    outbox.queue_edit(-1, 5, "first")
+    outbox.queue_edit(-1, 6, "second")
+    outbox.queue_edit(-2, 6, "third")
+
+    assert len(pending(db)) == 3
+
+### ORDERING
+def test_claim_delivers_messages_to_each_chat_in_order(db):
+    for text in ("a1", "a2"):
+        outbox.queue_message(-1, text)
+    outbox.queue_message(-2, "b1")
+
+    first, second = outbox._claim(), outbox._claim()
+
+    assert [json.loads(row[4])["text"] for row in (first, second)] == ["a1", "b1"]
+    assert outbox._claim() is None # a2 waits for a1
+
+    outbox._finish(first[0])
+    assert json.loads(outbox._claim()[4])["text"] == "a2"
+
+def test_claim_holds_back_chats_with_a_retry_pending(db):
+    outbox.queue_message(-1, "a1")
+    outbox.queue_message(-1, "a2")
+
+    outbox._finish(outbox._claim()[0], attempts=1, delay=60)
+
+    assert outbox._claim() is None
+
+### RATE LIMITING
+def test_rate_limits_are_shared_by_all_workers(db):
+    first, second = outbox.RateLimiter(10, 1, 3), outbox.RateLimiter(10, 1, 3) # e.g. in two worker processes
+
+    slots = [first.reserve("global", first.interval), second.reserve("global", second.interval)]
+    chat_slots = [first.reserve("chat:-1", 3), second.reserve("chat:-1", 3), first.reserve("chat:-2", 3)]
+
+    assert slots[1] - slots[0] == pytest.approx(0.1)
+    assert chat_slots[1] - chat_slots[0] == pytest.approx(3)
+    assert chat_slots[2] < chat_slots[1] # Other chats are not held back
+
+def test_defer_holds_back_a_chat(db):
+    limiter = outbox.RateLimiter(10, 1, 3)
+
+    limiter.defer(-1, 30)
+
+    assert limiter.reserve("chat:-1", 3) - time.time() > 25
+
+### FAILED MESSAGES
+def test_failed_messages_are_only_kept_for_a_while(db):
+    outbox.queue_message(-1, "old")
+    outbox.queue_message(-2, "new")
+    db.execute("UPDATE outbox SET status=?, claimed=? WHERE chat_id=-1",
+               (outbox.FAILED, time.time() - outbox.OUTBOX_FAILED_RETENTION - 1))
+    db.commit()
+
+    outbox._finish(outbox._claim()[0], attempts=outbox.OUTBOX_MAX_ATTEMPTS, delay=1)
+
+    assert pending(db) == [("send_message", -2, None, "new")]
+    assert outbox.outbox_backlog()[2] == 1
@@ -0,0 +1,52 @@
+"""
+Tests for the /edit_db query console
+"""
+
+### IMPORTS
+import sqlite3
+
+import pytest
+
+import handlers
+from db import get_data_version
+
+def data_version(con):
+    return get_data_version(con.cursor())
+
+### QUERIES
+def test_run_query_pages_results(db):
+    db.executemany("INSERT INTO settings VALUES (?, 'Service', 40, 'Camp', 'MRT')", [(-i,) for i in range(1, 31)])
+    db.commit()
+
+    columns, rows, more, _ = handlers.run_query("SELECT chat_id FROM settings ORDER BY chat_id DESC")
+    assert columns == ["chat_id"] and len(rows) == handlers.QUERY_PAGE_SIZE and more
+
+    _, rows, more, _ = handlers.run_query("SELECT chat_id FROM settings ORDER BY chat_id DESC", offset=handlers.QUERY_PAGE_SIZE)
+    assert rows[0] == (-handlers.QUERY_PAGE_SIZE - 1,) and not more
+
+def test_run_query_is_read_only_unless_write_is_set(db):
+    with pytest.raises(sqlite3.OperationalError):
+        handlers.run_query("INSERT INTO settings VALUES (-1, 'Service', 40, 'Camp', 'MRT')")
+
+def test_run_query_writes_bump_the_data_version(db):
+    version = data_version(db)
+
+    _, _, _, changes = handlers.run_query("INSERT INTO settings VALUES (-1, 'Service', 40, 'Camp', 'MRT')", write=True)
+
+    assert changes == 1
+    assert data_version(db) > version
+
+def test_run_query_writes_without_changes_keep_the_data_version(db):
+    version = data_version(db)
+
+    handlers.run_query("DELETE FROM settings WHERE chat_id=-1", write=True)
+
+    assert data_version(db) == version
+
+### FORMATTING
+def test_format_table_shortens_long_values():
+    table = handlers.format_table(["id", "name"], [(1, None), (2, "x" * 30)])
+
+    lines = table.split("\n")
+    assert lines[2].split("|")[1].strip() == "NULL"
+    assert lines[3].split("|")[1].strip() == "x" * (handlers.QUERY_CELL_WIDTH - 1) + "~"
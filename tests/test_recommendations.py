@@ -0,0 +1,71 @@
+"""
+Tests for the daily capacity recommendations of service chats
+"""
+
+### IMPORTS
+import time
+from datetime import datetime, timedelta
+
+import analytics
+import handlers
+from constants import RECOMMENDATIONS_MIN_DAYS
+
+def add_route(con, chat_id, times=("0630",), days=20, riders=20):
+    """Adds a service chat with max riders 40, its buses and their ridership over the last days."""
+    con.execute(f"INSERT INTO settings VALUES ({chat_id}, 'service', 40, 'Camp', 'MRT')")
+    con.executemany("INSERT INTO buses (chat_id, time, open_time, close_time) VALUES (?, ?, '1200', '2000')",
+                    [(chat_id, t) for t in times])
+    add_ridership(con, chat_id, times, range(1, days + 1), riders)
+
+def add_ridership(con, chat_id, times, days, riders, updated_at=None):
+    today = datetime.now()
+    con.executemany("INSERT OR REPLACE INTO ridership_daily VALUES (?, ?, ?, ?, 1, 40, 0, ?)",
+                    [(chat_id, t, (today - timedelta(days=day)).strftime("%Y-%m-%d"), riders, updated_at or time.time())
+                     for t in times for day in days])
+    con.commit()
+
+def recommendations(con, chat_id):
+    res = con.execute(f"SELECT kind, value FROM recommendations WHERE chat_id={chat_id}")
+    return res.fetchall()
+
+### RECOMMEND
+def test_max_riders_needs_enough_days_not_rows():
+    rows = [(t, f"2060-01-{day:02d}", 20, 1, 40, 0) for day in range(1, 4) for t in ("0630", "0645", "0700", "0715")]
+
+    assert len(rows) >= RECOMMENDATIONS_MIN_DAYS
+    assert analytics.recommend(rows, 40, {"0630"}) == []
+
+def test_max_riders_follows_demand_per_bus():
+    rows = [("0630", f"2060-01-{day:02d}", 20, 1, 40, 0) for day in range(1, RECOMMENDATIONS_MIN_DAYS + 1)]
+
+    assert analytics.recommend(rows, 40, set())[0][:2] == ("max_riders", "20")
+
+### UPDATES
+def test_only_chats_which_changed_are_recomputed(db):
+    add_route(db, -1)
+    add_route(db, -2)
+    assert handlers.update_recommendations() == 2
+    assert recommendations(db, -1) == [("max_riders", "20")]
+
+    assert handlers.update_recommendations() == 0
+
+    add_ridership(db, -2, ("0630",), [60], 20) # A late rollup row, for a date long past
+    assert handlers.update_recommendations() == 1
+
+def test_chats_changed_while_computing_are_left_for_the_next_run(db, monkeypatch):
+    add_route(db, -1)
+    add_route(db, -2)
+    recommend = analytics.recommend
+    def recommend_while_a_registration_ends(rows, max_riders, bus_times):
+        add_ridership(db, -1, ("0630",), [0], 40)
+        return recommend(rows, max_riders, bus_times)
+    monkeypatch.setattr(handlers, "recommend", recommend_while_a_registration_ends)
+
+    assert handlers.update_recommendations() == 1
+    assert recommendations(db, -1) == []
+    assert recommendations(db, -2) == [("max_riders", "20")]
+    assert handlers.get_meta("recommendations_time") is None
+
+    monkeypatch.setattr(handlers, "recommend", recommend)
+    assert handlers.update_recommendations() == 2
+    assert recommendations(db, -1) == [("max_riders", "20")]
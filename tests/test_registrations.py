@@ -0,0 +1,197 @@
+"""
+Tests for opening, closing and booking registrations
+"""
+
+### IMPORTS
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytz
+
+import handlers
+from constants import MAX_RIDERS_NOTIF_MSG, REGISTRATION_ENDED_MSG, TOKENS_MSG
+
+def at(hour, minute, second=0, day=1):
+    return pytz.timezone(handlers.TIMEZONE).localize(datetime(2060, 1, day, hour, minute, second))
+
+def add_bus(con, chat_id, time, open_time, close_time):
+    con.execute("INSERT INTO buses (chat_id, time, open_time, close_time) VALUES (?, ?, ?, ?)", (chat_id, time, open_time, close_time))
+    con.commit()
+    return con.execute("SELECT MAX(bus_id) FROM buses").fetchone()[0]
+
+### REGISTRATION EVENTS
+def test_due_registration_events_finds_windows_opening_and_closing(db):
+    first = add_bus(db, -1, "0630", "1200", "2000")
+    second = add_bus(db, -1, "0700", "1300", "2000")
+
+    assert handlers.due_registration_events(at(11, 59), at(12, 0, 15)) == {"open": [first], "close": []}
+    assert handlers.due_registration_events(at(19, 59, 50), at(20, 0, 5)) == {"open": [], "close": [first, second]}
+    assert handlers.due_registration_events(at(12, 0, 15), at(12, 0, 30)) == {"open": [], "close": []}
+
+def test_due_registration_events_does_not_open_registrations_a_day_late(db):
+    add_bus(db, -1, "0630", "2359", "0500")
+
+    events = handlers.due_registration_events(at(23, 58), at(0, 0, 10, day=2))
+
+    assert events == {"open": [], "close": [None]} # Registrations opened with /book close at DEFAULT_CLOSE_TIME
+
+def run_registration_job(monkeypatch, now, leader=True):
+    """Runs registration_job at now, returning the buses it opened and closed registrations for."""
+    ran = {"open": [], "close": []}
+    async def daily_booking(context, bus_ids):
+        ran["open"] += bus_ids
+    async def end_book_job(context, bus_ids):
+        ran["close"] += bus_ids
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(handlers, "datetime", FixedDatetime)
+    monkeypatch.setattr(handlers, "is_job_leader", lambda: leader)
+    monkeypatch.setattr(handlers, "daily_booking", daily_booking)
+    monkeypatch.setattr(handlers, "end_book_job", end_book_job)
+    asyncio.run(handlers.registration_job(SimpleNamespace()))
+    return ran
+
+def test_registration_job_picks_up_buses_added_since_its_last_run(db, monkeypatch):
+    run_registration_job(monkeypatch, at(11, 0))
+    bus_id = add_bus(db, -1, "0630", "1101", "2000") # e.g. through another worker
+
+    assert run_registration_job(monkeypatch, at(11, 1, 10)) == {"open": [bus_id], "close": []}
+    assert run_registration_job(monkeypatch, at(11, 1, 25)) == {"open": [], "close": []}
+
+def test_registration_job_only_runs_on_the_job_leader(db, monkeypatch):
+    add_bus(db, -1, "0630", "1200", "2000")
+    run_registration_job(monkeypatch, at(11, 59, 50))
+
+    assert run_registration_job(monkeypatch, at(12, 0, 5), leader=False) == {"open": [], "close": []}
+    assert handlers.get_meta("registration_job_time") == at(11, 59, 50).isoformat()
+
+def test_registration_job_catches_up_on_recent_events_only(db, monkeypatch):
+    recent = add_bus(db, -1, "0630", "1159", "2000")
+    add_bus(db, -1, "0700", "1100", "2000")
+
+    assert run_registration_job(monkeypatch, at(12, 0, 30)) == {"open": [recent], "close": []}
+
+### BOOKING
+def add_registration(con, chat_id, max_riders, message_id=10):
+    con.execute(f"INSERT OR IGNORE INTO settings VALUES ({chat_id}, 'service', {max_riders}, 'Camp', 'MRT')")
+    con.execute(f"INSERT INTO registrations (chat_id, message_id, date, time) VALUES ({chat_id}, {message_id}, '01 Jan 60', '0630')")
+    con.commit()
+    return con.execute("SELECT MAX(book_id) FROM registrations").fetchone()[0]
+
+def click(chat_id, user_id, data="book", message_id=10):
+    """Handles a click on a registration message button."""
+    update = SimpleNamespace(
+        effective_chat = SimpleNamespace(id=chat_id),
+        callback_query = SimpleNamespace(data=data, message=SimpleNamespace(message_id=message_id),
+                                         from_user=SimpleNamespace(id=user_id, username=f"user{user_id}")))
+    asyncio.run(handlers.booking_cb_handler(update, SimpleNamespace()))
+
+def riders(con, book_id):
+    return [i[0] for i in con.execute(f"SELECT user_id FROM riders WHERE book_id={book_id} ORDER BY user_id").fetchall()]
+
+def queued_texts(con):
+    return [text for (text,) in con.execute("SELECT json_extract(payload, '$.text') FROM outbox WHERE method='send_message'").fetchall()]
+
+async def no_message(context, registration):
+    pass
+
+def test_concurrent_bookings_do_not_exceed_max_riders(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    book_id = add_registration(db, -1, 5)
+
+    with ThreadPoolExecutor(max_workers=10) as pool: # e.g. clicks handled by several worker processes
+        list(pool.map(lambda user_id: click(-1, user_id), range(20)))
+
+    assert len(riders(db, book_id)) == 5
+    assert db.execute(f"SELECT COUNT(*) FROM turned_away WHERE book_id={book_id}").fetchone()[0] == 15
+    assert queued_texts(db).count(MAX_RIDERS_NOTIF_MSG) == 1
+
+def test_users_cannot_book_twice_in_a_chat(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    first = add_registration(db, -1, 5)
+    second = add_registration(db, -1, 5, message_id=11)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda message_id: click(-1, 1, message_id=message_id), (10, 10, 11, 11)))
+
+    assert len(riders(db, first) + riders(db, second)) == 1
+
+def test_cancelled_bookings_are_kept_in_the_booking_history(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    book_id = add_registration(db, -1, 5)
+    click(-1, 1)
+
+    click(-1, 1, data="cancel")
+
+    assert riders(db, book_id) == []
+    assert db.execute("SELECT book_id, user_id, date, cancelled_at IS NOT NULL FROM bookings").fetchall() == \
+        [(book_id, 1, "2060-01-01", 1)]
+
+### ENDING
+def test_each_rider_gets_one_token_for_all_their_registrations(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    first = add_registration(db, -1, 5)
+    second = add_registration(db, -2, 5)
+    for chat_id, user_id in ((-1, 1), (-2, 1), (-1, 2)):
+        click(chat_id, user_id)
+
+    ended = asyncio.run(handlers.end_registrations(SimpleNamespace(), "1"))
+
+    assert [registration["book_id"] for registration in ended] == [first, second]
+    tokens = dict(db.execute("SELECT chat_id, json_extract(payload, '$.text') FROM outbox WHERE chat_id > 0").fetchall())
+    assert tokens[1].startswith(TOKENS_MSG) and tokens[1].count("\n - ") == 2
+    assert tokens[2].startswith("Your registration for the shuttle bus from Camp to MRT")
+    assert db.execute("SELECT COUNT(*) FROM bookings WHERE cancelled_at IS NULL").fetchone()[0] == 3
+    assert db.execute("SELECT SUM(riders) FROM ridership_daily").fetchone()[0] == 3
+
+def test_registrations_are_only_ended_once(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    add_registration(db, -1, 5)
+    click(-1, 1)
+
+    asyncio.run(handlers.end_registrations(SimpleNamespace(), "1"))
+
+    assert asyncio.run(handlers.end_registrations(SimpleNamespace(), "1")) == []
+    assert db.execute("SELECT COUNT(*) FROM outbox WHERE chat_id=1").fetchone()[0] == 1
+
+### MANAGING
+def manage(function, book_id):
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=-3))
+    asyncio.run(function(update, SimpleNamespace(), book_id))
+
+def test_closing_a_registration(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    book_id = add_registration(db, -1, 5)
+
+    manage(handlers.manage_close, book_id)
+
+    assert db.execute(f"SELECT closed FROM registrations WHERE book_id={book_id}").fetchone()[0] == 1
+    click(-1, 1)
+    assert riders(db, book_id) == []
+
+def test_closing_or_reopening_an_ended_registration(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+
+    manage(handlers.manage_close, 1)
+    manage(handlers.manage_reopen, 1)
+
+    assert queued_texts(db) == [REGISTRATION_ENDED_MSG] * 2
+
+def test_reset_keeps_discarded_bookings_as_cancelled(db, monkeypatch):
+    monkeypatch.setattr(handlers, "registration_message", no_message)
+    book_id = add_registration(db, -1, 5)
+    click(-1, 1)
+    click(-1, 2)
+
+    reset_command = inspect.unwrap(handlers.reset_command) # Without the permission checks, which ask Telegram
+    asyncio.run(reset_command(SimpleNamespace(effective_chat=SimpleNamespace(id=-1)), SimpleNamespace()))
+
+    assert riders(db, book_id) == []
+    assert db.execute("SELECT user_id, cancelled_at IS NOT NULL FROM bookings ORDER BY user_id").fetchall() == [(1, 1), (2, 1)]
@@ -0,0 +1,123 @@
+"""
+Tests for the schedule merge and /import_schedule validation
+"""
+
+### IMPORTS
+import asyncio
+from types import SimpleNamespace
+
+import handlers
+from constants import IMPORT_SCHEDULE_MSG
+
+def schedule(con, bus_id):
+    res = con.execute(f"SELECT start_date, end_date, status FROM schedule WHERE bus_id={bus_id} ORDER BY rowid")
+    return res.fetchall()
+
+def add_bus(con, bus_id, chat_id=-1, time="0630"):
+    con.execute(f"INSERT INTO buses (bus_id, chat_id, time) VALUES ({bus_id}, {chat_id}, '{time}')")
+    con.commit()
+
+### SCHEDULE MERGE
+def test_clean_schedule_merges_overlapping_entries_of_the_same_status(db):
+    db.executemany("INSERT INTO schedule VALUES (1, ?, ?, 0)", [("010160", "050160"), ("040160", "100160")])
+    db.commit()
+
+    asyncio.run(handlers.clean_schedule([1]))
+
+    assert schedule(db, 1) == [("010160", "100160", 0)]
+
+def test_clean_schedule_later_entries_take_over_overlapping_dates(db):
+    db.execute("INSERT INTO schedule VALUES (1, '050160', '100160', 0)")
+    db.execute("INSERT INTO schedule VALUES (1, '010160', '060160', 1)")
+    db.commit()
+
+    asyncio.run(handlers.clean_schedule([1]))
+
+    assert schedule(db, 1) == [("010160", "060160", 1), ("070160", "100160", 0)]
+
+def test_clean_schedule_only_rewrites_the_buses_given(db):
+    db.executemany("INSERT INTO schedule VALUES (?, '010160', '050160', 0)", [(1,), (1,), (2,), (2,)])
+    db.commit()
+
+    asyncio.run(handlers.clean_schedule([1]))
+
+    assert len(schedule(db, 1)) == 1
+    assert len(schedule(db, 2)) == 2
+
+def test_clean_schedule_drops_entries_which_have_ended(db):
+    db.execute("INSERT INTO schedule VALUES (1, '010120', '050120', 0)")
+    db.commit()
+
+    asyncio.run(handlers.clean_schedule([1]))
+
+    assert schedule(db, 1) == []
+
+### IMPORT VALIDATION
+def test_parse_schedule_accepts_both_date_formats(db):
+    add_bus(db, 3)
+
+    entries, errors = handlers.parse_schedule([(1, "3", "book", "010160", ""), (2, "3", "Cancel", "2060-01-05", "2060-01-06")])
+
+    assert errors == []
+    assert entries == [(3, "010160", "010160", 0), (3, "050160", "060160", 1)]
+
+def test_parse_schedule_reports_every_invalid_line(db):
+    add_bus(db, 3)
+
+    entries, errors = handlers.parse_schedule([
+        (1, "9", "Book", "010160", ""),
+        (2, "3", "Maybe", "010160", ""),
+        (3, "3", "Book", "320160", ""),
+        (4, "3", "Book", "050160", "010160"),
+    ])
+
+    assert [error.split(":")[0] for error in errors] == ["Line 1", "Line 2", "Line 3", "Line 4"]
+
+def import_schedule(monkeypatch, text=None, document=None):
+    """Sends an import to import_schedule_entries, returning the next state and the replies."""
+    sent = []
+    monkeypatch.setattr(handlers, "queue_message", lambda chat_id, text, **kwargs: sent.append(text))
+    update = SimpleNamespace(
+        effective_chat = SimpleNamespace(id=-3),
+        message = SimpleNamespace(text=text, document=document)
+    )
+    return asyncio.run(handlers.import_schedule_entries(update, SimpleNamespace())), sent
+
+def csv_document(data):
+    async def download_as_bytearray():
+        return bytearray(data)
+    async def get_file():
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+    return SimpleNamespace(file_size=len(data), get_file=get_file)
+
+def test_import_schedule_text_accepts_iso_date_ranges(db, monkeypatch):
+    add_bus(db, 3)
+
+    state, sent = import_schedule(monkeypatch, "3 Cancel 2060-01-05-2060-01-06\n3 Book 2060-01-08")
+
+    assert state == handlers.ConversationHandler.END
+    assert schedule(db, 3) == [("050160", "060160", 1), ("080160", "080160", 0)]
+
+def test_import_schedule_saves_nothing_if_any_line_is_invalid(db, monkeypatch):
+    add_bus(db, 3)
+
+    state, sent = import_schedule(monkeypatch, "3 Cancel 050160\n3 Cancel 2060-01-05-")
+
+    assert state == handlers.IMPORT
+    assert "Line 2" in sent[0]
+    assert schedule(db, 3) == []
+
+def test_import_schedule_rejects_files_which_are_not_csv(db, monkeypatch):
+    for data in (b"\xff\xfe\x00\x01", b"pickup,destination\nA,B"):
+        state, sent = import_schedule(monkeypatch, document=csv_document(data))
+
+        assert state == handlers.IMPORT
+        assert sent == [IMPORT_SCHEDULE_MSG]
+
+def test_import_schedule_reads_csv_files(db, monkeypatch):
+    add_bus(db, 3)
+
+    state, sent = import_schedule(monkeypatch, document=csv_document(b"\xef\xbb\xbfbus_id,status,start_date,end_date\n3,Book,2060-01-05,2060-01-06\n"))
+
+    assert state == handlers.ConversationHandler.END
+    assert schedule(db, 3) == [("050160", "060160", 0)]
@@ -0,0 +1,63 @@
+"""
+Tests for bus timings and bulk settings
+"""
+
+### IMPORTS
+import pytest
+
+import handlers
+
+def add_chat(con, chat_id, buses):
+    con.execute(f"INSERT INTO settings VALUES ({chat_id}, 'Service', 40, 'Camp', 'MRT')")
+    con.executemany(f"INSERT INTO buses (chat_id, time) VALUES ({chat_id}, ?)", [(bus,) for bus in buses])
+    con.commit()
+
+def buses(con, chat_id):
+    res = con.execute(f"SELECT bus_id, time, open_time, close_time FROM buses WHERE chat_id={chat_id} ORDER BY time")
+    return res.fetchall()
+
+### BUS TIMINGS
+def test_parse_buses_reads_registration_windows():
+    assert handlers.parse_buses(["0630", "0700 1200-2000"]) == {"0630": ["1730", "2359"], "0700": ["1200", "2000"]}
+
+@pytest.mark.parametrize("line", ["630", "0630 1200", "0630 1200-1200", "2400"])
+def test_parse_buses_rejects_invalid_timings(line):
+    with pytest.raises(ValueError):
+        handlers.parse_buses(["0645", line])
+
+### BULK SETTINGS
+def test_apply_settings_returns_the_changes_of_each_chat(db):
+    add_chat(db, -1, ["0630", "0700"])
+    add_chat(db, -2, ["0630", "0800"])
+
+    changes = handlers.apply_settings([-1, -2], {"max_riders": 30}, handlers.parse_buses(["0630", "0800 1200-2000"]))
+
+    assert changes == {
+        -1: "Max Riders 40 -> 30; +0800 1200-2000; -0700",
+        -2: "Max Riders 40 -> 30; 0800 1730-2359 -> 1200-2000",
+    }
+    assert [bus[1:] for bus in buses(db, -1)] == [("0630", "1730", "2359"), ("0800", "1200", "2000")]
+
+def test_apply_settings_skips_chats_without_changes(db):
+    add_chat(db, -1, ["0630"])
+
+    assert handlers.apply_settings([-1], {"max_riders": 40}, handlers.parse_buses(["0630"])) == {}
+
+def test_apply_settings_never_reuses_bus_ids(db):
+    add_chat(db, -1, ["0630", "0700"])
+    removed = buses(db, -1)[-1][0]
+
+    handlers.apply_settings([-1], {}, handlers.parse_buses(["0630"]))
+    handlers.apply_settings([-1], {}, handlers.parse_buses(["0630", "0700"]))
+
+    assert buses(db, -1)[-1][0] > removed
+
+def test_apply_settings_deletes_the_schedule_of_removed_buses(db):
+    add_chat(db, -1, ["0630", "0700"])
+    kept, removed = [bus[0] for bus in buses(db, -1)]
+    db.executemany("INSERT INTO schedule VALUES (?, '010160', '050160', 0)", [(kept,), (removed,)])
+    db.commit()
+
+    handlers.apply_settings([-1], {}, handlers.parse_buses(["0630"]))
+
+    assert db.execute("SELECT bus_id FROM schedule").fetchall() == [(kept,)]
@@ -0,0 +1,71 @@
+"""
+Tests for the ingestion of webhook updates
+"""
+
+### IMPORTS
+import asyncio
+from types import SimpleNamespace
+
+import webhook
+from webhook import RecentUpdateIds, UpdateQueue, get_update_id
+
+### DEDUPLICATION
+def test_get_update_id_reads_the_raw_body():
+    assert get_update_id(b'{"update_id": 123, "message": {"text": "\\"update_id\\": 5"}}') == 123
+    assert get_update_id(b'{"message": {}}') is None
+
+def test_recent_update_ids_remember_the_newest_ids():
+    recent = RecentUpdateIds(2)
+    for update_id in (1, 2, 2, 3):
+        recent.add(update_id)
+
+    assert 1 not in recent # Forgotten, as the repeated 2 does not count twice
+    assert 2 in recent and 3 in recent
+    assert len(recent.order) == 2
+
+def test_recent_update_ids_ignore_bodies_without_an_id():
+    recent = RecentUpdateIds(2)
+    recent.add(None)
+
+    assert None not in recent
+
+### UPDATE QUEUE
+class Application:
+    """Records the updates processed, failing on those with a negative update_id."""
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.processed = []
+
+    async def process_update(self, update):
+        await asyncio.sleep(self.delay)
+        self.processed.append(update.update_id)
+        if update.update_id < 0:
+            raise ValueError("handler failed")
+
+def test_updates_are_processed_in_order(monkeypatch):
+    monkeypatch.setattr(webhook, "UPDATE_QUEUE_DRAIN_TIMEOUT", 5)
+    application = Application()
+
+    async def run():
+        updates = UpdateQueue(10)
+        updates.start(application)
+        for update_id in (3, 1, -2, 4):
+            assert updates.put(SimpleNamespace(update_id=update_id))
+        await updates.stop()
+
+    asyncio.run(run())
+
+    assert application.processed == [3, 1, -2, 4] # Failing updates do not stop the queue
+
+def test_updates_are_rejected_once_the_queue_is_full(monkeypatch):
+    monkeypatch.setattr(webhook, "UPDATE_QUEUE_DRAIN_TIMEOUT", 0.01)
+    application = Application(delay=1)
+
+    async def run():
+        updates = UpdateQueue(2)
+        updates.start(application)
+        accepted = [updates.put(SimpleNamespace(update_id=update_id)) for update_id in range(3)]
+        await updates.stop()
+        return accepted, updates.running
+
+    assert asyncio.run(run()) == ([True, True, False], False)
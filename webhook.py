@@ -0,0 +1,178 @@
+"""
+Webhook ingestion for RSNBusBot
+"""
+
+### IMPORTS
+import re
+import gzip
+import json
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+
+try: # Faster JSON decoding, if available
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+from constants import * # Ensure constants.py in same directory
+from metrics import Counter, Gauge # Ensure metrics.py in same directory
+
+### METRICS
+UPDATE_QUEUE_DEPTH = Gauge("update_queue_depth", "Updates waiting to be processed")
+UPDATE_QUEUE_LAG = Gauge("update_queue_lag_seconds", "Seconds the last processed update waited in the queue")
+UPDATES_PROCESSED = Counter("updates_processed_total", "Updates processed by the PTB application")
+UPDATES_REJECTED = Counter("updates_rejected_total", "Updates rejected because the update queue was full")
+UPDATES_DUPLICATE = Counter("updates_duplicate_total", "Updates dropped because they were already received")
+UPDATES_IGNORED = Counter("updates_ignored_total", "Updates dropped because the bot has no handlers for them")
+
+### FILTERING
+HANDLED_UPDATE_TYPES = ["message", "edited_message", "callback_query"] # Update types with handlers in main.py
+
+def is_handled(req):
+    """
+    Checks if the decoded update is of a type which the bot has handlers for.
+    """
+    return any(i in req for i in HANDLED_UPDATE_TYPES)
+
+### DEDUPLICATION
+UPDATE_ID_PATTERN = re.compile(rb'"update_id"\s*:\s*(\d+)')
+
+def get_update_id(body):
+    """
+    Finds the update_id in the raw request body without decoding the JSON.
+    Returns None if there is no update_id.
+    """
+    match = UPDATE_ID_PATTERN.search(body)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+class RecentUpdateIds:
+    """
+    Remembers the most recently received update_ids, so that updates redelivered by Telegram are only processed once.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def __contains__(self, update_id):
+        return update_id in self.ids
+
+    def add(self, update_id):
+        if update_id is None or update_id in self.ids:
+            return
+        self.ids.add(update_id)
+        self.order.append(update_id)
+
+        # Forget the oldest update_id
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+
+### RECORDING
+class UpdateRecorder:
+    """
+    Appends the raw body of every webhook request, with the time it was received, to a gzip compressed log of JSON lines.
+    Bodies are recorded before they are deduplicated or filtered, so that the log holds the traffic exactly as Telegram sent it.
+    Compressing and writing is done by a background thread, so that recording does not hold up the event loop.
+    The log can be fed back into the bot with benchmarks/replay.py.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write, name="update_recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, received, body):
+        if self.thread.is_alive(): # Recording must never stop updates from being processed
+            self.queue.put((received, body))
+
+    def _write(self):
+        with gzip.open(self.path, "at", encoding="utf-8") as f: # Each run appends a new gzip member
+            unflushed = 0
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                received, body = record
+                f.write(json.dumps({"t": received, "body": body.decode("utf-8", "replace")}) + "\n")
+
+                # Flush regularly, so that little is lost if the process dies
+                unflushed += 1
+                if unflushed >= UPDATE_LOG_FLUSH_INTERVAL:
+                    f.flush()
+                    unflushed = 0
+
+    def close(self):
+        """
+        Writes the bodies still waiting to be recorded, then closes the log.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+### UPDATE QUEUE
+class UpdateQueue:
+    """
+    Bounded queue between the webhook endpoint and the PTB application.
+    The webhook only has to queue the update, so Telegram gets its response without waiting for handlers.
+    Updates are processed one at a time, in the order they were received.
+    """
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize)
+        self.task = None
+        self.processing_since = None # When processing of the current update started, for health checks
+        UPDATE_QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    def put(self, update):
+        """
+        Queues an update. Returns False if the queue is full.
+        """
+        try:
+            self.queue.put_nowait((time.time(), update))
+        except asyncio.QueueFull:
+            UPDATES_REJECTED.inc()
+            return False
+
+        return True
+
+    async def _process(self, application):
+        while True:
+            received, update = await self.queue.get()
+            self.processing_since = time.monotonic()
+            UPDATE_QUEUE_LAG.set(time.time() - received)
+
+            try:
+                await application.process_update(update)
+            except Exception as e: # Errors in handlers are caught by PTB, this keeps the queue running regardless
+                print(f"Failed to process update {update.update_id}.")
+                print(e)
+
+            UPDATES_PROCESSED.inc()
+            self.processing_since = None
+            self.queue.task_done()
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, application):
+        """
+        Starts processing updates with the PTB application. Must be called from within the running event loop.
+        """
+        self.task = asyncio.create_task(self._process(application))
+
+    async def stop(self):
+        """
+        Gives queued updates UPDATE_QUEUE_DRAIN_TIMEOUT seconds to be processed, then stops processing.
+        """
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=UPDATE_QUEUE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Update queue stopped with {self.queue.qsize()} updates unprocessed.")
+
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)